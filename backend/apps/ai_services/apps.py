@@ -3,3 +3,6 @@ from django.apps import AppConfig
 class AiServicesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.ai_services'
+
+    def ready(self):
+        import apps.ai_services.signals  # noqa
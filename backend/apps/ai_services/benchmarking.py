@@ -0,0 +1,64 @@
+"""
+Helpers shared by the offline benchmark commands.
+"""
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from django.utils import timezone
+from apps.authentication.models import CustomUser
+from apps.banking.models import BankAccount
+from apps.categories.models import Category
+from apps.transactions.models import Transaction
+from .fakes import generate_transactions
+
+
+class Rollback(Exception):
+    """
+    Raised at the end of a benchmark's atomic block to discard its writes.
+    """
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def create_transactions(count, seed, categories=0):
+    """
+    Create a throwaway user and account holding ``count`` synthetic
+    transactions, one minute apart, and return the account.
+
+    By default the transactions are an unprocessed backlog. With
+    ``categories``, that many categories are created and the transactions
+    are marked processed and spread over them, every (categories + 1)th
+    one left without a category.
+    """
+    run_id = uuid.uuid4().hex[:12]
+    user = CustomUser.objects.create_user(email=f'benchmark-{run_id}@example.com')
+    account = BankAccount.objects.create(
+        user=user,
+        pluggy_account_id=f'benchmark-{run_id}',
+        bank_name='Benchmark',
+        account_type='CHECKING',
+        balance=Decimal('0.00'),
+    )
+    assigned = [
+        Category.objects.create(name=f'Benchmark {run_id} {index}', icon='benchmark', color='#123456')
+        for index in range(categories)
+    ] + [None]
+    now = timezone.now()
+    Transaction.objects.bulk_create([
+        Transaction(
+            account=account,
+            pluggy_transaction_id=f'benchmark-{run_id}-{index}',
+            amount=Decimal(str(amount)),
+            description=description,
+            date=now - timedelta(minutes=index),
+            category=assigned[index % len(assigned)],
+            is_processed=bool(categories),
+        )
+        for index, (description, amount) in enumerate(generate_transactions(count, seed=seed))
+    ], batch_size=1000)
+    return account
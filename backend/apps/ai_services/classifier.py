@@ -0,0 +1,207 @@
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import defaultdict
+from django.conf import settings
+from .normalizer import normalize_merchant
+
+MAGIC = b'GRANANB1'
+# Header length prefix, unsigned little-endian int
+LENGTH_FORMAT = '<I'
+
+
+def extract_features(description, n_features):
+    """
+    Hash the words and character 3-/4-grams of the normalized merchant into
+    ``n_features`` buckets. Returns a dict mapping bucket to count.
+    """
+    features = defaultdict(int)
+    text = normalize_merchant(description).lower()
+    for word in text.split():
+        features[zlib.crc32(word.encode()) % n_features] += 1
+        padded = f' {word} '
+        for size in (3, 4):
+            for start in range(len(padded) - size + 1):
+                features[zlib.crc32(padded[start:start + size].encode()) % n_features] += 1
+    return features
+
+
+class NaiveBayesClassifier:
+    """
+    Multinomial naive Bayes over hashed n-gram features.
+
+    Log-likelihoods are stored feature-major (one row of ``len(classes)``
+    doubles per bucket), so scoring a description reads one contiguous row
+    per feature. Saved models are memory-mapped on load instead of read
+    into memory.
+    """
+
+    def __init__(self, classes, priors, unseen, weights, n_features, buffer=None):
+        self.classes = classes
+        self.priors = priors
+        # Log-likelihood of a bucket never seen in training, per class
+        self.unseen = unseen
+        self.weights = weights
+        self.n_features = n_features
+        # Keeps the mmap alive for as long as ``weights`` points into it
+        self._buffer = buffer
+
+    @classmethod
+    def train(cls, samples, n_features=None, alpha=1.0):
+        """
+        Train from an iterable of (description, category name) pairs.
+        """
+        n_features = n_features or settings.AI_CLASSIFIER_FEATURES
+        counts = {}
+        totals = defaultdict(float)
+        documents = defaultdict(int)
+        for description, category in samples:
+            class_counts = counts.setdefault(category, defaultdict(float))
+            documents[category] += 1
+            for feature, count in extract_features(description, n_features).items():
+                class_counts[feature] += count
+                totals[category] += count
+
+        classes = sorted(counts)
+        n_documents = sum(documents.values())
+        priors = [math.log(documents[name] / n_documents) for name in classes]
+
+        unseen = []
+        weights = array('d', bytes(8 * n_features * len(classes)))
+        for column, name in enumerate(classes):
+            denominator = math.log(totals[name] + alpha * n_features)
+            unseen.append(math.log(alpha) - denominator)
+            for feature in range(n_features):
+                weights[feature * len(classes) + column] = unseen[column]
+            for feature, count in counts[name].items():
+                weights[feature * len(classes) + column] = math.log(count + alpha) - denominator
+        return cls(classes, priors, unseen, weights, n_features)
+
+    def predict_batch(self, descriptions):
+        """
+        Return a (category, confidence) pair for each description. Repeated
+        descriptions are scored once.
+
+        Confidence is the posterior of the best class scaled by the share of
+        the description's features that were seen in training, so a merchant
+        the model has never met does not get a confident guess.
+        """
+        n_classes = len(self.classes)
+        weights = self.weights
+        unseen = list(self.unseen)
+        seen = {}
+        results = []
+        for description in descriptions:
+            if description not in seen:
+                scores = list(self.priors)
+                known = total_count = 0
+                for feature, count in extract_features(description, self.n_features).items():
+                    row = feature * n_classes
+                    total_count += count
+                    if weights[row:row + n_classes].tolist() != unseen:
+                        known += count
+                    for column in range(n_classes):
+                        scores[column] += count * weights[row + column]
+                best = max(range(n_classes), key=scores.__getitem__)
+                total = sum(math.exp(score - scores[best]) for score in scores)
+                coverage = known / total_count if total_count else 0.0
+                seen[description] = (self.classes[best], coverage / total)
+            results.append(seen[description])
+        return results
+
+    def save(self, path):
+        header = json.dumps({
+            'classes': self.classes,
+            'priors': self.priors,
+            'unseen': self.unseen,
+            'n_features': self.n_features,
+            'byteorder': sys.byteorder,
+        }).encode()
+        offset = len(MAGIC) + struct.calcsize(LENGTH_FORMAT) + len(header)
+        padding = -offset % 8
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temporary_path = f'{path}.tmp'
+        with open(temporary_path, 'wb') as model_file:
+            model_file.write(MAGIC)
+            model_file.write(struct.pack(LENGTH_FORMAT, len(header)))
+            model_file.write(header)
+            model_file.write(b'\0' * padding)
+            self.weights.tofile(model_file)
+        # Swap atomically so running workers never map a half-written file
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as model_file:
+            buffer = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if buffer[:len(MAGIC)] != MAGIC:
+            buffer.close()
+            raise ValueError(f'{path} is not a category classifier model')
+        position = len(MAGIC)
+        (header_length,) = struct.unpack_from(LENGTH_FORMAT, buffer, position)
+        position += struct.calcsize(LENGTH_FORMAT)
+        header = json.loads(buffer[position:position + header_length])
+        if header['byteorder'] != sys.byteorder:
+            buffer.close()
+            raise ValueError(f'{path} was saved on a {header["byteorder"]}-endian machine')
+        position += header_length
+        position += -position % 8
+        size = 8 * header['n_features'] * len(header['classes'])
+        weights = memoryview(buffer)[position:position + size].cast('d')
+        return cls(
+            header['classes'], header['priors'], header['unseen'], weights, header['n_features'], buffer=buffer
+        )
+
+
+_classifier = None
+# Identifies the model file _classifier was loaded from
+_classifier_stamp = None
+
+
+def model_stamp(path):
+    """
+    Identify the current model file at ``path``: saving a model replaces
+    the file, which changes its inode and mtime. None when there is none.
+    """
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def get_classifier():
+    """
+    Return the model at AI_CLASSIFIER_PATH, loading it lazily and again
+    whenever train_category_classifier replaces the file, so running
+    workers pick up new models without a restart. Returns None when no
+    model has been trained yet.
+    """
+    global _classifier, _classifier_stamp
+    path = settings.AI_CLASSIFIER_PATH
+    stamp = model_stamp(path)
+    if stamp != _classifier_stamp:
+        classifier = None
+        if stamp is not None:
+            try:
+                classifier = NaiveBayesClassifier.load(path)
+            except (OSError, ValueError, KeyError):
+                classifier = None
+        _classifier, _classifier_stamp = classifier, stamp
+    return _classifier
+
+
+def reset_classifier():
+    """
+    Forget the loaded model so the next get_classifier() call reloads it.
+    """
+    global _classifier, _classifier_stamp
+    _classifier = None
+    _classifier_stamp = None
@@ -0,0 +1,156 @@
+"""
+Offline stand-ins for benchmarking and testing the categorization pipeline
+without network access: a fake OpenAI client and a generator of realistic
+Brazilian bank statement descriptions.
+"""
+import json
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+import httpx
+import openai
+from .matcher import FALLBACK_CATEGORY, get_matcher
+
+BATCH_LINE_PATTERN = re.compile(r'^\s*\d+\. Description: (.*) \| Amount: ', re.MULTILINE)
+SINGLE_LINE_PATTERN = re.compile(r'^\s*Description: (.*)$', re.MULTILINE)
+
+
+def keyword_answer(descriptions):
+    """
+    Default fake answer: categorize with the keyword matcher, as a model
+    that knows common Brazilian merchants would.
+    """
+    return [get_matcher().match(description) or FALLBACK_CATEGORY for description in descriptions]
+
+
+class FakeOpenAIClient:
+    """
+    Drop-in replacement for openai.OpenAI covering chat.completions.create.
+
+    ``answer`` receives the transaction descriptions found in the prompt and
+    returns either a list of category names or the raw message content.
+    ``latency`` (seconds) is slept on every call; ``error_rate`` and
+    ``rate_limit_rate`` are the probabilities of raising a connection error
+    or a 429 RateLimitError. Every call's kwargs are kept in ``calls``.
+    """
+
+    def __init__(self, answer=None, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, seed=None):
+        self.answer = answer or keyword_answer
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.calls = []
+        self.errors = 0
+        self.rate_limited = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        with self._lock:
+            self.calls.append(kwargs)
+            roll = self._random.random()
+        if self.latency:
+            time.sleep(self.latency)
+
+        request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+        if roll < self.rate_limit_rate:
+            with self._lock:
+                self.rate_limited += 1
+            raise openai.RateLimitError(
+                'Rate limit reached (fake)',
+                response=httpx.Response(429, headers={'retry-after': '0'}, request=request),
+                body=None
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            with self._lock:
+                self.errors += 1
+            raise openai.APIConnectionError(request=request)
+
+        prompt = kwargs['messages'][0]['content']
+        is_batch = 'response_format' in kwargs
+        pattern = BATCH_LINE_PATTERN if is_batch else SINGLE_LINE_PATTERN
+        descriptions = pattern.findall(prompt)
+
+        content = self.answer(descriptions)
+        if isinstance(content, list):
+            if is_batch:
+                content = json.dumps({'results': [
+                    {'index': index, 'category': category} for index, category in enumerate(content)
+                ]})
+            else:
+                content = content[0]
+
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(content) // 4
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+
+
+# (description template, amount range); {n} is a store number, {d} a date,
+# {p} an installment marker and {c} a card suffix
+MERCHANT_TEMPLATES = [
+    ('IFOOD *{restaurant}', (-120, -18)),
+    ('UBER *TRIP {d}', (-60, -8)),
+    ('99 *POP {d}', (-45, -7)),
+    ('COMPRA CARTAO SUPERMERCADO {market} {n}', (-650, -25)),
+    ('PADARIA {bakery} {d}', (-40, -5)),
+    ('POSTO {gas} {n} FINAL {c}', (-300, -50)),
+    ('NETFLIX.COM', (-55.90, -55.90)),
+    ('SPOTIFY BRASIL', (-21.90, -21.90)),
+    ('DROGASIL {n}', (-180, -12)),
+    ('DROGARIA SAO PAULO {n}', (-150, -10)),
+    ('MAGALU *{store} {p}', (-900, -80)),
+    ('AMAZON BR {p}', (-500, -30)),
+    ('LOJAS RENNER {n} {p}', (-400, -60)),
+    ('ENEL SP CONTA DE LUZ', (-350, -90)),
+    ('SABESP AGUA {d}', (-180, -40)),
+    ('VIVO INTERNET FIBRA', (-130, -99)),
+    ('CURSO ALURA {d}', (-90, -90)),
+    ('CINEMARK CINEMA {n}', (-80, -25)),
+    ('PIX ENVIADO {person}', (-500, -10)),
+    ('PIX RECEBIDO {person}', (50, 2000)),
+    ('SALARIO {company}', (2500, 12000)),
+]
+NAMES = {
+    'restaurant': ['RESTAURANTE SABOR MINEIRO', 'PIZZARIA BELLA NAPOLI', 'HABIBS', 'MC DONALDS', 'OUTBACK', 'SUSHI DA VILA'],
+    'market': ['EXTRA', 'CARREFOUR', 'PAO DE ACUCAR', 'ASSAI', 'DIA'],
+    'bakery': ['PAO QUENTE', 'SANTA MARIA', 'DONA BENTA'],
+    'gas': ['SHELL', 'IPIRANGA', 'PETROBRAS BR'],
+    'store': ['MAGAZINELUIZA', 'ELETRO'],
+    'person': ['JOAO DA SILVA', 'MARIA SOUZA', 'ANA OLIVEIRA', 'PEDRO SANTOS'],
+    'company': ['ACME LTDA', 'TECH BRASIL SA'],
+}
+
+
+def generate_transactions(count, seed=None):
+    """
+    Return ``count`` synthetic (description, amount) pairs. Merchants are
+    drawn with a skewed distribution so popular ones repeat, as in real
+    statements, and descriptions carry dates, store numbers, installment
+    markers and card suffixes that the normalizer has to strip.
+    """
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) for rank in range(len(MERCHANT_TEMPLATES))]
+    transactions = []
+    for _ in range(count):
+        template, (low, high) = rng.choices(MERCHANT_TEMPLATES, weights=weights)[0]
+        total = rng.randint(2, 12)
+        description = template.format(
+            n=rng.randint(1, 9999),
+            d=f'{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}',
+            p=f'PARC {rng.randint(1, total):02d}/{total:02d}',
+            c=f'{rng.randint(0, 9999):04d}',
+            **{key: rng.choice(values) for key, values in NAMES.items()}
+        )
+        amount = round(rng.uniform(low, high), 2)
+        transactions.append((description, amount))
+    return transactions
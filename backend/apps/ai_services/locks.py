@@ -0,0 +1,44 @@
+"""
+Lease locks in the shared cache. Each holder stores a random token and only
+a caller presenting that token can release the lock, so a holder that
+overran its lease never frees the next holder's lock.
+"""
+import secrets
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+
+# Deletes a lock only if it still holds the caller's token
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def new_token():
+    # An int, which the Redis backend stores unpickled for RELEASE_SCRIPT
+    return secrets.randbelow(2 ** 62) + 1
+
+
+def acquire_lock(key, lease, token=None):
+    """
+    Take the lock ``key`` for ``lease`` seconds. Returns the holder's token,
+    or None if someone else holds it. Cache errors are left to the caller.
+    """
+    token = token or new_token()
+    return token if cache.add(key, token, timeout=lease) else None
+
+
+def release_lock(key, token):
+    """
+    Release ``key`` if it still holds ``token``. Cache errors are left to
+    the caller.
+    """
+    backend = caches['default']
+    if isinstance(backend, RedisCache):
+        # Compare and delete in one step on the Redis server
+        full_key = backend.make_and_validate_key(key)
+        backend._cache.get_client(full_key, write=True).eval(RELEASE_SCRIPT, 1, full_key, token)
+    elif cache.get(key) == token:
+        cache.delete(key)
@@ -0,0 +1,24 @@
+import json
+from django.core.management.base import BaseCommand
+from apps.ai_services.metrics import metrics, to_prometheus
+
+class Command(BaseCommand):
+    help = 'Print AIService categorization metrics aggregated across all workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['prometheus', 'json'], default='prometheus')
+        parser.add_argument('--reset', action='store_true', help='Clear the counters after printing them')
+
+    def handle(self, *args, **options):
+        snapshot = metrics.snapshot()
+        if options['format'] == 'json':
+            data = {}
+            for (name, label, value, suffix), count in snapshot.items():
+                series = f'{name}{{{label}="{value}"}}'
+                data[f'{series}:{suffix}' if suffix else series] = count
+            self.stdout.write(json.dumps(data, indent=2))
+        else:
+            self.stdout.write(to_prometheus(snapshot), ending='')
+
+        if options['reset']:
+            metrics.reset()
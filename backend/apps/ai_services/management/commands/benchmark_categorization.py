@@ -0,0 +1,100 @@
+import time
+from unittest import mock
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction as db_transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from apps.ai_services import tasks
+from apps.ai_services.benchmarking import Rollback, create_transactions, percentile
+from apps.ai_services.fakes import FakeOpenAIClient
+from apps.ai_services.metrics import PATHS, metrics
+from apps.ai_services.models import AICache
+from apps.ai_services.services import AIService
+from apps.transactions.models import Merchant, Transaction
+
+LOCAL_CACHES = {'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'benchmark-categorization',
+}}
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark categorize_user_transactions offline against a fake OpenAI client '
+        'and synthetic transactions. Everything it writes is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transactions', type=int, default=2000)
+        parser.add_argument('--rounds', type=int, default=2,
+                            help='The first round starts with empty caches, later rounds reuse them')
+        parser.add_argument('--latency', type=float, default=0.2, help='Fake OpenAI latency per call, in seconds')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of calls failing with a connection error')
+        parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Share of calls answered with a 429')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        # Always a private in-memory cache: rounds clear the cache and reset
+        # the metrics, which must never touch the shared Redis
+        with override_settings(CACHES=LOCAL_CACHES):
+            self.run(options)
+
+    def run(self, options):
+        client = FakeOpenAIClient(
+            latency=options['latency'],
+            error_rate=options['error_rate'],
+            rate_limit_rate=options['rate_limit_rate'],
+            seed=options['seed'],
+        )
+        try:
+            with db_transaction.atomic(), mock.patch.object(AIService, 'get_client', return_value=client):
+                user = create_transactions(options['transactions'], options['seed']).user
+                for round_number in range(1, options['rounds'] + 1):
+                    self.run_round(round_number, user, client)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run_round(self, round_number, user, client):
+        if round_number == 1:
+            cache.clear()
+            AICache.objects.all().delete()
+        # Start every round from an uncategorized backlog; later rounds keep
+        # the AI caches so they measure the warm path
+        Transaction.objects.filter(account__user=user).update(category=None, is_processed=False)
+        Merchant.objects.update(category=None)
+        metrics.reset()
+        calls_before = len(client.calls)
+
+        item_latencies = []
+        categorize_rows = tasks.categorize_rows
+
+        def timed_categorize_rows(rows, categories):
+            started = time.perf_counter()
+            count = categorize_rows(rows, categories)
+            # Every row in a chunk is written back when the chunk finishes
+            item_latencies.extend([time.perf_counter() - started] * count)
+            return count
+
+        with mock.patch.object(tasks, 'categorize_rows', timed_categorize_rows), \
+                CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            tasks.categorize_user_transactions(user.id)
+            elapsed = time.perf_counter() - started
+
+        snapshot = metrics.snapshot()
+        resolved = {path: snapshot[('ai_categorizations_total', 'path', path, '')] for path in PATHS}
+        lookups = sum(resolved.values())
+        hits = resolved['redis_cache'] + resolved['db_cache']
+        count = len(item_latencies)
+
+        self.stdout.write(f'Round {round_number}')
+        self.stdout.write(f'  transactions:       {count}')
+        self.stdout.write(f'  throughput:         {count / elapsed if elapsed else 0:.1f} tx/s ({elapsed:.2f}s)')
+        self.stdout.write(f'  latency p50/p99:    {percentile(item_latencies, 0.5) * 1000:.1f} / '
+                          f'{percentile(item_latencies, 0.99) * 1000:.1f} ms per item')
+        self.stdout.write(f'  queries per item:   {len(queries) / count if count else 0:.3f} ({len(queries)} total)')
+        self.stdout.write(f'  cache hit rate:     {hits / lookups if lookups else 0:.1%} of {lookups} merchant lookups')
+        self.stdout.write(f'  resolved by path:   {", ".join(f"{path}={value}" for path, value in resolved.items())}')
+        self.stdout.write(f'  fake OpenAI calls:  {len(client.calls) - calls_before} '
+                          f'(errors so far {client.errors}, 429s so far {client.rate_limited})')
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.db.models import F
+from django.core.management.base import BaseCommand, CommandError
+from apps.ai_services.classifier import NaiveBayesClassifier, reset_classifier
+from apps.transactions.models import Transaction
+
+class Command(BaseCommand):
+    help = (
+        'Train the local category classifier from transactions carrying their merchant\'s category. '
+        'Keyword guesses applied to rows only are left out, so they are never learned back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=settings.AI_CLASSIFIER_PATH, help='Where to save the model')
+        parser.add_argument('--min-samples', type=int, default=100, help='Refuse to train on fewer transactions')
+        parser.add_argument('--features', type=int, default=settings.AI_CLASSIFIER_FEATURES, help='Number of hashed feature buckets')
+
+    def handle(self, *args, **options):
+        # Fallback guesses go on rows only and never on the merchant, so
+        # matching the merchant keeps them out of the training set
+        samples = Transaction.objects.filter(
+            category__isnull=False, category=F('merchant__category')
+        ).values_list('description', 'category__name')
+        count = samples.count()
+        if count < options['min_samples']:
+            raise CommandError(f'Only {count} categorized transactions, need at least {options["min_samples"]}')
+
+        classifier = NaiveBayesClassifier.train(samples.iterator(chunk_size=2000), n_features=options['features'])
+        classifier.save(options['output'])
+        reset_classifier()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Trained classifier on {count} transactions across {len(classifier.classes)} categories, '
+            f'saved to {options["output"]}'
+        ))
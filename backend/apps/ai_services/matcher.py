@@ -0,0 +1,192 @@
+import time
+from collections import deque
+from django.core.cache import cache
+from .normalizer import fold_accents
+
+FALLBACK_CATEGORY = 'Outros'
+
+# Built-in keywords, in priority order: when a description matches keywords
+# of several categories, the one listed first wins.
+DEFAULT_KEYWORDS = [
+    ('Alimentação', ['restaurante', 'mercado', 'supermercado', 'padaria', 'ifood']),
+    ('Transporte', ['uber', 'taxi', 'onibus', 'metro', 'combustivel', 'posto']),
+    ('Lazer', ['cinema', 'teatro', 'show', 'bar', 'netflix', 'spotify']),
+    ('Saúde', ['farmacia', 'medico', 'hospital', 'clinica']),
+    ('Educação', ['escola', 'universidade', 'curso', 'livro']),
+    ('Compras', ['shopping', 'loja', 'compras']),
+    ('Serviços', ['luz', 'agua', 'gas', 'telefone', 'internet']),
+]
+
+# Cache key bumped whenever categories change, so every process rebuilds
+VERSION_CACHE_KEY = 'keyword_matcher_version'
+# How often a process checks VERSION_CACHE_KEY, in seconds
+VERSION_CHECK_INTERVAL = 60
+
+
+def fold_keyword(text):
+    return fold_accents(text).lower()
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over category keywords.
+
+    Matching walks each description once, so its cost depends on the
+    description length and not on how many keywords are configured.
+    Keywords match as substrings, after lowercasing and accent folding.
+    """
+
+    def __init__(self, categories):
+        """
+        ``categories`` is a list of (category name, keywords) in priority order.
+        """
+        self.names = []
+        self.goto = [{}]
+        self.fail = [0]
+        # Best (lowest) category priority of any keyword ending at each state
+        self.output = [None]
+
+        for name, keywords in categories:
+            if name not in self.names:
+                self.names.append(name)
+            priority = self.names.index(name)
+            for keyword in keywords:
+                keyword = fold_keyword(keyword).strip()
+                if keyword:
+                    self._add(keyword, priority)
+        self._build()
+
+    def _add(self, keyword, priority):
+        state = 0
+        for char in keyword:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(None)
+            state = next_state
+        if self.output[state] is None or priority < self.output[state]:
+            self.output[state] = priority
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                # Inherit matches that end here through the failure link
+                inherited = self.output[self.fail[next_state]]
+                if inherited is not None and (self.output[next_state] is None or inherited < self.output[next_state]):
+                    self.output[next_state] = inherited
+
+    def match(self, description):
+        """
+        Return the highest-priority category whose keyword occurs in
+        ``description``, or None when nothing matches.
+        """
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        best = None
+        state = 0
+        for char in fold_keyword(description or ''):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            priority = output[state]
+            if priority is not None and (best is None or priority < best):
+                best = priority
+                if best == 0:
+                    break
+        return self.names[best] if best is not None else None
+
+    def match_many(self, descriptions):
+        """
+        Match a list of descriptions, scanning each distinct one only once.
+        """
+        seen = {}
+        results = []
+        for description in descriptions:
+            if description not in seen:
+                seen[description] = self.match(description)
+            results.append(seen[description])
+        return results
+
+
+def load_categories():
+    """
+    Merge DEFAULT_KEYWORDS with the keywords stored on Category rows.
+    """
+    from apps.categories.models import Category
+
+    categories = [(name, list(keywords)) for name, keywords in DEFAULT_KEYWORDS]
+    positions = {name: index for index, (name, _) in enumerate(categories)}
+    for name, keywords in Category.objects.order_by('id').values_list('name', 'keywords'):
+        if isinstance(keywords, str):
+            keywords = keywords.split(',')
+        if not isinstance(keywords, list):
+            continue
+        keywords = [keyword for keyword in keywords if isinstance(keyword, str)]
+        if name in positions:
+            categories[positions[name]][1].extend(keywords)
+        else:
+            positions[name] = len(categories)
+            categories.append((name, keywords))
+    return categories
+
+
+_matcher = None
+_matcher_version = None
+_version_checked_at = 0.0
+
+
+def get_matcher():
+    """
+    Return the process-wide KeywordMatcher, rebuilding it when categories
+    changed in this process (signals) or in another one (version key).
+    """
+    global _matcher, _matcher_version, _version_checked_at
+
+    now = time.monotonic()
+    if _matcher is not None and now - _version_checked_at >= VERSION_CHECK_INTERVAL:
+        _version_checked_at = now
+        try:
+            if cache.get(VERSION_CACHE_KEY) != _matcher_version:
+                _matcher = None
+        except Exception:
+            # Cache might not be available (e.g., Redis down)
+            pass
+
+    if _matcher is None:
+        try:
+            version = cache.get(VERSION_CACHE_KEY)
+        except Exception:
+            version = None
+        try:
+            categories = load_categories()
+        except Exception:
+            # Database might not be available
+            categories = DEFAULT_KEYWORDS
+        _matcher = KeywordMatcher(categories)
+        _matcher_version = version
+        _version_checked_at = now
+    return _matcher
+
+
+def invalidate_matcher():
+    """
+    Drop the cached matcher here and tell other processes to rebuild theirs.
+    """
+    global _matcher
+    _matcher = None
+    try:
+        cache.set(VERSION_CACHE_KEY, time.time_ns(), timeout=None)
+    except Exception:
+        pass
@@ -0,0 +1,190 @@
+import threading
+import time
+from django.core.cache import cache
+
+# Where a categorization was resolved
+PATHS = ('redis_cache', 'db_cache', 'classifier', 'llm', 'single_flight', 'fallback')
+# Where an error can be swallowed on the way
+TIERS = ('redis_cache', 'db_cache', 'classifier', 'llm', 'rate_limiter', 'single_flight')
+TOKEN_KINDS = ('prompt', 'completion')
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Cached series are integers so they can be merged with cache.incr;
+# latency sums are kept in microseconds
+MICROSECONDS = 1_000_000
+CACHE_PREFIX = 'ai_metrics'
+CACHE_TIMEOUT = None
+
+# Flush in-process deltas to the shared cache after this many updates or seconds
+FLUSH_EVERY_UPDATES = 200
+FLUSH_EVERY_SECONDS = 10
+
+
+def series_keys():
+    """
+    Every cached series, as (metric name, label name, label value, suffix).
+    """
+    keys = []
+    for path in PATHS:
+        keys.append(('ai_categorizations_total', 'path', path, ''))
+        for bucket in LATENCY_BUCKETS:
+            keys.append(('ai_categorization_latency_seconds', 'path', path, f'bucket_{bucket}'))
+        keys.append(('ai_categorization_latency_seconds', 'path', path, 'bucket_+Inf'))
+        keys.append(('ai_categorization_latency_seconds', 'path', path, 'sum'))
+        keys.append(('ai_categorization_latency_seconds', 'path', path, 'count'))
+    for kind in TOKEN_KINDS:
+        keys.append(('ai_llm_tokens_total', 'kind', kind, ''))
+    for tier in TIERS:
+        keys.append(('ai_errors_total', 'tier', tier, ''))
+    return keys
+
+
+def cache_key(name, label, value, suffix):
+    return f'{CACHE_PREFIX}:{name}:{label}={value}:{suffix}'
+
+
+class Metrics:
+    """
+    Per-process counters and latency histograms for AIService.
+
+    Updates are cheap in-memory increments. They are pushed to the shared
+    cache as deltas every FLUSH_EVERY_UPDATES updates or FLUSH_EVERY_SECONDS
+    seconds (and by flush()), so snapshot() sees every worker's numbers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._updates = 0
+        self._flushed_at = time.monotonic()
+
+    def _add(self, key, amount):
+        self._pending[key] = self._pending.get(key, 0) + amount
+
+    def observe(self, path, seconds, count=1):
+        """
+        Record ``count`` categorizations resolved together by ``path`` in
+        ``seconds``. The time is split evenly, so a batch adds its elapsed
+        time to the latency sum once and each item is observed at its share.
+        """
+        per_item = seconds / count
+        with self._lock:
+            self._add(('ai_categorizations_total', 'path', path, ''), count)
+            for bucket in LATENCY_BUCKETS:
+                if per_item <= bucket:
+                    self._add(('ai_categorization_latency_seconds', 'path', path, f'bucket_{bucket}'), count)
+            self._add(('ai_categorization_latency_seconds', 'path', path, 'bucket_+Inf'), count)
+            self._add(('ai_categorization_latency_seconds', 'path', path, 'sum'), int(seconds * MICROSECONDS))
+            self._add(('ai_categorization_latency_seconds', 'path', path, 'count'), count)
+            self._updates += 1
+        self._maybe_flush()
+
+    def record_tokens(self, usage):
+        """
+        Record token usage from an OpenAI response's ``usage`` object.
+        """
+        prompt_tokens = getattr(usage, 'prompt_tokens', None)
+        completion_tokens = getattr(usage, 'completion_tokens', None)
+        with self._lock:
+            if isinstance(prompt_tokens, int):
+                self._add(('ai_llm_tokens_total', 'kind', 'prompt', ''), prompt_tokens)
+            if isinstance(completion_tokens, int):
+                self._add(('ai_llm_tokens_total', 'kind', 'completion', ''), completion_tokens)
+            self._updates += 1
+        self._maybe_flush()
+
+    def record_error(self, tier):
+        with self._lock:
+            self._add(('ai_errors_total', 'tier', tier, ''), 1)
+            self._updates += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self._updates >= FLUSH_EVERY_UPDATES or time.monotonic() - self._flushed_at >= FLUSH_EVERY_SECONDS:
+            self.flush()
+
+    def flush(self):
+        """
+        Push pending deltas to the shared cache. Deltas that cannot be
+        written (e.g. Redis down) are kept for the next flush.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._updates = 0
+            self._flushed_at = time.monotonic()
+
+        failed = {}
+        for key, amount in pending.items():
+            if not amount:
+                continue
+            name = cache_key(*key)
+            try:
+                cache.add(name, 0, timeout=CACHE_TIMEOUT)
+                cache.incr(name, amount)
+            except Exception:
+                failed[key] = amount
+
+        if failed:
+            with self._lock:
+                for key, amount in failed.items():
+                    self._add(key, amount)
+
+    def snapshot(self):
+        """
+        Read the fleet-wide totals from the shared cache, including this
+        process's unflushed deltas.
+        """
+        self.flush()
+        keys = series_keys()
+        try:
+            values = cache.get_many([cache_key(*key) for key in keys])
+        except Exception:
+            values = {}
+        return {key: values.get(cache_key(*key), 0) for key in keys}
+
+    def reset(self):
+        with self._lock:
+            self._pending = {}
+            self._updates = 0
+        try:
+            cache.delete_many([cache_key(*key) for key in series_keys()])
+        except Exception:
+            pass
+
+
+def to_prometheus(snapshot):
+    """
+    Render a snapshot() in the Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP ai_categorizations_total Categorizations by resolution path.',
+        '# TYPE ai_categorizations_total counter',
+    ]
+    for path in PATHS:
+        value = snapshot[('ai_categorizations_total', 'path', path, '')]
+        lines.append(f'ai_categorizations_total{{path="{path}"}} {value}')
+
+    lines.append('# HELP ai_categorization_latency_seconds Categorization latency by resolution path.')
+    lines.append('# TYPE ai_categorization_latency_seconds histogram')
+    for path in PATHS:
+        for bucket in LATENCY_BUCKETS + ('+Inf',):
+            value = snapshot[('ai_categorization_latency_seconds', 'path', path, f'bucket_{bucket}')]
+            lines.append(f'ai_categorization_latency_seconds_bucket{{path="{path}",le="{bucket}"}} {value}')
+        total = snapshot[('ai_categorization_latency_seconds', 'path', path, 'sum')] / MICROSECONDS
+        count = snapshot[('ai_categorization_latency_seconds', 'path', path, 'count')]
+        lines.append(f'ai_categorization_latency_seconds_sum{{path="{path}"}} {total:.6f}')
+        lines.append(f'ai_categorization_latency_seconds_count{{path="{path}"}} {count}')
+
+    lines.append('# HELP ai_llm_tokens_total OpenAI tokens used, from response usage.')
+    lines.append('# TYPE ai_llm_tokens_total counter')
+    for kind in TOKEN_KINDS:
+        lines.append(f'ai_llm_tokens_total{{kind="{kind}"}} {snapshot[("ai_llm_tokens_total", "kind", kind, "")]}')
+
+    lines.append('# HELP ai_errors_total Errors handled by AIService, by tier.')
+    lines.append('# TYPE ai_errors_total counter')
+    for tier in TIERS:
+        lines.append(f'ai_errors_total{{tier="{tier}"}} {snapshot[("ai_errors_total", "tier", tier, "")]}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -6,11 +6,14 @@ class AICache(models.Model):
     value = models.JSONField()
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField(null=True, blank=True)
+    last_hit_at = models.DateTimeField(default=timezone.now, help_text="Last read or write, used for LRU eviction")
+    hit_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         indexes = [
             models.Index(fields=['key']),
             models.Index(fields=['expires_at']),
+            models.Index(fields=['last_hit_at']),
         ]
 
     def __str__(self):
@@ -0,0 +1,56 @@
+import re
+import unicodedata
+
+# Boilerplate that Pluggy/bank statements put in front of the merchant name
+PREFIX_PATTERN = re.compile(
+    r'^(?:COMPRA(?:\s+(?:CARTAO|CARTAO\s+DE\s+CREDITO|NO\s+DEBITO|NO\s+CREDITO|DEBITO|CREDITO))?'
+    r'|PAGAMENTO(?:\s+DE)?|PAG\s+BOLETO|DEB(?:ITO)?\s+AUT(?:OMATICO)?'
+    r'|PIX\s+(?:ENVIADO|RECEBIDO|QRS)|TED|DOC|TRANSF(?:ERENCIA)?(?:\s+(?:ENVIADA|RECEBIDA))?'
+    r'|ELO|VISA|MASTERCARD|MAESTRO)\b\s*'
+)
+# Installment markers such as "PARC 02/10", "PARCELA 2 DE 10" or a bare "02/10"
+INSTALLMENT_PATTERN = re.compile(r'\bPARC(?:ELA)?\s*\d{1,2}\s*(?:/|DE)\s*\d{1,2}\b|\b\d{1,2}/\d{1,2}\b')
+# Dates like 12/03, 12/03/2024, 2024-03-12 and times like 14:32
+DATE_PATTERN = re.compile(r'\b\d{1,4}[/-]\d{1,2}(?:[/-]\d{2,4})?\b|\b\d{1,2}:\d{2}(?::\d{2})?\b')
+# Card suffixes such as "FINAL 1234", "****1234" or "*1234"
+CARD_PATTERN = re.compile(r'\bFINAL\s*\d{4}\b|\*+\d{2,}|\bCARTAO\s*\d{4}\b')
+# Any remaining run of digits (store numbers, NSU, authorization codes)
+DIGITS_PATTERN = re.compile(r'\d+')
+PUNCTUATION_PATTERN = re.compile(r'[^A-Z ]+')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def fold_accents(text):
+    """
+    Strip diacritics so that "AÇAÍ" and "ACAI" normalize to the same text.
+    """
+    return ''.join(
+        char for char in unicodedata.normalize('NFKD', text)
+        if not unicodedata.combining(char)
+    )
+
+
+def normalize_merchant(description):
+    """
+    Map a raw transaction description to a canonical merchant key.
+
+    The key drops everything that varies between two purchases at the same
+    merchant (dates, installment markers, card suffixes, store numbers and
+    statement boilerplate), so "IFOOD *RESTAURANTE PARC 02/10" and
+    "IFOOD *RESTAURANTE 12/03" both map to "IFOOD RESTAURANTE".
+    """
+    text = fold_accents(description or '').upper()
+    text = INSTALLMENT_PATTERN.sub(' ', text)
+    text = DATE_PATTERN.sub(' ', text)
+    text = CARD_PATTERN.sub(' ', text)
+    text = DIGITS_PATTERN.sub(' ', text)
+    text = PUNCTUATION_PATTERN.sub(' ', text)
+    text = WHITESPACE_PATTERN.sub(' ', text).strip()
+    stripped = text
+    while True:
+        shorter = PREFIX_PATTERN.sub('', stripped).strip()
+        if shorter == stripped:
+            break
+        stripped = shorter
+    # Keep the boilerplate when it is all there is (e.g. a bare "PIX ENVIADO")
+    return stripped or text or 'DESCONHECIDO'
@@ -0,0 +1,141 @@
+import logging
+import time
+from django.core.cache import cache
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60
+# Usage is counted per slot; a call is admitted when the slots covering the
+# last WINDOW_SECONDS + SLOT_SECONDS stay within the budget
+SLOT_SECONDS = 10
+SLOTS = WINDOW_SECONDS // SLOT_SECONDS
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised by RateLimiter.acquire when the budget frees up only after the
+    caller's timeout. ``retry_after`` is the wait in seconds.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f'Rate limit exceeded, retry in {retry_after:.0f}s')
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """
+    Requests/min and tokens/min budget shared by every worker through the
+    Django cache (Redis in production).
+
+    Usage is counted in SLOT_SECONDS slots, incremented atomically with
+    cache.incr. A call is admitted only if the current slot and the SLOTS
+    slots before it stay within budget. Any WINDOW_SECONDS span falls inside
+    that lookback, so the budget holds over every rolling minute, unlike
+    fixed minute windows, which let a burst at the end of one minute and
+    the start of the next through at twice the rate. The price is that
+    steady traffic gets about SLOTS / (SLOTS + 1) of the nominal budget. A
+    caller that would overdraw either budget gives its share back and
+    sleeps until enough old slots age out. When the cache is unreachable
+    the limiter lets calls through rather than stalling categorization.
+
+    Without ``tokens_per_minute`` only requests are budgeted. Cache failures
+    are counted under ``metrics_tier`` in the AIService metrics; pass None
+    for limiters that are not part of categorization.
+    """
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None, metrics_tier='rate_limiter'):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.metrics_tier = metrics_tier
+
+    def _keys(self, slot):
+        return (
+            f'ratelimit_{self.name}_requests_{slot}',
+            f'ratelimit_{self.name}_tokens_{slot}',
+        )
+
+    @staticmethod
+    def _wait(now, slot, history, excess):
+        """
+        Seconds until ``excess`` units of usage leave the lookback.
+        ``history`` holds the usage of the SLOTS slots before ``slot``,
+        oldest first.
+        """
+        freed = 0
+        for offset, used in enumerate(history):
+            freed += used
+            if freed >= excess:
+                # Slot slot - SLOTS + offset drops out once slot + offset + 1 starts
+                return (slot + offset + 1) * SLOT_SECONDS - now
+        return (slot + SLOTS + 1) * SLOT_SECONDS - now
+
+    def try_acquire(self, tokens):
+        """
+        Reserve one request and ``tokens`` tokens in the current slot.
+        Returns 0 on success, otherwise the seconds until the budget allows
+        the call.
+        """
+        now = time.time()
+        slot = int(now // SLOT_SECONDS)
+        requests_key, tokens_key = self._keys(slot)
+        past_keys = [self._keys(past) for past in range(slot - SLOTS, slot)]
+        try:
+            cache.add(requests_key, 0, timeout=(SLOTS + 2) * SLOT_SECONDS)
+            if self.tokens_per_minute is not None:
+                cache.add(tokens_key, 0, timeout=(SLOTS + 2) * SLOT_SECONDS)
+            # Only the current slot is incremented, so past slots can be read first
+            stored = cache.get_many([key for keys in past_keys for key in keys])
+            request_history = [stored.get(keys[0], 0) for keys in past_keys]
+            used = sum(request_history) + cache.incr(requests_key)
+            if used > self.requests_per_minute:
+                cache.decr(requests_key)
+                return self._wait(now, slot, request_history, used - self.requests_per_minute)
+            if self.tokens_per_minute is None:
+                return 0
+            token_history = [stored.get(keys[1], 0) for keys in past_keys]
+            used = sum(token_history) + cache.incr(tokens_key, tokens)
+            # A single request larger than the whole budget still gets the
+            # lookback to itself instead of waiting forever
+            if used > self.tokens_per_minute and used != tokens:
+                cache.decr(tokens_key, tokens)
+                cache.decr(requests_key)
+                return self._wait(now, slot, token_history, used - self.tokens_per_minute)
+        except Exception as e:
+            # Cache might not be available (e.g., Redis down)
+            logger.warning('Rate limiter %s unavailable, letting request through: %s', self.name, e)
+            if self.metrics_tier:
+                metrics.record_error(self.metrics_tier)
+            return 0
+        return 0
+
+    def acquire(self, tokens=0, timeout=None):
+        """
+        Block until the budget allows the call. With ``timeout`` (seconds),
+        raise RateLimitExceeded rather than wait longer than that.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise RateLimitExceeded(wait)
+            time.sleep(wait)
+
+    def adjust(self, estimated_tokens, actual_tokens):
+        """
+        Correct the current slot once the real token usage is known.
+        """
+        delta = actual_tokens - estimated_tokens
+        if not delta or self.tokens_per_minute is None:
+            return
+        _, tokens_key = self._keys(int(time.time() // SLOT_SECONDS))
+        try:
+            if delta > 0:
+                cache.incr(tokens_key, delta)
+            else:
+                cache.decr(tokens_key, -delta)
+        except Exception:
+            pass
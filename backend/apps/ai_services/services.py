@@ -1,7 +1,46 @@
+import json
+import logging
 import openai
 import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
 from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+from .classifier import get_classifier
+from .locks import acquire_lock, new_token, release_lock
+from .matcher import FALLBACK_CATEGORY, get_matcher
+from .metrics import metrics
 from .models import AICache
+from .ratelimit import RateLimiter
+from .normalizer import normalize_merchant
+
+logger = logging.getLogger(__name__)
+
+CATEGORY_CHOICES = [
+    ('Alimentação', 'food'),
+    ('Transporte', 'transport'),
+    ('Lazer', 'leisure'),
+    ('Saúde', 'health'),
+    ('Educação', 'education'),
+    ('Compras', 'shopping'),
+    ('Serviços', 'utilities'),
+    ('Outros', 'other'),
+]
+
+CATEGORY_NAMES = [name for name, _ in CATEGORY_CHOICES]
+
+# Number of transactions packed into a single chat completion
+BATCH_SIZE = 50
+
+# Shared by every worker so together they stay within the OpenAI account limits
+openai_rate_limiter = RateLimiter(
+    'openai',
+    requests_per_minute=settings.OPENAI_REQUESTS_PER_MINUTE,
+    tokens_per_minute=settings.OPENAI_TOKENS_PER_MINUTE,
+)
 
 class AIService:
     @staticmethod
@@ -9,31 +48,169 @@ class AIService:
         api_key = os.environ.get('OPENAI_API_KEY')
         if not api_key:
             return None
-        return openai.OpenAI(api_key=api_key)
+        # Retries are handled by create_completion so they go through the rate limiter
+        return openai.OpenAI(api_key=api_key, max_retries=0, timeout=settings.OPENAI_REQUEST_TIMEOUT)
 
     @staticmethod
-    def categorize_transaction(description, amount):
-        cache_key = f"categorize_{description}_{amount}"
+    def create_completion(client, **kwargs):
+        """
+        Call client.chat.completions.create within the shared rate limit,
+        retrying 429 responses with jittered exponential backoff.
+        """
+        prompt_length = sum(len(message['content']) for message in kwargs['messages'])
+        # Roughly four characters per token, plus the completion budget
+        estimated_tokens = prompt_length // 4 + kwargs.get('max_tokens', 0)
+
+        for attempt in range(settings.OPENAI_MAX_RETRIES + 1):
+            openai_rate_limiter.acquire(estimated_tokens)
+            try:
+                response = client.chat.completions.create(**kwargs)
+            except openai.RateLimitError as e:
+                # A 429 from OpenAI; 'rate_limiter' is for our own limiter's failures
+                metrics.record_error('llm')
+                if attempt == settings.OPENAI_MAX_RETRIES:
+                    raise
+                retry_after = None
+                try:
+                    retry_after = float(e.response.headers.get('retry-after'))
+                except (AttributeError, TypeError, ValueError):
+                    pass
+                backoff = random.uniform(0, settings.OPENAI_RETRY_BACKOFF * 2 ** attempt)
+                # Capped so AI_SINGLE_FLIGHT_LEASE bounds the whole call
+                time.sleep(min(max(retry_after or 0, backoff), settings.OPENAI_MAX_RETRY_WAIT))
+                continue
+
+            usage = getattr(response, 'usage', None)
+            metrics.record_tokens(usage)
+            if isinstance(getattr(usage, 'total_tokens', None), int):
+                openai_rate_limiter.adjust(estimated_tokens, usage.total_tokens)
+            return response
+
+    @staticmethod
+    def get_cache_key(description):
+        # Keyed on the merchant, not the raw description and amount, so every
+        # purchase at the same merchant shares one cached category
+        merchant_key = normalize_merchant(description).replace(' ', '_')
+        return f"categorize_{merchant_key}"
+
+    @staticmethod
+    def get_cached_category(cache_key):
+        return AIService.get_cached_categories([cache_key]).get(cache_key)
+
+    @staticmethod
+    def get_cached_categories(cache_keys):
+        """
+        Look ``cache_keys`` up in the shared cache, then the misses in the
+        AICache table, with one query each. Returns the categories found,
+        keyed by cache key.
+        """
+        started = time.perf_counter()
+        results = {}
         try:
-            cached_result = cache.get(cache_key)
-            if cached_result:
-                return cached_result
-        except Exception:
+            results = {cache_key: category for cache_key, category in cache.get_many(cache_keys).items() if category}
+            if results:
+                metrics.observe('redis_cache', time.perf_counter() - started, count=len(results))
+        except Exception as e:
             # Cache might not be available (e.g., Redis down)
-            pass
+            logger.warning('Redis cache read failed: %s', e)
+            metrics.record_error('redis_cache')
 
         # Check database cache
+        missing = [cache_key for cache_key in cache_keys if cache_key not in results]
+        if not missing:
+            return results
         try:
-            db_cache = AICache.objects.filter(key=cache_key).first()
-            if db_cache and not db_cache.is_expired():
-                return db_cache.value
-        except Exception:
+            found = [entry for entry in AICache.objects.filter(key__in=missing) if not entry.is_expired()]
+            if found:
+                AIService.touch_cached_categories(found)
+                results.update((entry.key, entry.value) for entry in found)
+                metrics.observe('db_cache', time.perf_counter() - started, count=len(found))
+        except Exception as e:
             # Database might not be available
-            pass
+            logger.warning('AICache read failed: %s', e)
+            metrics.record_error('db_cache')
+
+        return results
+
+    @staticmethod
+    def set_cached_category(cache_key, category):
+        # Cache in Redis and DB
+        AIService.publish_cached_category(cache_key, category)
+        AIService.store_cached_category(cache_key, category)
+
+    @staticmethod
+    def publish_cached_category(cache_key, category):
+        """
+        Write ``category`` to the shared cache, where single-flight waiters
+        look for it. Safe to call from worker threads.
+        """
+        try:
+            cache.set(cache_key, category, timeout=3600)  # 1 hour
+        except Exception as e:
+            logger.warning('Redis cache write failed for %s: %s', cache_key, e)
+            metrics.record_error('redis_cache')
+
+    @staticmethod
+    def store_cached_category(cache_key, category):
+        AIService.store_cached_categories({cache_key: category})
+
+    @staticmethod
+    def store_cached_categories(categories):
+        """
+        Upsert ``categories``, a mapping of cache key to category, into the
+        AICache table with a single bulk statement.
+        """
+        if not categories:
+            return
+        now = timezone.now()
+        try:
+            AICache.objects.bulk_create(
+                [
+                    AICache(key=cache_key, value=category, expires_at=now + settings.AI_CACHE_TTL, last_hit_at=now)
+                    for cache_key, category in categories.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['key'],
+                update_fields=['value', 'expires_at', 'last_hit_at'],
+            )
+        except Exception as e:
+            logger.warning('AICache write failed for %d keys: %s', len(categories), e)
+            metrics.record_error('db_cache')
+
+    @staticmethod
+    def touch_cached_categories(entries):
+        # Record the hits for LRU/LFU eviction, at most once per
+        # AI_CACHE_HIT_RESOLUTION so hot keys don't turn reads into writes
+        now = timezone.now()
+        stale = [entry.pk for entry in entries if now - entry.last_hit_at >= settings.AI_CACHE_HIT_RESOLUTION]
+        if stale:
+            AICache.objects.filter(pk__in=stale).update(last_hit_at=now, hit_count=F('hit_count') + 1)
+
+    @staticmethod
+    def categorize_transaction(description, amount):
+        started = time.perf_counter()
+        cache_key = AIService.get_cache_key(description)
+        cached_result = AIService.get_cached_category(cache_key)
+        if cached_result:
+            return cached_result
+
+        predicted = AIService.classify([description])[0]
+        if predicted:
+            metrics.observe('classifier', time.perf_counter() - started)
+            return predicted
 
         client = AIService.get_client()
         if not client:
-            return AIService.fallback_categorization(description)
+            return AIService.fallback_categorization(description, started)
+
+        # Only one caller per merchant asks the LLM; the others wait for its answer
+        token = AIService.acquire_flight(cache_key)
+        if not token:
+            waited = AIService.wait_for_flight([cache_key]).get(cache_key)
+            if waited:
+                metrics.observe('single_flight', time.perf_counter() - started)
+                return waited
+            return AIService.fallback_categorization(description, started)
 
         prompt = f"""
         Categorize the following financial transaction:
@@ -54,48 +231,326 @@ class AIService:
         """
 
         try:
-            response = client.chat.completions.create(
+            # A holder that finished after the cache read above has published by now
+            published = AIService.peek_cached_categories([cache_key]).get(cache_key)
+            if published:
+                metrics.observe('single_flight', time.perf_counter() - started)
+                return published
+
+            response = AIService.create_completion(
+                client,
                 model="gpt-4o-mini",
                 messages=[{"role": "user", "content": prompt}],
                 max_tokens=50,
                 temperature=0.1
             )
             category = response.choices[0].message.content.strip()
-
-            # Cache in Redis and DB
-            try:
-                cache.set(cache_key, category, timeout=3600)  # 1 hour
-            except Exception:
-                pass
-            try:
-                AICache.objects.update_or_create(
-                    key=cache_key,
-                    defaults={'value': category}
-                )
-            except Exception:
-                pass
-
+            AIService.set_cached_category(cache_key, category)
+            metrics.observe('llm', time.perf_counter() - started)
             return category
         except Exception as e:
             # Fallback to basic categorization
-            return AIService.fallback_categorization(description)
-
-    @staticmethod
-    def fallback_categorization(description):
-        desc_lower = description.lower()
-        if any(word in desc_lower for word in ['restaurante', 'mercado', 'supermercado', 'padaria', 'ifood']):
-            return 'Alimentação'
-        elif any(word in desc_lower for word in ['uber', 'taxi', 'onibus', 'metro', 'combustivel', 'posto']):
-            return 'Transporte'
-        elif any(word in desc_lower for word in ['cinema', 'teatro', 'show', 'bar', 'netflix', 'spotify']):
-            return 'Lazer'
-        elif any(word in desc_lower for word in ['farmacia', 'medico', 'hospital', 'clinica']):
-            return 'Saúde'
-        elif any(word in desc_lower for word in ['escola', 'universidade', 'curso', 'livro']):
-            return 'Educação'
-        elif any(word in desc_lower for word in ['shopping', 'loja', 'compras']):
-            return 'Compras'
-        elif any(word in desc_lower for word in ['luz', 'agua', 'gas', 'telefone', 'internet']):
-            return 'Serviços'
-        else:
-            return 'Outros'
+            logger.warning('LLM categorization failed for %r', description, exc_info=True)
+            metrics.record_error('llm')
+            return AIService.fallback_categorization(description, started)
+        finally:
+            AIService.release_flight(cache_key, token)
+
+    @staticmethod
+    def acquire_flight(cache_key):
+        """
+        Try to become the single caller computing ``cache_key``. The lock is a
+        cache key holding a token unique to this caller, with a lease
+        (AI_SINGLE_FLIGHT_LEASE) covering the worst-case LLM call, so a
+        crashed holder cannot block others forever. Returns the token to
+        pass to release_flight when the caller should compute the result,
+        otherwise None.
+        """
+        token = new_token()
+        try:
+            return acquire_lock(f'lock_{cache_key}', settings.AI_SINGLE_FLIGHT_LEASE, token)
+        except Exception as e:
+            # Cache might not be available (e.g., Redis down); compute anyway
+            logger.warning('Single-flight lock failed for %s: %s', cache_key, e)
+            metrics.record_error('single_flight')
+            return token
+
+    @staticmethod
+    def release_flight(cache_key, token):
+        """
+        Release the lock on ``cache_key`` if it still holds ``token``: a
+        holder that overran its lease must not free the next holder's lock.
+        """
+        try:
+            release_lock(f'lock_{cache_key}', token)
+        except Exception as e:
+            logger.warning('Single-flight release failed for %s: %s', cache_key, e)
+            metrics.record_error('single_flight')
+
+    @staticmethod
+    def peek_cached_categories(cache_keys):
+        """
+        Categories already published in the shared cache for ``cache_keys``.
+        Safe to call from worker threads: the database cache is not read.
+        """
+        if not cache_keys:
+            return {}
+        try:
+            return {cache_key: category for cache_key, category in cache.get_many(cache_keys).items() if category}
+        except Exception as e:
+            logger.warning('Redis cache read failed: %s', e)
+            metrics.record_error('redis_cache')
+            return {}
+
+    @staticmethod
+    def wait_for_flight(cache_keys, timeout=None):
+        """
+        Poll the cache until the callers holding ``cache_keys`` publish their
+        results, or ``timeout`` seconds pass. Returns the results found.
+        """
+        timeout = settings.AI_SINGLE_FLIGHT_WAIT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        pending = set(cache_keys)
+        results = {}
+        while pending:
+            try:
+                found = cache.get_many(list(pending))
+            except Exception as e:
+                logger.warning('Single-flight wait failed: %s', e)
+                metrics.record_error('single_flight')
+                break
+            for cache_key, category in found.items():
+                if category:
+                    results[cache_key] = category
+                    pending.discard(cache_key)
+            if not pending or time.monotonic() >= deadline:
+                break
+            time.sleep(settings.AI_SINGLE_FLIGHT_POLL_INTERVAL)
+        return results
+
+    @staticmethod
+    def categorize_batch(items):
+        """
+        Categorize a list of (description, amount) pairs. Returns the
+        category names in the same order as ``items``.
+        """
+        return [category for category, source in AIService.resolve_batch(items)]
+
+    @staticmethod
+    def resolve_batch(items):
+        """
+        Categorize a list of (description, amount) pairs.
+
+        Cached items are answered directly, then the local classifier answers
+        the merchants it is confident about; the remaining merchants are
+        packed BATCH_SIZE at a time into a single chat completion. Any item
+        the model does not answer with a valid category falls back to
+        fallback_categorization.
+
+        Returns (category name, source) pairs in the same order as
+        ``items``, the source being one of 'cache', 'classifier', 'llm',
+        'single_flight' or 'fallback'. Fallback answers are keyword guesses
+        made while no better answer was available, and are never cached.
+        """
+        started = time.perf_counter()
+        results = [None] * len(items)
+        sources = [None] * len(items)
+        # Items sharing a merchant are sent once and answered together
+        pending = {}
+        for index, (description, amount) in enumerate(items):
+            pending.setdefault(AIService.get_cache_key(description), []).append(index)
+        for cache_key, cached_result in AIService.get_cached_categories(list(pending)).items():
+            for index in pending.pop(cache_key):
+                results[index] = cached_result
+                sources[index] = 'cache'
+
+        if pending:
+            predictions = AIService.classify([items[indexes[0]][0] for indexes in pending.values()])
+            classified = 0
+            for (cache_key, indexes), predicted in zip(list(pending.items()), predictions):
+                if predicted:
+                    for index in indexes:
+                        results[index] = predicted
+                        sources[index] = 'classifier'
+                    classified += len(indexes)
+                    del pending[cache_key]
+            if classified:
+                metrics.observe('classifier', time.perf_counter() - started, count=classified)
+
+        client = AIService.get_client() if pending else None
+        contended_keys = []
+        if client:
+            batch = [(cache_key, items[indexes[0]]) for cache_key, indexes in pending.items()]
+            chunks = [batch[start:start + BATCH_SIZE] for start in range(0, len(batch), BATCH_SIZE)]
+            # Up to AI_MAX_CONCURRENT_REQUESTS completions in flight at once;
+            # database cache writes stay on this thread
+            with ThreadPoolExecutor(max_workers=min(settings.AI_MAX_CONCURRENT_REQUESTS, len(chunks))) as executor:
+                chunk_results = list(executor.map(lambda chunk: AIService.request_flight_batch(client, chunk), chunks))
+            answered = 0
+            reused = 0
+            AIService.store_cached_categories({
+                cache_key: category for answers, published, chunk_contended in chunk_results
+                for cache_key, category in answers.items()
+            })
+            for answers, published, chunk_contended in chunk_results:
+                contended_keys.extend(chunk_contended)
+                for cache_key, category in answers.items():
+                    for index in pending[cache_key]:
+                        results[index] = category
+                        sources[index] = 'llm'
+                    answered += len(pending[cache_key])
+                for cache_key, category in published.items():
+                    for index in pending[cache_key]:
+                        results[index] = category
+                        sources[index] = 'single_flight'
+                    reused += len(pending[cache_key])
+            if answered:
+                metrics.observe('llm', time.perf_counter() - started, count=answered)
+            if reused:
+                metrics.observe('single_flight', time.perf_counter() - started, count=reused)
+
+        contended = {cache_key: pending[cache_key] for cache_key in contended_keys}
+        if contended:
+            waited = 0
+            for cache_key, category in AIService.wait_for_flight(list(contended)).items():
+                for index in contended[cache_key]:
+                    results[index] = category
+                    sources[index] = 'single_flight'
+                waited += len(contended[cache_key])
+            if waited:
+                metrics.observe('single_flight', time.perf_counter() - started, count=waited)
+
+        missing = [index for index, result in enumerate(results) if result is None]
+        if missing:
+            fallbacks = get_matcher().match_many([items[index][0] for index in missing])
+            for index, category in zip(missing, fallbacks):
+                results[index] = category or FALLBACK_CATEGORY
+                sources[index] = 'fallback'
+            metrics.observe('fallback', time.perf_counter() - started, count=len(missing))
+        return list(zip(results, sources))
+
+    @staticmethod
+    def classify(descriptions):
+        """
+        Run the local classifier over ``descriptions``. Returns the predicted
+        category for each one, or None where there is no trained model or its
+        confidence is below AI_CLASSIFIER_THRESHOLD.
+        """
+        classifier = get_classifier()
+        if classifier is None:
+            return [None] * len(descriptions)
+        return [
+            category if confidence >= settings.AI_CLASSIFIER_THRESHOLD else None
+            for category, confidence in classifier.predict_batch(descriptions)
+        ]
+
+    @staticmethod
+    def request_flight_batch(client, batch):
+        """
+        Ask the LLM about ``batch``, a list of (cache key, (description,
+        amount)), holding each merchant's single-flight lock only for this
+        request. Runs on a worker thread.
+
+        Returns (answers, published, contended): the categories answered by
+        the LLM (already in the shared cache), those another worker
+        published in the meantime, and the keys another worker still holds.
+        """
+        tokens = {}
+        contended = []
+        for cache_key, item in batch:
+            token = AIService.acquire_flight(cache_key)
+            if token:
+                tokens[cache_key] = token
+            else:
+                contended.append(cache_key)
+        answers = {}
+        try:
+            # A holder that finished after our first cache read has published by now
+            published = AIService.peek_cached_categories(list(tokens))
+            asked = [(cache_key, item) for cache_key, item in batch if cache_key in tokens and cache_key not in published]
+            if asked:
+                positions = AIService.request_batch(client, [item for _, item in asked])
+                for position, (cache_key, item) in enumerate(asked):
+                    category = positions.get(position)
+                    if category:
+                        AIService.publish_cached_category(cache_key, category)
+                        answers[cache_key] = category
+        finally:
+            for cache_key, token in tokens.items():
+                AIService.release_flight(cache_key, token)
+        return answers, published, contended
+
+    @staticmethod
+    def request_batch(client, items):
+        """
+        Send one chat completion for ``items`` and return a dict mapping the
+        item position to its category. Positions missing from the answer, or
+        answered with an unknown category, are left out of the dict.
+        """
+        lines = '\n'.join(
+            f'        {position}. Description: {description} | Amount: {amount}'
+            for position, (description, amount) in enumerate(items)
+        )
+        options = '\n'.join(f'        - {name} ({hint})' for name, hint in CATEGORY_CHOICES)
+        prompt = f"""
+        Categorize each of the following financial transactions:
+{lines}
+
+        Use only these category names in Portuguese:
+{options}
+
+        Be precise and consider common Brazilian spending patterns.
+        Answer with a JSON object in the form
+        {{"results": [{{"index": 0, "category": "Alimentação"}}, ...]}}
+        with one entry per transaction.
+        """
+
+        try:
+            response = AIService.create_completion(
+                client,
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=20 * len(items) + 50,
+                temperature=0.1,
+                response_format={"type": "json_object"},
+            )
+        except Exception:
+            logger.warning('LLM batch categorization failed for %d items', len(items), exc_info=True)
+            metrics.record_error('llm')
+            return {}
+
+        answers = AIService.parse_batch_response(response.choices[0].message.content, len(items))
+        if len(answers) < len(items):
+            logger.warning('LLM batch answer covered %d of %d items', len(answers), len(items))
+            metrics.record_error('llm')
+        return answers
+
+    @staticmethod
+    def parse_batch_response(content, size):
+        try:
+            payload = json.loads(content)
+        except (TypeError, ValueError):
+            return {}
+
+        entries = payload.get('results', []) if isinstance(payload, dict) else payload
+        if not isinstance(entries, list):
+            return {}
+
+        answers = {}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            index = entry.get('index')
+            category = entry.get('category')
+            if isinstance(category, str):
+                category = category.strip()
+            if isinstance(index, int) and 0 <= index < size and category in CATEGORY_NAMES:
+                answers[index] = category
+        return answers
+
+    @staticmethod
+    def fallback_categorization(description, started=None):
+        category = get_matcher().match(description) or FALLBACK_CATEGORY
+        if started is not None:
+            metrics.observe('fallback', time.perf_counter() - started)
+        return category
@@ -0,0 +1,9 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from apps.categories.models import Category
+from .matcher import invalidate_matcher
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def rebuild_keyword_matcher(sender, **kwargs):
+    invalidate_matcher()
@@ -1,36 +1,317 @@
-from celery import shared_task
+import logging
+from collections import defaultdict
+from celery import chord, shared_task
+from celery.exceptions import Ignore
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction as db_transaction
+from django.utils import timezone
+from .metrics import metrics
+from .models import AICache
+from .normalizer import normalize_merchant
 from .services import AIService
-from apps.transactions.models import Transaction
+from apps.transactions.models import Merchant, Transaction, TransactionCounter, month_of
+from apps.transactions.versioning import bump_data_version
 from apps.categories.models import Category
 from apps.banking.models import BankAccount
 
-@shared_task
-def categorize_user_transactions(user_id):
+logger = logging.getLogger(__name__)
+
+def load_categories():
     """
-    Background task to categorize all uncategorized transactions for a user
+    Load every category once, keyed by name, for the categorization pipeline.
+    """
+    return {category.name: category for category in Category.objects.all()}
+
+def get_category(categories, name):
+    category = categories.get(name)
+    if category is None:
+        category, created = Category.objects.get_or_create(
+            name=name,
+            defaults={'icon': 'default', 'color': '#000000', 'keywords': ''}
+        )
+        categories[name] = category
+    return category
+
+def categorize_rows(transactions, categories):
     """
+    Categorize a chunk of uncategorized Transaction rows per merchant and
+    write them back with a single bulk_update. Rows another task holds or
+    has categorized since the chunk was loaded are left alone. Returns the
+    number of rows categorized.
+    """
+    # Attach a merchant to rows ingested before merchants existed
+    unlinked = [transaction for transaction in transactions if transaction.merchant_id is None]
+    if unlinked:
+        merchants = Merchant.objects.for_descriptions(transaction.description for transaction in unlinked)
+        for transaction in unlinked:
+            transaction.merchant = merchants[normalize_merchant(transaction.description)]
+
+    # Categorize each distinct merchant once, using its first transaction as sample
+    pending_merchants = {}
+    for transaction in transactions:
+        if transaction.merchant.category_id is None:
+            pending_merchants.setdefault(transaction.merchant.key, transaction)
+
+    samples = list(pending_merchants.values())
+    answers = AIService.resolve_batch([
+        (transaction.description, transaction.amount) for transaction in samples
+    ]) if samples else []
+
+    with db_transaction.atomic():
+        # Counter moves assume the rows are still uncategorized, so claim
+        # them first; overlapping tasks on the same backlog skip each other's
+        claimed = set(Transaction.objects.select_for_update(skip_locked=True).filter(
+            id__in=[transaction.id for transaction in transactions],
+            category__isnull=True,
+        ).values_list('id', flat=True))
+        transactions = [transaction for transaction in transactions if transaction.id in claimed]
+
+        updated_merchants = []
+        # Keyword guesses made while the LLM was unavailable go on this
+        # chunk's rows only; the merchant stays uncategorized so it is asked again
+        provisional = {}
+        for transaction, (category_name, source) in zip(samples, answers):
+            merchant = transaction.merchant
+            if source == 'fallback':
+                provisional[merchant.key] = get_category(categories, category_name)
+                continue
+            merchant.category = get_category(categories, category_name)
+            merchant.updated_at = timezone.now()
+            updated_merchants.append(merchant)
+        Merchant.objects.bulk_update(updated_merchants, ['category', 'updated_at'])
+
+        now = timezone.now()
+        counts = defaultdict(int)
+        for transaction in transactions:
+            # Rows loaded with select_related each hold their own Merchant copy
+            transaction.merchant = pending_merchants.get(transaction.merchant.key, transaction).merchant
+            category = provisional.get(transaction.merchant.key)
+            category_id = category.id if category else transaction.merchant.category_id
+            if transaction.category_id != category_id:
+                month = month_of(transaction.date)
+                counts[(transaction.account_id, transaction.category_id, month)] -= 1
+                counts[(transaction.account_id, category_id, month)] += 1
+            transaction.category_id = category_id
+            transaction.is_processed = True
+            transaction.updated_at = now
+        Transaction.objects.bulk_update(transactions, ['category', 'merchant', 'is_processed', 'updated_at'])
+        TransactionCounter.objects.add(counts)
+        bump_data_version(*BankAccount.objects.filter(
+            id__in={transaction.account_id for transaction in transactions}
+        ).values_list('user_id', flat=True).distinct())
+
+    return len(transactions)
+
+def get_uncategorized_transactions(user_id):
     user_accounts = BankAccount.objects.filter(user_id=user_id, is_active=True)
-    uncategorized_transactions = Transaction.objects.filter(
+    return Transaction.objects.filter(
         account__in=user_accounts,
         category__isnull=True
-    )
+    ).select_related('merchant').order_by('id')
 
+def categorize_queryset(transactions):
+    """
+    Categorize ``transactions`` in id-ordered keyset chunks of
+    AI_CATEGORIZATION_CHUNK_SIZE, writing each chunk back with bulk_update,
+    so memory stays flat and the query count grows with the number of
+    chunks, not rows. Returns the number of rows categorized.
+    """
+    categories = load_categories()
     categorized_count = 0
-    for transaction in uncategorized_transactions:
-        category_name = AIService.categorize_transaction(
-            transaction.description,
-            transaction.amount
-        )
+    last_id = 0
+    while True:
+        chunk = list(transactions.filter(id__gt=last_id)[:settings.AI_CATEGORIZATION_CHUNK_SIZE])
+        if not chunk:
+            break
+        categorized_count += categorize_rows(chunk, categories)
+        last_id = chunk[-1].id
+    metrics.flush()
+    return categorized_count
 
-        # Get or create category
-        category, created = Category.objects.get_or_create(
-            name=category_name,
-            defaults={'icon': 'default', 'color': '#000000', 'keywords': ''}
+def split_id_ranges(transactions, size):
+    """
+    Split ``transactions`` into consecutive (first id, last id) ranges of
+    ``size`` rows. Each boundary costs one indexed query; no rows are loaded.
+    """
+    ids = transactions.values_list('id', flat=True)
+    ranges = []
+    first_id = ids.first()
+    while first_id is not None:
+        remaining = ids.filter(id__gte=first_id)
+        last_id = remaining[size - 1:size].first()
+        if last_id is None:
+            ranges.append((first_id, remaining.last()))
+            break
+        ranges.append((first_id, last_id))
+        first_id = ids.filter(id__gt=last_id).first()
+    return ranges
+
+def progress_cache_key(task_id):
+    return f'categorize_progress_{task_id}'
+
+@shared_task(bind=True)
+def categorize_user_transactions(self, user_id):
+    """
+    Background task to categorize all uncategorized transactions for a user
+
+    Backlogs larger than AI_CATEGORIZATION_FANOUT_SIZE are split into id
+    ranges and dispatched as a chord of categorize_transaction_range tasks,
+    so any number of workers share the work. While the chord runs this
+    task's state is PROGRESS with {'done', 'total'} in its meta; the chord
+    callback marks it SUCCESS with the final summary, or its errback
+    FAILURE if any range fails.
+    """
+    transactions = get_uncategorized_transactions(user_id)
+    ranges = split_id_ranges(transactions, settings.AI_CATEGORIZATION_FANOUT_SIZE)
+
+    # Small backlogs, and direct calls outside a worker, run inline
+    if len(ranges) <= 1 or not self.request.id or self.request.is_eager:
+        categorized_count = categorize_queryset(transactions)
+        return f'Categorized {categorized_count} transactions for user {user_id}'
+
+    task_id = self.request.id
+    total = transactions.count()
+    cache.set(progress_cache_key(task_id), 0, timeout=settings.AI_CATEGORIZATION_PROGRESS_TTL)
+    self.update_state(state='PROGRESS', meta={'done': 0, 'total': total})
+
+    chord(
+        categorize_transaction_range.s(user_id, first_id, last_id, task_id, total)
+        for first_id, last_id in ranges
+    )(finish_user_categorization.s(user_id, task_id).on_error(fail_user_categorization.s(user_id, task_id)))
+
+    # Keep the PROGRESS state; finish_user_categorization stores the result
+    raise Ignore()
+
+@shared_task
+def categorize_transaction_range(user_id, first_id, last_id, parent_id=None, total=None):
+    """
+    Categorize the user's uncategorized transactions with ids in
+    [first_id, last_id] and report progress to the parent task.
+    """
+    transactions = get_uncategorized_transactions(user_id).filter(id__gte=first_id, id__lte=last_id)
+    categorized_count = categorize_queryset(transactions)
+
+    if parent_id:
+        try:
+            done = cache.incr(progress_cache_key(parent_id), categorized_count)
+        except Exception:
+            # Progress is best effort (e.g., Redis down or key expired)
+            done = None
+        if done is not None:
+            categorize_user_transactions.backend.store_result(
+                parent_id, {'done': done, 'total': total}, 'PROGRESS'
+            )
+    return categorized_count
+
+@shared_task
+def finish_user_categorization(counts, user_id, parent_id):
+    """
+    Chord callback: aggregate the per-range counts and mark the parent
+    categorize_user_transactions task as done.
+    """
+    categorized_count = sum(counts)
+    result = f'Categorized {categorized_count} transactions for user {user_id}'
+    categorize_user_transactions.backend.mark_as_done(parent_id, result)
+    try:
+        cache.delete(progress_cache_key(parent_id))
+    except Exception:
+        pass
+    return result
+
+@shared_task
+def fail_user_categorization(request, exc, traceback, user_id, parent_id):
+    """
+    Chord errback: a range task failed, so the callback will never run.
+    Mark the parent categorize_user_transactions task as failed so status
+    polling ends.
+    """
+    logger.warning('Categorization for user %s failed: %s', user_id, exc)
+    categorize_user_transactions.backend.mark_as_failure(parent_id, exc, traceback=traceback)
+    try:
+        cache.delete(progress_cache_key(parent_id))
+    except Exception:
+        pass
+
+@shared_task
+def categorize_new_transactions(transaction_ids):
+    """
+    Categorize exactly the given transactions, as enqueued right after ingest.
+    """
+    transactions = Transaction.objects.filter(
+        id__in=transaction_ids,
+        category__isnull=True
+    ).select_related('merchant').order_by('id')
+    categorized_count = categorize_queryset(transactions)
+    return f'Categorized {categorized_count} new transactions'
+
+def enqueue_categorization(transaction_ids):
+    """
+    Enqueue categorize_new_transactions for ``transaction_ids`` once the
+    current database transaction commits.
+    """
+    transaction_ids = list(transaction_ids)
+    if not transaction_ids:
+        return
+
+    def enqueue():
+        try:
+            categorize_new_transactions.delay(transaction_ids)
+        except Exception:
+            # Broker might not be available; categorize_stragglers picks these up
+            pass
+
+    db_transaction.on_commit(enqueue)
+
+@shared_task
+def categorize_stragglers():
+    """
+    Periodic task that picks up transactions whose categorize-on-ingest task
+    never ran (e.g. the broker was down), using the partial index on
+    unprocessed rows. Work is enqueued in chunks of AI_CATEGORIZATION_CHUNK_SIZE.
+    """
+    cutoff = timezone.now() - settings.AI_CATEGORIZATION_STRAGGLER_DELAY
+    straggler_ids = Transaction.objects.filter(
+        is_processed=False,
+        created_at__lt=cutoff
+    ).order_by('created_at').values_list('id', flat=True)[:settings.AI_CATEGORIZATION_STRAGGLER_LIMIT]
+
+    straggler_ids = list(straggler_ids)
+    chunk_size = settings.AI_CATEGORIZATION_CHUNK_SIZE
+    for start in range(0, len(straggler_ids), chunk_size):
+        categorize_new_transactions.delay(straggler_ids[start:start + chunk_size])
+    return f'Enqueued {len(straggler_ids)} uncategorized transactions'
+
+@shared_task
+def sweep_ai_cache(batch_size=None):
+    """
+    Periodic task that deletes expired AICache rows, then evicts the least
+    recently hit rows above AI_CACHE_MAX_ENTRIES. Deletes run in batches of
+    AI_CACHE_SWEEP_BATCH_SIZE so no single statement holds long locks.
+    """
+    batch_size = batch_size or settings.AI_CACHE_SWEEP_BATCH_SIZE
+
+    expired_count = 0
+    while True:
+        expired_ids = list(
+            AICache.objects.filter(expires_at__lte=timezone.now())
+            .values_list('id', flat=True)[:batch_size]
         )
+        if not expired_ids:
+            break
+        expired_count += AICache.objects.filter(id__in=expired_ids).delete()[0]
 
-        transaction.category = category
-        transaction.is_processed = True
-        transaction.save()
-        categorized_count += 1
+    evicted_count = 0
+    excess = AICache.objects.count() - settings.AI_CACHE_MAX_ENTRIES
+    while excess > 0:
+        lru_ids = list(
+            AICache.objects.order_by('last_hit_at', 'hit_count')
+            .values_list('id', flat=True)[:min(batch_size, excess)]
+        )
+        if not lru_ids:
+            break
+        deleted = AICache.objects.filter(id__in=lru_ids).delete()[0]
+        evicted_count += deleted
+        excess -= deleted
 
-    return f'Categorized {categorized_count} transactions for user {user_id}'
+    return f'Swept {expired_count} expired and {evicted_count} evicted AI cache entries'
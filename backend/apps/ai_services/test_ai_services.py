@@ -1,7 +1,41 @@
-from django.test import TestCase
-from unittest.mock import patch, MagicMock
-from apps.ai_services.services import AIService
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import timedelta
+from unittest.mock import patch, MagicMock, PropertyMock
+from apps.ai_services.normalizer import normalize_merchant
+from apps.ai_services.services import AIService, BATCH_SIZE
+from apps.ai_services.fakes import FakeOpenAIClient, generate_transactions
+from apps.ai_services.classifier import NaiveBayesClassifier, get_classifier, reset_classifier
+from apps.ai_services.matcher import KeywordMatcher, get_matcher, invalidate_matcher
+from apps.ai_services.metrics import metrics, to_prometheus
+from apps.ai_services.models import AICache
+from apps.ai_services.ratelimit import RateLimiter
+from apps.ai_services.tasks import (
+    categorize_new_transactions, categorize_stragglers, categorize_transaction_range, categorize_user_transactions,
+    fail_user_categorization, finish_user_categorization, get_uncategorized_transactions, progress_cache_key, split_id_ranges, sweep_ai_cache,
+)
+from celery import signature
+from celery.app.task import Context
+from celery.exceptions import Ignore
+from celery.utils.functional import arity_greater
+from apps.banking.models import BankAccount
+from apps.categories.models import Category
+from apps.transactions.models import Merchant, Transaction
+import httpx
+import io
+import json
+import openai
 import os
+import tempfile
+import threading
+import time
+
+User = get_user_model()
 
 class AIServiceTests(TestCase):
 
@@ -71,3 +105,1019 @@ class AIServiceTests(TestCase):
         self.assertEqual(AIService.fallback_categorization('loja de roupas'), 'Compras')
         self.assertEqual(AIService.fallback_categorization('conta de luz'), 'Serviços')
         self.assertEqual(AIService.fallback_categorization('alguma outra coisa'), 'Outros')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AIServiceBatchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_categorize_batch_single_request(self):
+        """
+        Ensure a batch of transactions is categorized with a single completion.
+        """
+        client = FakeOpenAIClient(lambda descriptions: json.dumps({
+            'results': [{'index': i, 'category': 'Transporte'} for i in range(len(descriptions))]
+        }))
+        items = [(f'Taxi {name}', -20 - i) for i, name in enumerate('ABCDEFGHIJ')]
+
+        with patch.object(AIService, 'get_client', return_value=client):
+            categories = AIService.categorize_batch(items)
+
+        self.assertEqual(categories, ['Transporte'] * 10)
+        self.assertEqual(len(client.calls), 1)
+
+    def test_categorize_batch_splits_into_chunks(self):
+        """
+        Ensure large batches are split into BATCH_SIZE chunks.
+        """
+        client = FakeOpenAIClient(lambda descriptions: json.dumps({
+            'results': [{'index': i, 'category': 'Compras'} for i in range(len(descriptions))]
+        }))
+        items = [(f'Loja {i:03d} {"X" * (i + 1)}', -10) for i in range(BATCH_SIZE + 5)]
+
+        with patch.object(AIService, 'get_client', return_value=client):
+            categories = AIService.categorize_batch(items)
+
+        self.assertEqual(len(categories), BATCH_SIZE + 5)
+        self.assertEqual(len(client.calls), 2)
+
+    def test_categorize_batch_per_item_fallback(self):
+        """
+        Ensure items missing or invalid in the answer fall back individually.
+        """
+        client = FakeOpenAIClient(lambda descriptions: json.dumps({
+            'results': [
+                {'index': 0, 'category': 'Lazer'},
+                {'index': 1, 'category': 'Not a category'},
+            ]
+        }))
+        items = [('Netflix', -39.90), ('Farmacia Sao Joao', -25.00), ('Padaria', -8.00)]
+
+        with patch.object(AIService, 'get_client', return_value=client):
+            categories = AIService.categorize_batch(items)
+
+        self.assertEqual(categories, ['Lazer', 'Saúde', 'Alimentação'])
+
+    def test_categorize_batch_unparseable_response(self):
+        """
+        Ensure an unparseable answer falls back for every item.
+        """
+        client = FakeOpenAIClient(lambda descriptions: 'not json')
+
+        with patch.object(AIService, 'get_client', return_value=client):
+            categories = AIService.categorize_batch([('Uber', -15.00), ('Cinema', -30.00)])
+
+        self.assertEqual(categories, ['Transporte', 'Lazer'])
+
+    def test_categorize_batch_uses_cache(self):
+        """
+        Ensure cached items are not sent to the model again.
+        """
+        client = FakeOpenAIClient(lambda descriptions: json.dumps({
+            'results': [{'index': i, 'category': 'Alimentação'} for i in range(len(descriptions))]
+        }))
+        items = [('iFood', -50.00)]
+
+        with patch.object(AIService, 'get_client', return_value=client):
+            AIService.categorize_batch(items)
+            categories = AIService.categorize_batch(items)
+
+        self.assertEqual(categories, ['Alimentação'])
+        self.assertEqual(len(client.calls), 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CategorizeUserTransactionsTaskTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='task@example.com', password='password123')
+        self.account = BankAccount.objects.create(
+            user=self.user,
+            pluggy_account_id='task_account_id',
+            bank_name='Test Bank',
+            account_type='CHECKING',
+            balance=1000.00
+        )
+        for i in range(5):
+            Transaction.objects.create(
+                account=self.account,
+                pluggy_transaction_id=f'task_tx_{i}',
+                amount=-10 - i,
+                description=f'Uber trip {i}',
+                date=timezone.now()
+            )
+
+    def test_task_categorizes_in_one_request(self):
+        """
+        Ensure the task categorizes the whole backlog through the batch API.
+        """
+        client = FakeOpenAIClient(lambda descriptions: json.dumps({
+            'results': [{'index': i, 'category': 'Transporte'} for i in range(len(descriptions))]
+        }))
+
+        with patch.object(AIService, 'get_client', return_value=client):
+            categorize_user_transactions(self.user.id)
+
+        self.assertEqual(len(client.calls), 1)
+        self.assertFalse(Transaction.objects.filter(category__isnull=True).exists())
+        self.assertEqual(
+            set(Transaction.objects.values_list('category__name', flat=True)),
+            {'Transporte'}
+        )
+
+    def test_task_categorizes_each_merchant_once(self):
+        """
+        Ensure a merchant categorized for one user is reused for another.
+        """
+        client = FakeOpenAIClient(lambda descriptions: json.dumps({
+            'results': [{'index': i, 'category': 'Transporte'} for i in range(len(descriptions))]
+        }))
+        other_user = User.objects.create_user(email='other@example.com', password='password123')
+        other_account = BankAccount.objects.create(
+            user=other_user,
+            pluggy_account_id='other_account_id',
+            bank_name='Test Bank',
+            account_type='CHECKING',
+            balance=0
+        )
+        Transaction.objects.create(
+            account=other_account,
+            pluggy_transaction_id='other_tx',
+            amount=-22,
+            description='UBER TRIP 14/03 FINAL 1234',
+            date=timezone.now()
+        )
+
+        with patch.object(AIService, 'get_client', return_value=client):
+            categorize_user_transactions(self.user.id)
+            categorize_user_transactions(other_user.id)
+
+        self.assertEqual(len(client.calls), 1)
+        self.assertEqual(Merchant.objects.count(), 1)
+        self.assertEqual(Transaction.objects.get(pluggy_transaction_id='other_tx').category.name, 'Transporte')
+
+    def _create_backlog(self, email, size):
+        user = User.objects.create_user(email=email, password='password123')
+        account = BankAccount.objects.create(
+            user=user, pluggy_account_id=f'{email}_account', bank_name='Test Bank',
+            account_type='CHECKING', balance=0
+        )
+        Transaction.objects.bulk_create([
+            Transaction(
+                account=account, pluggy_transaction_id=f'{email}_{i}', amount=-10,
+                description=f'{["UBER TRIP", "NETFLIX", "PADARIA"][i % 3]} {i:04d}', date=timezone.now()
+            )
+            for i in range(size)
+        ])
+        return user
+
+    def test_fallback_answers_leave_merchant_uncategorized(self):
+        """
+        Ensure a keyword fallback categorizes the rows but not the merchant, which is asked again later.
+        """
+        client = FakeOpenAIClient(error_rate=1.0)
+        with patch.object(AIService, 'get_client', return_value=client):
+            categorize_user_transactions(self.user.id)
+
+        self.assertFalse(Transaction.objects.filter(category__isnull=True).exists())
+        merchant = Transaction.objects.select_related('merchant').first().merchant
+        self.assertIsNone(merchant.category_id)
+
+        Transaction.objects.create(
+            account=self.account, pluggy_transaction_id='task_tx_later', amount=-12,
+            description='Uber trip 9', date=timezone.now()
+        )
+        client = FakeOpenAIClient(lambda descriptions: ['Lazer'] * len(descriptions))
+        with patch.object(AIService, 'get_client', return_value=client):
+            categorize_user_transactions(self.user.id)
+
+        self.assertEqual(len(client.calls), 1)
+        merchant.refresh_from_db()
+        self.assertEqual(merchant.category.name, 'Lazer')
+
+    @override_settings(AI_CATEGORIZATION_CHUNK_SIZE=100)
+    def test_task_query_count_does_not_grow_with_rows(self):
+        """
+        Ensure a chunk costs the same number of queries whatever its size.
+        """
+        small = self._create_backlog('small@example.com', 10)
+        large = self._create_backlog('large@example.com', 90)
+        with patch.object(AIService, 'get_client', return_value=FakeOpenAIClient()):
+            # Warm up merchants and categories so both runs take the same path
+            categorize_user_transactions(self.user.id)
+            categorize_user_transactions(self._create_backlog('warm@example.com', 3).id)
+
+            with CaptureQueriesContext(connection) as small_queries:
+                categorize_user_transactions(small.id)
+            with CaptureQueriesContext(connection) as large_queries:
+                categorize_user_transactions(large.id)
+
+        self.assertEqual(len(small_queries), len(large_queries))
+        self.assertEqual(Transaction.objects.filter(category__isnull=True).count(), 0)
+
+    @override_settings(AI_CATEGORIZATION_CHUNK_SIZE=4)
+    def test_task_processes_backlog_in_chunks(self):
+        """
+        Ensure backlogs larger than one chunk are fully categorized.
+        """
+        user = self._create_backlog('chunks@example.com', 10)
+
+        result = categorize_user_transactions(user.id)
+
+        self.assertEqual(result, f'Categorized 10 transactions for user {user.id}')
+        self.assertFalse(Transaction.objects.filter(account__user=user, is_processed=False).exists())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CategorizationFanOutTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(email='fanout@example.com', password='password123')
+        account = BankAccount.objects.create(
+            user=self.user, pluggy_account_id='fanout_account', bank_name='Test Bank',
+            account_type='CHECKING', balance=0
+        )
+        Transaction.objects.bulk_create([
+            Transaction(
+                account=account, pluggy_transaction_id=f'fanout_{i}', amount=-10,
+                description='UBER TRIP', date=timezone.now()
+            )
+            for i in range(10)
+        ])
+        self.ids = list(Transaction.objects.order_by('id').values_list('id', flat=True))
+
+    def test_split_id_ranges(self):
+        """
+        Ensure the backlog is split into consecutive id ranges.
+        """
+        ranges = split_id_ranges(get_uncategorized_transactions(self.user.id), 4)
+        self.assertEqual(ranges, [
+            (self.ids[0], self.ids[3]),
+            (self.ids[4], self.ids[7]),
+            (self.ids[8], self.ids[9]),
+        ])
+
+    @override_settings(AI_CATEGORIZATION_FANOUT_SIZE=4)
+    @patch('apps.ai_services.tasks.chord')
+    def test_large_backlog_is_dispatched_as_chord(self, mock_chord):
+        """
+        Ensure large backlogs fan out one subtask per id range and report progress.
+        """
+        categorize_user_transactions.push_request(id='parent-task', is_eager=False)
+        try:
+            with patch.object(categorize_user_transactions, 'update_state') as mock_update_state:
+                with self.assertRaises(Ignore):
+                    categorize_user_transactions.run(self.user.id)
+        finally:
+            categorize_user_transactions.pop_request()
+
+        signatures = list(mock_chord.call_args[0][0])
+        self.assertEqual(len(signatures), 3)
+        self.assertEqual(signatures[0].args, (self.user.id, self.ids[0], self.ids[3], 'parent-task', 10))
+        mock_update_state.assert_called_once_with(state='PROGRESS', meta={'done': 0, 'total': 10})
+        self.assertTrue(Transaction.objects.filter(category__isnull=True).exists())
+
+    @override_settings(AI_CATEGORIZATION_FANOUT_SIZE=4)
+    @patch.object(type(categorize_user_transactions._get_current_object()), 'backend', new_callable=PropertyMock)
+    @patch('apps.ai_services.tasks.chord')
+    def test_failed_range_fails_parent(self, mock_chord, mock_backend_property):
+        """
+        Ensure a failing range task marks the parent FAILURE instead of leaving it in PROGRESS.
+        """
+        categorize_user_transactions.push_request(id='parent-task', is_eager=False)
+        try:
+            with patch.object(categorize_user_transactions, 'update_state'):
+                with self.assertRaises(Ignore):
+                    categorize_user_transactions.run(self.user.id)
+        finally:
+            categorize_user_transactions.pop_request()
+
+        callback = mock_chord.return_value.call_args[0][0]
+        errbacks = callback.options['link_error']
+        self.assertEqual([errback.task for errback in errbacks], [fail_user_categorization.name])
+        self.assertTrue(arity_greater(fail_user_categorization.__header__, 1))
+
+        # What Celery does with the callback's errbacks when a header task fails
+        error = RuntimeError('range failed')
+        signature(errbacks[0])(Context(id=None), error, None)
+
+        mock_backend_property.return_value.mark_as_failure.assert_called_once_with('parent-task', error, traceback=None)
+        self.assertIsNone(cache.get(progress_cache_key('parent-task')))
+
+    @patch.object(type(categorize_user_transactions._get_current_object()), 'backend', new_callable=PropertyMock)
+    def test_range_task_reports_progress(self, mock_backend_property):
+        """
+        Ensure each range subtask categorizes its rows and updates the parent meta.
+        """
+        mock_backend = mock_backend_property.return_value
+        cache.set(progress_cache_key('parent-task'), 0)
+
+        count = categorize_transaction_range(self.user.id, self.ids[0], self.ids[3], 'parent-task', 10)
+
+        self.assertEqual(count, 4)
+        self.assertEqual(Transaction.objects.filter(category__isnull=True).count(), 6)
+        mock_backend.store_result.assert_called_once_with('parent-task', {'done': 4, 'total': 10}, 'PROGRESS')
+
+    @patch.object(type(categorize_user_transactions._get_current_object()), 'backend', new_callable=PropertyMock)
+    def test_chord_callback_aggregates_counts(self, mock_backend_property):
+        """
+        Ensure the chord callback sums the subtask counts into the parent result.
+        """
+        mock_backend = mock_backend_property.return_value
+        result = finish_user_categorization([4, 4, 2], self.user.id, 'parent-task')
+
+        self.assertEqual(result, f'Categorized 10 transactions for user {self.user.id}')
+        mock_backend.mark_as_done.assert_called_once_with('parent-task', result)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class IncrementalCategorizationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create_user(email='ingest@example.com', password='password123')
+        account = BankAccount.objects.create(
+            user=user, pluggy_account_id='ingest_account', bank_name='Test Bank',
+            account_type='CHECKING', balance=0
+        )
+        Transaction.objects.bulk_create([
+            Transaction(
+                account=account, pluggy_transaction_id=f'ingest_{i}', amount=-10,
+                description='NETFLIX', date=timezone.now()
+            )
+            for i in range(4)
+        ])
+        self.ids = list(Transaction.objects.order_by('id').values_list('id', flat=True))
+
+    def test_categorize_new_transactions_only_touches_given_ids(self):
+        """
+        Ensure only the enqueued ids are categorized.
+        """
+        categorize_new_transactions(self.ids[:2])
+
+        self.assertEqual(
+            list(Transaction.objects.filter(is_processed=True).order_by('id').values_list('id', flat=True)),
+            self.ids[:2]
+        )
+
+    @patch('apps.ai_services.tasks.categorize_new_transactions')
+    def test_stragglers_are_enqueued(self, mock_task):
+        """
+        Ensure the sweeper enqueues old unprocessed rows and skips fresh ones.
+        """
+        Transaction.objects.filter(id__in=self.ids[:3]).update(created_at=timezone.now() - timedelta(hours=1))
+
+        categorize_stragglers()
+
+        mock_task.delay.assert_called_once_with(self.ids[:3])
+
+
+class MerchantNormalizerTests(TestCase):
+
+    def test_normalize_merchant(self):
+        """
+        Ensure dates, installments, card suffixes and boilerplate are dropped.
+        """
+        self.assertEqual(normalize_merchant('IFOOD *RESTAURANTE PARC 02/10'), 'IFOOD RESTAURANTE')
+        self.assertEqual(normalize_merchant('Ifood *Restaurante 12/03'), 'IFOOD RESTAURANTE')
+        self.assertEqual(normalize_merchant('COMPRA CARTAO Padaria São João FINAL 5678'), 'PADARIA SAO JOAO')
+        self.assertEqual(normalize_merchant('Açaí do Zé ****4455'), 'ACAI DO ZE')
+        self.assertEqual(normalize_merchant('PIX ENVIADO'), 'PIX ENVIADO')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AICacheEvictionTests(TestCase):
+
+    def test_set_cached_category_sets_expiry(self):
+        """
+        Ensure cache rows are written with a TTL.
+        """
+        AIService.set_cached_category('categorize_UBER', 'Transporte')
+        entry = AICache.objects.get(key='categorize_UBER')
+        self.assertIsNotNone(entry.expires_at)
+        self.assertGreater(entry.expires_at, timezone.now())
+
+    def test_sweep_deletes_expired_entries(self):
+        """
+        Ensure the sweeper removes expired rows in batches.
+        """
+        past = timezone.now() - timedelta(days=1)
+        for i in range(5):
+            AICache.objects.create(key=f'expired_{i}', value='Outros', expires_at=past)
+        AICache.objects.create(key='fresh', value='Outros', expires_at=timezone.now() + timedelta(days=1))
+
+        sweep_ai_cache(batch_size=2)
+
+        self.assertEqual(list(AICache.objects.values_list('key', flat=True)), ['fresh'])
+
+    @override_settings(AI_CACHE_MAX_ENTRIES=2)
+    def test_sweep_evicts_least_recently_hit(self):
+        """
+        Ensure the sweeper enforces the size cap by evicting LRU rows.
+        """
+        now = timezone.now()
+        for i, key in enumerate(['old', 'recent', 'newest']):
+            AICache.objects.create(
+                key=key,
+                value='Outros',
+                expires_at=now + timedelta(days=1),
+                last_hit_at=now - timedelta(hours=3 - i)
+            )
+
+        sweep_ai_cache()
+
+        self.assertEqual(set(AICache.objects.values_list('key', flat=True)), {'recent', 'newest'})
+
+    def test_cache_hit_updates_last_hit(self):
+        """
+        Ensure a database cache hit refreshes the LRU timestamp.
+        """
+        stale = timezone.now() - timedelta(days=2)
+        AICache.objects.create(
+            key='categorize_NETFLIX',
+            value='Lazer',
+            expires_at=timezone.now() + timedelta(days=1),
+            last_hit_at=stale
+        )
+
+        self.assertEqual(AIService.get_cached_category('categorize_NETFLIX'), 'Lazer')
+
+        entry = AICache.objects.get(key='categorize_NETFLIX')
+        self.assertGreater(entry.last_hit_at, stale)
+        self.assertEqual(entry.hit_count, 1)
+
+    def test_batch_reads_and_writes_cache_in_bulk(self):
+        """
+        Ensure a batch costs one AICache read, one hit update and one upsert whatever its number of merchants.
+        """
+        stale = timezone.now() - timedelta(days=2)
+        cached = ['NETFLIX', 'SPOTIFY', 'CINEMARK']
+        for name in cached:
+            AICache.objects.create(
+                key=AIService.get_cache_key(name), value='Lazer',
+                expires_at=timezone.now() + timedelta(days=1), last_hit_at=stale
+            )
+        new = ['UBER', 'IFOOD', 'PADARIA', 'FARMACIA', 'POSTO SHELL']
+        items = [(name, -10) for name in cached + new]
+
+        with patch.object(AIService, 'get_client', return_value=FakeOpenAIClient()), \
+                CaptureQueriesContext(connection) as queries:
+            answers = AIService.resolve_batch(items)
+
+        self.assertEqual([source for category, source in answers], ['cache'] * 3 + ['llm'] * 5)
+        cache_queries = [query['sql'] for query in queries.captured_queries if 'ai_services_aicache' in query['sql']]
+        self.assertEqual(len(cache_queries), 3)
+        self.assertEqual(AICache.objects.count(), 8)
+        self.assertEqual(AICache.objects.filter(hit_count=1).count(), 3)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class KeywordMatcherTests(TestCase):
+
+    def setUp(self):
+        invalidate_matcher()
+
+    def tearDown(self):
+        invalidate_matcher()
+
+    def test_match_folds_accents_and_case(self):
+        """
+        Ensure keywords match regardless of accents and case.
+        """
+        matcher = KeywordMatcher([('Saúde', ['farmácia']), ('Lazer', ['cinema'])])
+        self.assertEqual(matcher.match('FARMACIA SAO JOAO'), 'Saúde')
+        self.assertEqual(matcher.match('Cinemark Cinema'), 'Lazer')
+        self.assertIsNone(matcher.match('padaria'))
+
+    def test_match_respects_priority(self):
+        """
+        Ensure the first category wins when several keywords match.
+        """
+        matcher = KeywordMatcher([('Alimentação', ['restaurante']), ('Transporte', ['uber'])])
+        self.assertEqual(matcher.match('uber eats restaurante'), 'Alimentação')
+
+    def test_match_overlapping_keywords(self):
+        """
+        Ensure keywords contained in other keywords are still found.
+        """
+        matcher = KeywordMatcher([('Alimentação', ['mercado']), ('Compras', ['supermercadox'])])
+        self.assertEqual(matcher.match('supermercadox'), 'Alimentação')
+
+    def test_match_many(self):
+        """
+        Ensure bulk matching returns one result per description, in order.
+        """
+        matcher = KeywordMatcher([('Transporte', ['uber']), ('Lazer', ['netflix'])])
+        self.assertEqual(
+            matcher.match_many(['Uber', 'Netflix', 'Uber', 'nada']),
+            ['Transporte', 'Lazer', 'Transporte', None]
+        )
+
+    def test_matcher_uses_category_keywords(self):
+        """
+        Ensure Category.keywords feed the matcher and changes rebuild it.
+        """
+        self.assertEqual(AIService.fallback_categorization('Academia Smart Fit'), 'Outros')
+
+        Category.objects.create(name='Academia', keywords=['smart fit', 'academia'])
+
+        self.assertEqual(AIService.fallback_categorization('Academia Smart Fit'), 'Academia')
+        self.assertEqual(get_matcher().match('SMARTFIT'), None)
+
+
+TRAINING_SAMPLES = [
+    ('UBER *TRIP', 'Transporte'),
+    ('UBER DO BRASIL', 'Transporte'),
+    ('99 TAXI CORRIDA', 'Transporte'),
+    ('IFOOD *RESTAURANTE', 'Alimentação'),
+    ('IFOOD *PIZZARIA', 'Alimentação'),
+    ('PADARIA PAO QUENTE', 'Alimentação'),
+    ('NETFLIX COM', 'Lazer'),
+    ('SPOTIFY BRASIL', 'Lazer'),
+]
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ClassifierTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.classifier = NaiveBayesClassifier.train(TRAINING_SAMPLES * 5, n_features=1024)
+
+    def tearDown(self):
+        reset_classifier()
+
+    def test_predict_batch(self):
+        """
+        Ensure the classifier predicts repeat merchants with high confidence.
+        """
+        predictions = self.classifier.predict_batch(['UBER *TRIP 12/03', 'IFOOD *RESTAURANTE PARC 01/02'])
+        self.assertEqual([category for category, _ in predictions], ['Transporte', 'Alimentação'])
+        self.assertTrue(all(confidence > 0.9 for _, confidence in predictions))
+
+    def test_save_and_load(self):
+        """
+        Ensure a saved model is memory-mapped back with identical predictions.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.bin')
+            self.classifier.save(path)
+            loaded = NaiveBayesClassifier.load(path)
+
+            self.assertEqual(loaded.classes, self.classifier.classes)
+            self.assertEqual(
+                loaded.predict_batch(['NETFLIX.COM']),
+                self.classifier.predict_batch(['NETFLIX.COM'])
+            )
+            loaded.weights.release()
+            loaded._buffer.close()
+
+    def test_confident_prediction_skips_llm(self):
+        """
+        Ensure merchants the classifier is confident about never reach the LLM.
+        """
+        client = FakeOpenAIClient(lambda descriptions: json.dumps({
+            'results': [{'index': i, 'category': 'Compras'} for i in range(len(descriptions))]
+        }))
+
+        with patch('apps.ai_services.services.get_classifier', return_value=self.classifier), \
+                patch.object(AIService, 'get_client', return_value=client):
+            categories = AIService.categorize_batch([('UBER *TRIP', -10), ('LOJA AMERICANAS', -99)])
+
+        self.assertEqual(categories, ['Transporte', 'Compras'])
+        self.assertEqual(len(client.calls), 1)
+        self.assertNotIn('UBER', client.calls[0]['messages'][0]['content'])
+
+    def test_train_command(self):
+        """
+        Ensure the management command trains and persists a loadable model.
+        """
+        user = User.objects.create_user(email='train@example.com', password='password123')
+        account = BankAccount.objects.create(
+            user=user, pluggy_account_id='train_account', bank_name='Test Bank',
+            account_type='CHECKING', balance=0
+        )
+        for i, (description, category_name) in enumerate(TRAINING_SAMPLES):
+            category, _ = Category.objects.get_or_create(name=category_name)
+            merchant = Merchant.objects.create(key=normalize_merchant(description), name=description, category=category)
+            Transaction.objects.create(
+                account=account, pluggy_transaction_id=f'train_{i}', amount=-10,
+                description=description, date=timezone.now(), category=category, merchant=merchant
+            )
+        # A keyword guess kept on the row while the merchant waits for the LLM
+        outros, _ = Category.objects.get_or_create(name='Outros')
+        Transaction.objects.create(
+            account=account, pluggy_transaction_id='train_guess', amount=-10, description='SPOTIFY PREMIUM',
+            date=timezone.now(), category=outros,
+            merchant=Merchant.objects.create(key='SPOTIFY PREMIUM', name='SPOTIFY PREMIUM'),
+        )
+
+        out = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.bin')
+            with override_settings(AI_CLASSIFIER_PATH=path):
+                call_command('train_category_classifier', '--min-samples', '5', '--features', '1024', stdout=out)
+                classifier = get_classifier()
+                self.assertEqual(classifier.predict_batch(['SPOTIFY'])[0][0], 'Lazer')
+                self.assertNotIn('Outros', classifier.classes)
+                self.assertIn('on 8 transactions', out.getvalue())
+                classifier.weights.release()
+                classifier._buffer.close()
+
+
+    def test_workers_pick_up_new_models(self):
+        """
+        Ensure a running process loads the first model and every retrained one without a restart.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.bin')
+            with override_settings(AI_CLASSIFIER_PATH=path):
+                self.assertIsNone(get_classifier())
+
+                self.classifier.save(path)
+                first = get_classifier()
+                self.assertEqual(first.classes, self.classifier.classes)
+                self.assertIs(get_classifier(), first)
+
+                retrained = NaiveBayesClassifier.train([('SPOTIFY', 'Lazer'), ('UBER', 'Transporte')] * 5, n_features=1024)
+                retrained.save(path)
+                second = get_classifier()
+                self.assertEqual(second.classes, retrained.classes)
+
+                for classifier in (first, second):
+                    classifier.weights.release()
+                    classifier._buffer.close()
+                reset_classifier()
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @patch('apps.ai_services.ratelimit.time.time', return_value=120.0)
+    def test_limiter_enforces_requests_per_minute(self, mock_time):
+        """
+        Ensure the limiter refuses requests above the per-minute budget.
+        """
+        limiter = RateLimiter('test', requests_per_minute=2, tokens_per_minute=1000)
+        self.assertEqual(limiter.try_acquire(10), 0)
+        self.assertEqual(limiter.try_acquire(10), 0)
+        self.assertEqual(limiter.try_acquire(10), 70)
+
+        mock_time.return_value = 190.0
+        self.assertEqual(limiter.try_acquire(10), 0)
+
+    @patch('apps.ai_services.ratelimit.time.time', return_value=119.0)
+    def test_limiter_holds_across_minute_boundaries(self, mock_time):
+        """
+        Ensure a burst at the end of one minute is still counted at the
+        start of the next, so no rolling minute exceeds the budget.
+        """
+        limiter = RateLimiter('test', requests_per_minute=2)
+        self.assertEqual(limiter.try_acquire(0), 0)
+        self.assertEqual(limiter.try_acquire(0), 0)
+
+        mock_time.return_value = 121.0
+        self.assertEqual(limiter.try_acquire(0), 59)
+
+        mock_time.return_value = 180.0
+        self.assertEqual(limiter.try_acquire(0), 0)
+
+    @patch('apps.ai_services.ratelimit.time.time', return_value=120.0)
+    def test_limiter_enforces_tokens_per_minute(self, mock_time):
+        """
+        Ensure the limiter refuses requests above the token budget and gives
+        the reserved request back.
+        """
+        limiter = RateLimiter('test', requests_per_minute=10, tokens_per_minute=100)
+        self.assertEqual(limiter.try_acquire(80), 0)
+        self.assertEqual(limiter.try_acquire(30), 70)
+        self.assertEqual(limiter.try_acquire(20), 0)
+
+    @override_settings(OPENAI_RETRY_BACKOFF=0.01)
+    @patch('apps.ai_services.services.time.sleep')
+    def test_create_completion_retries_rate_limit(self, mock_sleep):
+        """
+        Ensure 429 responses are retried with backoff, honoring Retry-After.
+        """
+        request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+        rate_limited = openai.RateLimitError(
+            'Rate limit reached',
+            response=httpx.Response(429, headers={'retry-after': '2'}, request=request),
+            body=None
+        )
+        response = MagicMock()
+        client = MagicMock()
+        client.chat.completions.create.side_effect = [rate_limited, response]
+
+        result = AIService.create_completion(client, model='gpt-4o-mini', messages=[{'role': 'user', 'content': 'hi'}])
+
+        self.assertIs(result, response)
+        self.assertEqual(client.chat.completions.create.call_count, 2)
+        mock_sleep.assert_called_once_with(2.0)
+
+    @override_settings(AI_MAX_CONCURRENT_REQUESTS=3)
+    def test_categorize_batch_runs_chunks_concurrently(self):
+        """
+        Ensure chunks are sent concurrently, bounded by AI_MAX_CONCURRENT_REQUESTS.
+        """
+        lock = threading.Lock()
+        in_flight = []
+        peak = []
+
+        def answer(descriptions):
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.pop()
+            return json.dumps({'results': [{'index': i, 'category': 'Compras'} for i in range(len(descriptions))]})
+
+        client = FakeOpenAIClient(answer)
+        items = [(f'Loja {"X" * (i + 1)}', -10) for i in range(BATCH_SIZE * 6)]
+
+        with patch.object(AIService, 'get_client', return_value=client):
+            categories = AIService.categorize_batch(items)
+
+        self.assertEqual(categories, ['Compras'] * len(items))
+        self.assertEqual(len(client.calls), 6)
+        self.assertLessEqual(max(peak), 3)
+        self.assertGreater(max(peak), 1)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    AI_SINGLE_FLIGHT_POLL_INTERVAL=0.01,
+)
+class SingleFlightTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client_stub = FakeOpenAIClient(lambda descriptions: json.dumps({
+            'results': [{'index': i, 'category': 'Lazer'} for i in range(len(descriptions))]
+        }))
+
+    def test_waiter_uses_result_of_lock_holder(self):
+        """
+        Ensure a caller that loses the race reuses the holder's result.
+        """
+        cache_key = AIService.get_cache_key('IFOOD *RESTAURANTE')
+        self.assertTrue(AIService.acquire_flight(cache_key))
+
+        def publish():
+            time.sleep(0.05)
+            cache.set(cache_key, 'Alimentação')
+
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        with patch.object(AIService, 'get_client', return_value=self.client_stub):
+            category = AIService.categorize_transaction('IFOOD *RESTAURANTE', -30)
+        publisher.join()
+
+        self.assertEqual(category, 'Alimentação')
+        self.assertEqual(self.client_stub.calls, [])
+
+    @override_settings(AI_SINGLE_FLIGHT_WAIT=0.05)
+    def test_waiter_falls_back_on_timeout(self):
+        """
+        Ensure waiters fall back to the keyword matcher when the holder is slow.
+        """
+        AIService.acquire_flight(AIService.get_cache_key('Cinema Paradiso'))
+
+        with patch.object(AIService, 'get_client', return_value=self.client_stub):
+            categories = AIService.categorize_batch([('Cinema Paradiso', -30), ('Teatro Municipal', -80)])
+
+        self.assertEqual(categories, ['Lazer', 'Lazer'])
+        self.assertEqual(len(self.client_stub.calls), 1)
+        self.assertNotIn('Cinema', self.client_stub.calls[0]['messages'][0]['content'])
+
+    def test_holder_releases_lock(self):
+        """
+        Ensure the lock is released once the holder has published its result.
+        """
+        with patch.object(AIService, 'get_client', return_value=self.client_stub):
+            AIService.categorize_batch([('Netflix', -39.90)])
+
+        self.assertTrue(AIService.acquire_flight(AIService.get_cache_key('Netflix')))
+
+
+    def test_release_keeps_next_holders_lock(self):
+        """
+        Ensure a holder that overran its lease cannot release the next holder's lock.
+        """
+        cache_key = AIService.get_cache_key('Netflix')
+        token = AIService.acquire_flight(cache_key)
+        # The lease runs out and another worker takes the lock
+        cache.delete(f'lock_{cache_key}')
+        self.assertTrue(AIService.acquire_flight(cache_key))
+
+        AIService.release_flight(cache_key, token)
+
+        self.assertIsNone(AIService.acquire_flight(cache_key))
+
+    def test_holder_rechecks_cache_after_locking(self):
+        """
+        Ensure a result published between the cache read and the lock is reused.
+        """
+        cache.set(AIService.get_cache_key('Netflix'), 'Lazer')
+
+        with patch.object(AIService, 'get_client', return_value=self.client_stub), \
+                patch.object(AIService, 'get_cached_categories', return_value={}):
+            answers = AIService.resolve_batch([('Netflix', -39.90)])
+            category = AIService.categorize_transaction('Netflix', -39.90)
+
+        self.assertEqual(answers, [('Lazer', 'single_flight')])
+        self.assertEqual(category, 'Lazer')
+        self.assertEqual(self.client_stub.calls, [])
+
+    @override_settings(AI_MAX_CONCURRENT_REQUESTS=1)
+    def test_locks_are_taken_per_chunk(self):
+        """
+        Ensure later chunks' merchants are not locked while earlier chunks run.
+        """
+        items = [(f'Loja {i:03d} {"X" * (i + 1)}', -10) for i in range(BATCH_SIZE + 5)]
+        later_lock = f'lock_{AIService.get_cache_key(items[-1][0])}'
+        held = []
+
+        def answer(descriptions):
+            held.append(cache.get(later_lock) is not None)
+            return ['Compras'] * len(descriptions)
+
+        with patch.object(AIService, 'get_client', return_value=FakeOpenAIClient(answer)):
+            AIService.categorize_batch(items)
+
+        self.assertEqual(held, [False, True])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def _count(self, snapshot, name, label, value, suffix=''):
+        return snapshot[(name, label, value, suffix)]
+
+    def test_batch_records_resolution_paths(self):
+        """
+        Ensure each item is counted under the path that resolved it.
+        """
+        client = FakeOpenAIClient(lambda descriptions: json.dumps({
+            'results': [{'index': 0, 'category': 'Lazer'}]
+        }))
+        AIService.set_cached_category(AIService.get_cache_key('NETFLIX'), 'Lazer')
+
+        with patch.object(AIService, 'get_client', return_value=client):
+            AIService.categorize_batch([('NETFLIX', -39.90), ('CINEMARK', -30), ('UBER TRIP', -12)])
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(self._count(snapshot, 'ai_categorizations_total', 'path', 'redis_cache'), 1)
+        self.assertEqual(self._count(snapshot, 'ai_categorizations_total', 'path', 'llm'), 1)
+        self.assertEqual(self._count(snapshot, 'ai_categorizations_total', 'path', 'fallback'), 1)
+        self.assertEqual(self._count(snapshot, 'ai_errors_total', 'tier', 'llm'), 1)
+        self.assertEqual(
+            self._count(snapshot, 'ai_categorization_latency_seconds', 'path', 'llm', 'count'), 1
+        )
+
+    def test_llm_error_is_counted(self):
+        """
+        Ensure LLM failures are counted instead of silently swallowed.
+        """
+        client = MagicMock()
+        client.chat.completions.create.side_effect = Exception('API Error')
+
+        with patch.object(AIService, 'get_client', return_value=client), self.assertLogs('apps.ai_services.services', 'WARNING'):
+            self.assertEqual(AIService.categorize_transaction('Farmacia', -20), 'Saúde')
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(self._count(snapshot, 'ai_errors_total', 'tier', 'llm'), 1)
+        self.assertEqual(self._count(snapshot, 'ai_categorizations_total', 'path', 'fallback'), 1)
+
+    @patch('apps.ai_services.services.time.sleep')
+    def test_openai_429_is_counted_as_llm_error(self, mock_sleep):
+        """
+        Ensure 429s from OpenAI are counted under the llm tier, not our own rate limiter's.
+        """
+        request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+        client = MagicMock()
+        client.chat.completions.create.side_effect = [
+            openai.RateLimitError('Rate limit reached', response=httpx.Response(429, request=request), body=None),
+            MagicMock(),
+        ]
+
+        AIService.create_completion(client, model='gpt-4o-mini', messages=[{'role': 'user', 'content': 'hi'}])
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(self._count(snapshot, 'ai_errors_total', 'tier', 'llm'), 1)
+        self.assertEqual(self._count(snapshot, 'ai_errors_total', 'tier', 'rate_limiter'), 0)
+
+    def test_batch_latency_is_split_across_items(self):
+        """
+        Ensure a batch adds its elapsed time to the latency sum once, not once per item.
+        """
+        metrics.observe('llm', 0.6, count=3)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(self._count(snapshot, 'ai_categorization_latency_seconds', 'path', 'llm', 'sum'), 600_000)
+        self.assertEqual(self._count(snapshot, 'ai_categorization_latency_seconds', 'path', 'llm', 'count'), 3)
+        self.assertEqual(self._count(snapshot, 'ai_categorization_latency_seconds', 'path', 'llm', 'bucket_0.25'), 3)
+
+    def test_token_usage_is_recorded(self):
+        """
+        Ensure token usage from the OpenAI response is accumulated.
+        """
+        response = MagicMock()
+        response.usage.prompt_tokens = 120
+        response.usage.completion_tokens = 30
+        response.usage.total_tokens = 150
+        client = MagicMock()
+        client.chat.completions.create.return_value = response
+
+        AIService.create_completion(client, model='gpt-4o-mini', messages=[{'role': 'user', 'content': 'hi'}])
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(self._count(snapshot, 'ai_llm_tokens_total', 'kind', 'prompt'), 120)
+        self.assertEqual(self._count(snapshot, 'ai_llm_tokens_total', 'kind', 'completion'), 30)
+
+    def test_prometheus_export_and_command(self):
+        """
+        Ensure the management command prints the Prometheus text format.
+        """
+        metrics.observe('classifier', 0.006, count=3)
+
+        text = to_prometheus(metrics.snapshot())
+        self.assertIn('ai_categorizations_total{path="classifier"} 3', text)
+        self.assertIn('ai_categorization_latency_seconds_bucket{path="classifier",le="0.005"} 3', text)
+        self.assertIn('ai_categorization_latency_seconds_bucket{path="classifier",le="0.001"} 0', text)
+
+        out = io.StringIO()
+        call_command('ai_metrics', stdout=out)
+        self.assertIn('ai_categorizations_total{path="classifier"} 3', out.getvalue())
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BenchmarkTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        invalidate_matcher()
+        metrics.reset()
+
+    def test_generated_transactions_are_deterministic(self):
+        """
+        Ensure the synthetic generator is reproducible and repeats merchants.
+        """
+        transactions = generate_transactions(200, seed=7)
+
+        self.assertEqual(transactions, generate_transactions(200, seed=7))
+        merchants = {normalize_merchant(description) for description, amount in transactions}
+        self.assertLess(len(merchants), 100)
+
+    def test_fake_client_answers_batch_prompts_with_keywords(self):
+        """
+        Ensure the default fake answer categorizes batch prompts by keyword.
+        """
+        client = FakeOpenAIClient()
+        with patch.object(AIService, 'get_client', return_value=client):
+            categories = AIService.categorize_batch([('UBER *TRIP', -20), ('NETFLIX.COM', -55.9)])
+
+        self.assertEqual(categories, ['Transporte', 'Lazer'])
+        self.assertEqual(len(client.calls), 1)
+
+    def test_fake_client_raises_rate_limit_errors(self):
+        """
+        Ensure a fake client configured to always 429 raises RateLimitError.
+        """
+        client = FakeOpenAIClient(rate_limit_rate=1.0)
+
+        with self.assertRaises(openai.RateLimitError):
+            client.chat.completions.create(model='gpt-4o-mini', messages=[{'role': 'user', 'content': 'hi'}])
+        self.assertEqual(client.rate_limited, 1)
+
+    def test_benchmark_command_reports_and_rolls_back(self):
+        """
+        Ensure the benchmark prints its report and leaves no rows or cache keys behind.
+        """
+        cache.set('unrelated_key', 'kept')
+        out = io.StringIO()
+        call_command('benchmark_categorization', '--transactions', '50', '--latency', '0', stdout=out)
+
+        report = out.getvalue()
+        self.assertIn('Round 2', report)
+        self.assertIn('tx/s', report)
+        self.assertIn('queries per item', report)
+        self.assertIn('cache hit rate:     100.0%', report)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(User.objects.exists())
+        self.assertEqual(cache.get('unrelated_key'), 'kept')
+        self.assertFalse(AICache.objects.exists())
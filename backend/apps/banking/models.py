@@ -1,9 +1,52 @@
-from django.db import models
+from django.db import models, transaction as db_transaction
 from apps.authentication.models import CustomUser
+from apps.transactions.versioning import bump_data_version
+
+class BankAccountManager(models.Manager):
+    def upsert_from_pluggy(self, user, item_id, accounts_data):
+        """
+        Create or refresh ``user``'s accounts from Pluggy's account records
+        with one bulk upsert keyed on pluggy_account_id, inside one atomic
+        block, and return the persisted rows. Existing accounts get their
+        name, type and balance refreshed and are reactivated.
+
+        Raises ValueError, saving nothing, if any of the accounts belongs to
+        another user.
+        """
+        accounts = {
+            account_data['id']: self.model(
+                user=user,
+                pluggy_account_id=account_data['id'],
+                pluggy_item_id=item_id,
+                bank_name=account_data.get('name', 'Unknown'),
+                account_type=account_data.get('type', 'OTHER'),
+                balance=account_data.get('balance', 0),
+                is_active=True,
+            )
+            for account_data in accounts_data
+        }
+        if not accounts:
+            return []
+
+        with db_transaction.atomic():
+            self.bulk_create(
+                accounts.values(),
+                update_conflicts=True,
+                unique_fields=['pluggy_account_id'],
+                # Never 'user': a conflicting row of another user is rejected below
+                update_fields=['pluggy_item_id', 'bank_name', 'account_type', 'balance', 'is_active', 'updated_at'],
+            )
+            # Primary keys are not set on upserted objects, so read the rows back
+            saved = list(self.filter(user=user, pluggy_account_id__in=accounts).order_by('id'))
+            if len(saved) != len(accounts):
+                raise ValueError('Bank account is linked to another user')
+            bump_data_version(user.id)
+        return saved
 
 class BankAccount(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     pluggy_account_id = models.CharField(max_length=100, unique=True)
+    pluggy_item_id = models.CharField(max_length=100, blank=True, default='', db_index=True, help_text="Pluggy item (bank connection) the account belongs to")
     bank_name = models.CharField(max_length=100)
     account_type = models.CharField(max_length=50)
     balance = models.DecimalField(max_digits=12, decimal_places=2)
@@ -11,8 +54,47 @@ class BankAccount(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = BankAccountManager()
+
     class Meta:
         unique_together = ('user', 'pluggy_account_id')
 
     def __str__(self):
         return f"{self.user.email} - {self.bank_name} - {self.account_type}"
+
+class SyncState(models.Model):
+    """
+    Per-account cursor for incremental Pluggy syncs.
+    """
+    account = models.OneToOneField(BankAccount, on_delete=models.CASCADE, related_name='sync_state')
+    last_synced_at = models.DateTimeField(null=True, blank=True, help_text="When the last sync finished")
+    high_water_mark = models.DateTimeField(null=True, blank=True, help_text="Latest transaction date synced")
+    next_sync_at = models.DateTimeField(null=True, blank=True, db_index=True, help_text="When the scheduler syncs this account next")
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.account} - synced up to {self.high_water_mark}"
+
+class SyncRun(models.Model):
+    """
+    One scheduled sync of an account: what it fetched and how long it took.
+    """
+    account = models.ForeignKey(BankAccount, on_delete=models.CASCADE, related_name='sync_runs')
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True, help_text="Seconds")
+    transactions_synced = models.PositiveIntegerField(default=0)
+    succeeded = models.BooleanField(default=False)
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        ordering = ['-started_at']
+        indexes = [
+            models.Index(fields=['account', 'started_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.account} - {self.started_at} - {'ok' if self.succeeded else 'failed'}"
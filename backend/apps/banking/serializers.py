@@ -4,8 +4,15 @@ from .models import BankAccount
 class BankAccountSerializer(serializers.ModelSerializer):
     class Meta:
         model = BankAccount
-        fields = ['id', 'pluggy_account_id', 'bank_name', 'account_type', 'balance', 'is_active', 'created_at', 'updated_at']
+        fields = ['id', 'pluggy_account_id', 'pluggy_item_id', 'bank_name', 'account_type', 'balance', 'is_active', 'created_at', 'updated_at']
         read_only_fields = ['id', 'created_at', 'updated_at']
 
 class ConnectBankAccountSerializer(serializers.Serializer):
     itemId = serializers.CharField(max_length=100)
+
+class FetchTransactionsSerializer(serializers.Serializer):
+    # Optional; by default only the delta since the account's last sync is fetched
+    start_date = serializers.CharField(required=False, default=None, allow_null=True)
+    end_date = serializers.CharField(required=False, default=None, allow_null=True)
+    # Also refresh amounts and descriptions of transactions already stored
+    update_existing = serializers.BooleanField(required=False, default=False)
@@ -1,6 +1,24 @@
+import random
 import requests
 import os
+import threading
+import time
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from apps.ai_services.ratelimit import RateLimiter, RateLimitExceeded
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# Fleet-wide budget for Pluggy API calls, shared by all workers through the cache
+pluggy_rate_limiter = RateLimiter(
+    'pluggy',
+    requests_per_minute=settings.PLUGGY_REQUESTS_PER_MINUTE,
+    metrics_tier=None,
+)
 
 class PluggyService:
     BASE_URL = 'https://api.pluggy.ai'
@@ -14,21 +32,130 @@ class PluggyService:
         }
 
     @staticmethod
-    def get_accounts(item_id):
-        url = f'{PluggyService.BASE_URL}/accounts'
-        params = {'itemId': item_id}
-        response = requests.get(url, params=params, headers=PluggyService.get_headers())
-        response.raise_for_status()
-        return response.json()
+    def get_session():
+        """
+        Return this process's pooled keep-alive session, so repeated calls
+        reuse TCP/TLS connections to the API host. It is rebuilt after a
+        fork, since pooled sockets must not be shared between processes.
+        """
+        global _session, _session_pid
+        pid = os.getpid()
+        if _session is None or _session_pid != pid:
+            with _session_lock:
+                if _session is None or _session_pid != pid:
+                    _session = PluggyService.create_session()
+                    _session_pid = pid
+        return _session
+
+    @staticmethod
+    def create_session():
+        # No transport-level retries: get() retries itself so that every
+        # attempt is counted against pluggy_rate_limiter
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=settings.PLUGGY_POOL_SIZE,
+            # Threads wait for a free connection, so PLUGGY_POOL_SIZE also
+            # caps this process's concurrent requests to the API host
+            pool_block=True,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        return session
+
+    @staticmethod
+    def get_timeout():
+        return (settings.PLUGGY_CONNECT_TIMEOUT, settings.PLUGGY_READ_TIMEOUT)
+
+    @staticmethod
+    def get_retry_delay(attempt, response=None):
+        """
+        Seconds to wait before retry number ``attempt`` + 1: jittered
+        exponential backoff, or Retry-After when the API asks for longer,
+        capped at PLUGGY_MAX_RETRY_WAIT.
+        """
+        delay = random.uniform(0, settings.PLUGGY_RETRY_BACKOFF * 2 ** attempt)
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get('Retry-After')))
+            except (TypeError, ValueError):
+                pass
+        return min(delay, settings.PLUGGY_MAX_RETRY_WAIT)
 
     @staticmethod
-    def get_transactions(account_id, from_date, to_date):
-        url = f'{PluggyService.BASE_URL}/transactions'
+    def get(path, params, max_wait=None):
+        """
+        GET ``path`` and return the decoded JSON. Connection errors, 429 and
+        5xx are retried up to PLUGGY_MAX_RETRIES times with backoff, and
+        every attempt takes its own slot from pluggy_rate_limiter.
+
+        Callers serving a web request pass ``max_wait`` (seconds): waiting
+        for the limiter or a retry longer than that raises
+        RateLimitExceeded instead of holding the request.
+        """
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        for attempt in range(settings.PLUGGY_MAX_RETRIES + 1):
+            last_attempt = attempt == settings.PLUGGY_MAX_RETRIES
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            pluggy_rate_limiter.acquire(timeout=remaining)
+            try:
+                response = PluggyService.get_session().get(
+                    f'{PluggyService.BASE_URL}{path}',
+                    params=params,
+                    headers=PluggyService.get_headers(),
+                    timeout=PluggyService.get_timeout(),
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+                response = None
+            if response is not None and (response.status_code not in RETRY_STATUSES or last_attempt):
+                response.raise_for_status()
+                return response.json()
+
+            delay = PluggyService.get_retry_delay(attempt, response)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                if response is not None and response.status_code == 429:
+                    raise RateLimitExceeded(delay)
+                if response is not None:
+                    response.raise_for_status()
+                raise requests.ConnectionError(f'Pluggy unreachable, gave up retrying {path}')
+            time.sleep(delay)
+
+    @staticmethod
+    def get_accounts(item_id, max_wait=None):
+        return PluggyService.get('/accounts', {'itemId': item_id}, max_wait=max_wait)
+
+    @staticmethod
+    def get_transactions(account_id, from_date, to_date, page=1, page_size=None):
+        """
+        Fetch one page of transactions. Pluggy answers with
+        {'total', 'totalPages', 'page', 'results'}.
+        """
         params = {
             'accountId': account_id,
             'from': from_date,
             'to': to_date,
+            'page': page,
+            'pageSize': page_size or settings.PLUGGY_PAGE_SIZE,
         }
-        response = requests.get(url, params=params, headers=PluggyService.get_headers())
-        response.raise_for_status()
-        return response.json()
+        return PluggyService.get('/transactions', params)
+
+    @staticmethod
+    def iter_transactions(account_id, from_date, to_date, page_size=None):
+        """
+        Yield the account's transactions one page (a list of records) at a
+        time, following Pluggy's page/totalPages metadata. Each page is
+        requested only when the caller asks for it, so memory stays flat
+        however long the date range is.
+        """
+        page = 1
+        while True:
+            data = PluggyService.get_transactions(account_id, from_date, to_date, page=page, page_size=page_size)
+            results = data.get('results', [])
+            if results:
+                yield results
+            if not results or page >= data.get('totalPages', page):
+                return
+            page += 1
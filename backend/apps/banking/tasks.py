@@ -0,0 +1,373 @@
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils import timezone
+from .models import BankAccount, SyncRun, SyncState
+from .services import PluggyService
+from apps.ai_services.locks import acquire_lock, new_token, release_lock
+from apps.ai_services.tasks import enqueue_categorization
+from apps.transactions.models import Transaction
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of an account's pages on the item sync queue
+DONE = object()
+
+def get_sync_window(state, start_date=None, end_date=None):
+    """
+    Return the (from, to) dates to request from Pluggy. Without explicit
+    dates the window starts at the account's high-water mark minus
+    PLUGGY_SYNC_OVERLAP, or PLUGGY_SYNC_INITIAL_DAYS back on a first sync.
+    """
+    today = timezone.localdate()
+    if not start_date:
+        if state.high_water_mark:
+            start = timezone.localtime(state.high_water_mark - settings.PLUGGY_SYNC_OVERLAP).date()
+        else:
+            start = today - timedelta(days=settings.PLUGGY_SYNC_INITIAL_DAYS)
+        start_date = start.isoformat()
+    return start_date, end_date or today.isoformat()
+
+def ingest_page(account, tx_records, update_existing=False):
+    """
+    Store one page of Pluggy records and queue the new rows for
+    categorization. Returns (rows inserted, latest transaction date).
+    """
+    saved_ids = Transaction.objects.ingest(account, tx_records, update_existing=update_existing)
+    enqueue_categorization(saved_ids)
+
+    latest = max(datetime.fromisoformat(tx_data['date']) for tx_data in tx_records)
+    if timezone.is_naive(latest):
+        latest = timezone.make_aware(latest)
+    return len(saved_ids), latest
+
+def sync_lock_key(account_id):
+    return f'pluggy_sync_lock_{account_id}'
+
+def acquire_sync_lock(account_id):
+    """
+    Try to become the only sync of ``account_id``. The lock is a cache key
+    holding a token unique to this caller, with a lease
+    (PLUGGY_SYNC_LOCK_LEASE) so a crashed worker cannot block the account
+    forever. Returns the token to pass to release_sync_lock, or None if
+    another sync holds the account.
+    """
+    token = new_token()
+    try:
+        return acquire_lock(sync_lock_key(account_id), settings.PLUGGY_SYNC_LOCK_LEASE, token)
+    except Exception as e:
+        # Cache might not be available (e.g., Redis down); ingest's account lock keeps rows and counts right
+        logger.warning('Sync lock failed for account %s: %s', account_id, e)
+        return token
+
+def release_sync_lock(account_id, token):
+    """
+    Release the sync lock of ``account_id`` if it still holds ``token``.
+    """
+    try:
+        release_lock(sync_lock_key(account_id), token)
+    except Exception as e:
+        logger.warning('Sync lock release failed for account %s: %s', account_id, e)
+
+def jittered(delay):
+    """
+    Spread ``delay`` by ±10% so accounts synced together drift apart.
+    """
+    return delay * random.uniform(0.9, 1.1)
+
+def advance_cursor(state, latest):
+    """
+    Record a successful sync: move the high-water mark forward and push the
+    next scheduled sync a PLUGGY_SYNC_INTERVAL away.
+    """
+    if latest is not None:
+        # Compared in the database, so a sync that read an older state
+        # can never move the mark backwards
+        SyncState.objects.filter(
+            Q(high_water_mark__lt=latest) | Q(high_water_mark__isnull=True), pk=state.pk
+        ).update(high_water_mark=latest)
+        if state.high_water_mark is None or latest > state.high_water_mark:
+            state.high_water_mark = latest
+    state.last_synced_at = timezone.now()
+    state.next_sync_at = state.last_synced_at + jittered(settings.PLUGGY_SYNC_INTERVAL)
+    state.consecutive_failures = 0
+    state.last_error = ''
+    state.save(update_fields=['last_synced_at', 'next_sync_at', 'consecutive_failures', 'last_error', 'updated_at'])
+
+def record_failure(state, error):
+    """
+    Back off an account that failed to sync: the delay before the scheduler
+    retries doubles with every consecutive failure, up to
+    PLUGGY_SYNC_MAX_BACKOFF.
+    """
+    state.consecutive_failures += 1
+    delay = min(settings.PLUGGY_SYNC_INTERVAL * 2 ** (state.consecutive_failures - 1), settings.PLUGGY_SYNC_MAX_BACKOFF)
+    state.next_sync_at = timezone.now() + jittered(delay)
+    state.last_error = str(error)
+    state.save(update_fields=['consecutive_failures', 'next_sync_at', 'last_error', 'updated_at'])
+
+def sync_account(account, state, start_date=None, end_date=None, update_existing=False):
+    """
+    Pull ``account``'s transactions from Pluggy since its cursor, store them
+    page by page and queue the new rows for categorization. Returns the
+    number of rows inserted. Callers hold the account's sync lock.
+    """
+    from_date, to_date = get_sync_window(state, start_date, end_date)
+
+    saved_count = 0
+    latest = None
+    # Each page is stored and queued for categorization before the next is downloaded
+    for tx_records in PluggyService.iter_transactions(account.pluggy_account_id, from_date, to_date):
+        page_count, page_latest = ingest_page(account, tx_records, update_existing)
+        saved_count += page_count
+        latest = max(latest, page_latest) if latest else page_latest
+
+    advance_cursor(state, latest)
+    return saved_count
+
+@shared_task(bind=True)
+def sync_account_transactions(self, account_id, start_date=None, end_date=None, update_existing=False):
+    """
+    Sync one account on demand. If another sync of the account is running
+    the task is retried every PLUGGY_SYNC_LOCK_RETRY_DELAY seconds for up
+    to one lease, since its dates or update_existing may differ.
+    """
+    try:
+        account = BankAccount.objects.get(id=account_id, is_active=True)
+    except BankAccount.DoesNotExist:
+        return f'Bank account {account_id} not found'
+
+    token = acquire_sync_lock(account.id)
+    if token is None:
+        raise self.retry(
+            countdown=settings.PLUGGY_SYNC_LOCK_RETRY_DELAY,
+            max_retries=settings.PLUGGY_SYNC_LOCK_LEASE // settings.PLUGGY_SYNC_LOCK_RETRY_DELAY,
+        )
+    try:
+        # Loaded under the lock, so the cursor includes the previous sync
+        state, created = SyncState.objects.get_or_create(account=account)
+        saved_count = sync_account(account, state, start_date, end_date, update_existing)
+    finally:
+        release_sync_lock(account.id, token)
+    return f'Fetched {saved_count} new transactions for account {account_id}'
+
+def iter_concurrent_pages(windows):
+    """
+    Download the pages of several accounts concurrently and yield them as
+    (account, records) in arrival order. ``windows`` maps each account to
+    its (from, to) dates.
+
+    Up to PLUGGY_SYNC_MAX_WORKERS threads only talk to Pluggy; the caller
+    stores every page on its own thread, so database work stays on one
+    connection. The bounded queue pauses fetching when storing falls
+    behind. Each account ends with (account, DONE), or with
+    (account, exception) if its download failed.
+    """
+    pages = queue.Queue(maxsize=settings.PLUGGY_SYNC_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def fetch(account, from_date, to_date):
+        try:
+            for tx_records in PluggyService.iter_transactions(account.pluggy_account_id, from_date, to_date):
+                if stop.is_set():
+                    return
+                put((account, tx_records))
+            put((account, DONE))
+        except Exception as e:
+            put((account, e))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(windows), settings.PLUGGY_SYNC_MAX_WORKERS))) as executor:
+        for account, (from_date, to_date) in windows.items():
+            executor.submit(fetch, account, from_date, to_date)
+        try:
+            remaining = len(windows)
+            while remaining:
+                account, item = pages.get()
+                if item is DONE or isinstance(item, Exception):
+                    remaining -= 1
+                yield account, item
+        finally:
+            # Lets fetch threads finish if the caller stops early or fails
+            stop.set()
+
+@shared_task
+def sync_item_transactions(user_id, item_id):
+    """
+    Sync every active account of a user's Pluggy item at once, so the sync
+    takes as long as the slowest account instead of the sum of all of them.
+    An account whose download fails keeps its cursor; the others advance.
+    Accounts another sync is already running for are skipped.
+    """
+    accounts = BankAccount.objects.filter(user_id=user_id, pluggy_item_id=item_id, is_active=True)
+    tokens = {}
+    states = {}
+    windows = {}
+    try:
+        for account in accounts:
+            token = acquire_sync_lock(account.id)
+            if token is None:
+                continue
+            tokens[account] = token
+            states[account], created = SyncState.objects.get_or_create(account=account)
+            windows[account] = get_sync_window(states[account])
+
+        saved_count = 0
+        latest = {}
+        failed = []
+        for account, item in iter_concurrent_pages(windows):
+            if item is DONE:
+                advance_cursor(states[account], latest.get(account))
+            elif isinstance(item, Exception):
+                logger.warning('Sync of account %s failed: %s', account.id, item)
+                failed.append(account.id)
+            else:
+                page_count, page_latest = ingest_page(account, item)
+                saved_count += page_count
+                latest[account] = max(latest[account], page_latest) if account in latest else page_latest
+    finally:
+        for account, token in tokens.items():
+            release_sync_lock(account.id, token)
+
+    result = f'Fetched {saved_count} new transactions for {len(windows)} accounts of item {item_id}'
+    skipped = len(accounts) - len(windows)
+    if failed:
+        result += f' ({len(failed)} failed)'
+    if skipped:
+        result += f' ({skipped} already syncing)'
+    return result
+
+def webhook_debounce_key(item_id):
+    return f'pluggy_webhook_debounce_{item_id}'
+
+def schedule_item_sync(item_id):
+    """
+    Schedule one sync of ``item_id`` PLUGGY_WEBHOOK_DEBOUNCE seconds from
+    now, unless one is already pending; events arriving in the meantime
+    are covered by it. Returns True if a sync was scheduled.
+    """
+    key = webhook_debounce_key(item_id)
+    # Outlives the countdown so a late worker does not open a second window
+    if not cache.add(key, 1, timeout=2 * settings.PLUGGY_WEBHOOK_DEBOUNCE):
+        return False
+    try:
+        sync_webhook_item.apply_async((item_id,), countdown=settings.PLUGGY_WEBHOOK_DEBOUNCE)
+    except Exception:
+        cache.delete(key)
+        raise
+    return True
+
+@shared_task
+def sync_webhook_item(item_id):
+    """
+    Sync an item after a burst of Pluggy webhook events.
+    """
+    # Events from now on may carry data this sync misses, so they open a new window
+    cache.delete(webhook_debounce_key(item_id))
+    user_ids = BankAccount.objects.filter(
+        pluggy_item_id=item_id, is_active=True
+    ).values_list('user_id', flat=True).distinct()
+    return [sync_item_transactions(user_id, item_id) for user_id in user_ids]
+
+@shared_task
+def schedule_account_syncs():
+    """
+    Periodic task that starts the syncs that are due, so every active
+    account is refreshed about every PLUGGY_SYNC_INTERVAL.
+
+    At most PLUGGY_SCHEDULE_BATCH_SIZE syncs start per tick, the longest
+    overdue first, and at most PLUGGY_SCHEDULE_PER_USER of them per user so
+    a user with many accounts cannot crowd out the others. Starts are
+    jittered across the tick; PluggyService's limiter keeps the actual
+    request rate within PLUGGY_REQUESTS_PER_MINUTE.
+    """
+    # Accounts never synced get a state that is due right away
+    SyncState.objects.bulk_create([
+        SyncState(account_id=account_id)
+        for account_id in BankAccount.objects.filter(
+            is_active=True, sync_state__isnull=True
+        ).values_list('id', flat=True)
+    ], ignore_conflicts=True)
+
+    now = timezone.now()
+    overdue_first = F('next_sync_at').asc(nulls_first=True)
+    due = SyncState.objects.filter(
+        Q(next_sync_at__isnull=True) | Q(next_sync_at__lte=now),
+        account__is_active=True,
+    ).annotate(
+        user_rank=Window(RowNumber(), partition_by=F('account__user_id'), order_by=overdue_first)
+    ).filter(
+        user_rank__lte=settings.PLUGGY_SCHEDULE_PER_USER
+    ).order_by(overdue_first, 'id').values_list('id', 'account_id')
+    selected = list(due[:settings.PLUGGY_SCHEDULE_BATCH_SIZE])
+    if not selected:
+        return 'Scheduled 0 account syncs'
+
+    # Lease the selected accounts so the next ticks skip them while they run;
+    # a sync that never reports back is retried once the lease expires
+    SyncState.objects.filter(id__in=[state_id for state_id, account_id in selected]).update(
+        next_sync_at=now + settings.PLUGGY_SYNC_INTERVAL
+    )
+    tick = settings.PLUGGY_SCHEDULE_TICK.total_seconds()
+    for position, (state_id, account_id) in enumerate(selected):
+        try:
+            sync_scheduled_account.apply_async((account_id,), countdown=random.uniform(0, tick))
+        except Exception:
+            # Broker might not be available; make the rest due again for the next tick
+            SyncState.objects.filter(id__in=[state_id for state_id, account_id in selected[position:]]).update(
+                next_sync_at=now
+            )
+            raise
+    return f'Scheduled {len(selected)} account syncs'
+
+@shared_task
+def sync_scheduled_account(account_id):
+    """
+    Run one scheduled sync and record it as a SyncRun. A failure backs the
+    account off instead of failing the task.
+    """
+    try:
+        account = BankAccount.objects.get(id=account_id, is_active=True)
+    except BankAccount.DoesNotExist:
+        return f'Bank account {account_id} not found'
+
+    token = acquire_sync_lock(account.id)
+    if token is None:
+        # The running sync advances the cursor and the next scheduled time
+        return f'Sync of account {account_id} already running'
+    try:
+        state, created = SyncState.objects.get_or_create(account=account)
+        run = SyncRun.objects.create(account=account)
+        started = time.monotonic()
+        try:
+            run.transactions_synced = sync_account(account, state)
+            run.succeeded = True
+        except Exception as e:
+            logger.warning('Scheduled sync of account %s failed: %s', account_id, e)
+            run.error = str(e)
+            record_failure(state, e)
+    finally:
+        release_sync_lock(account.id, token)
+    run.duration = time.monotonic() - started
+    run.finished_at = timezone.now()
+    run.save(update_fields=['transactions_synced', 'succeeded', 'error', 'duration', 'finished_at'])
+
+    if not run.succeeded:
+        return f'Sync of account {account_id} failed: {run.error}'
+    return f'Fetched {run.transactions_synced} new transactions for account {account_id}'
@@ -2,7 +2,26 @@ from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
-from .models import BankAccount
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from celery.exceptions import Retry
+from django.utils import timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
+from apps.ai_services.ratelimit import RateLimitExceeded
+from apps.transactions.models import Transaction
+from .models import BankAccount, SyncRun, SyncState
+from .services import PluggyService, pluggy_rate_limiter
+from .tasks import (
+    acquire_sync_lock, advance_cursor, release_sync_lock, schedule_account_syncs, sync_account_transactions,
+    sync_item_transactions, sync_scheduled_account, sync_webhook_item,
+)
+import requests
+import threading
+import time
 
 User = get_user_model()
 
@@ -49,3 +68,566 @@ class BankingTests(APITestCase):
         response = self.client.get(self.list_accounts_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 0)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    @patch('apps.banking.views.PluggyService.get_accounts')
+    def test_list_bank_accounts_etag(self, mock_get_accounts):
+        """
+        Ensure an unchanged account list is answered with 304 until accounts are connected or disconnected.
+        """
+        response = self.client.get(self.list_accounts_url)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.list_accounts_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(queries), 0)
+
+        mock_get_accounts.return_value = {'results': [
+            {'id': 'savings_id', 'name': 'Test Bank', 'type': 'SAVINGS', 'balance': 100},
+        ]}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('banking:connect_bank_account'), {'itemId': 'item_1'}, format='json')
+        response = self.client.get(self.list_accounts_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        etag = response['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('banking:disconnect_bank_account', args=[self.account.id]))
+        response = self.client.get(self.list_accounts_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+
+    @patch('apps.banking.views.PluggyService.get_accounts')
+    def test_connect_upserts_accounts_in_bulk(self, mock_get_accounts):
+        """
+        Ensure connecting creates new accounts and refreshes existing balances.
+        """
+        mock_get_accounts.return_value = {'results': [
+            {'id': 'test_account_id', 'name': 'Test Bank', 'type': 'CHECKING', 'balance': 2500},
+            {'id': 'savings_id', 'name': 'Test Bank', 'type': 'SAVINGS', 'balance': 100},
+            {'id': 'card_id', 'name': 'Test Bank', 'type': 'CREDIT', 'balance': -300},
+        ]}
+        url = reverse('banking:connect_bank_account')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, {'itemId': 'item_1'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 3)
+        self.assertTrue(all(account['id'] for account in response.data))
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, 2500)
+        self.assertEqual(self.account.pluggy_item_id, 'item_1')
+        self.assertEqual(BankAccount.objects.filter(user=self.user, pluggy_item_id='item_1').count(), 3)
+        self.assertLess(len(queries), 10)
+
+    def test_connect_answers_503_when_budget_is_spent(self):
+        """
+        Ensure connecting fails fast with Retry-After instead of waiting for the Pluggy budget.
+        """
+        with patch.object(pluggy_rate_limiter, 'try_acquire', return_value=30), \
+                patch.object(PluggyService, 'get_session') as mock_session:
+            response = self.client.post(reverse('banking:connect_bank_account'), {'itemId': 'item_1'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '30')
+        mock_session.return_value.get.assert_not_called()
+
+    @patch('apps.banking.views.PluggyService.get_accounts')
+    def test_connect_rejects_another_users_account(self, mock_get_accounts):
+        """
+        Ensure an account of another user is neither taken over nor partially saved.
+        """
+        other_user = User.objects.create_user(email='other@example.com', password='password123')
+        BankAccount.objects.create(
+            user=other_user, pluggy_account_id='other_account_id',
+            bank_name='Other Bank', account_type='CHECKING', balance=50
+        )
+        mock_get_accounts.return_value = {'results': [
+            {'id': 'new_id', 'name': 'Test Bank', 'type': 'SAVINGS', 'balance': 100},
+            {'id': 'other_account_id', 'name': 'Test Bank', 'type': 'CHECKING', 'balance': 999},
+        ]}
+
+        response = self.client.post(reverse('banking:connect_bank_account'), {'itemId': 'item_1'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(BankAccount.objects.filter(pluggy_account_id='new_id').exists())
+        self.assertEqual(BankAccount.objects.get(pluggy_account_id='other_account_id').balance, 50)
+
+    @patch('apps.ai_services.tasks.categorize_new_transactions')
+    @patch('apps.banking.tasks.PluggyService.get_transactions')
+    def test_sync_enqueues_new_ids(self, mock_get_transactions, mock_task):
+        """
+        Ensure syncing enqueues categorization of exactly the inserted rows.
+        """
+        Transaction.objects.create(
+            account=self.account,
+            pluggy_transaction_id='existing',
+            amount=-10,
+            description='Old',
+            date='2024-01-01T00:00:00+00:00'
+        )
+        mock_get_transactions.return_value = {'total': 3, 'totalPages': 1, 'page': 1, 'results': [
+            {'id': 'existing', 'amount': -10, 'description': 'Old', 'date': '2024-01-01T00:00:00+00:00'},
+            {'id': 'new_1', 'amount': -25, 'description': 'UBER TRIP', 'date': '2024-01-02T00:00:00+00:00'},
+            {'id': 'new_2', 'amount': -40, 'description': 'IFOOD', 'date': '2024-01-03T00:00:00+00:00'},
+        ]}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = sync_account_transactions(self.account.id, '2024-01-01', '2024-01-31')
+
+        self.assertEqual(result, f'Fetched 2 new transactions for account {self.account.id}')
+        new_ids = list(Transaction.objects.filter(
+            pluggy_transaction_id__in=['new_1', 'new_2']
+        ).order_by('id').values_list('id', flat=True))
+        mock_task.delay.assert_called_once_with(new_ids)
+
+    @patch('apps.ai_services.tasks.categorize_new_transactions')
+    @patch('apps.banking.tasks.PluggyService.get_transactions')
+    def test_sync_follows_every_page(self, mock_get_transactions, mock_task):
+        """
+        Ensure rows past the first page are stored, one enqueue per page.
+        """
+        def page(number):
+            return {'total': 4, 'totalPages': 2, 'page': number, 'results': [
+                {'id': f'p{number}_{i}', 'amount': -10, 'description': f'LOJA {number}{i}', 'date': '2024-01-02T00:00:00+00:00'}
+                for i in range(2)
+            ]}
+        page_data = {1: page(1), 2: page(2)}
+        mock_get_transactions.side_effect = lambda *args, page=1, **kwargs: page_data[page]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sync_account_transactions(self.account.id, '2024-01-01', '2024-01-31')
+
+        self.assertEqual(Transaction.objects.filter(account=self.account).count(), 4)
+        self.assertEqual(mock_task.delay.call_count, 2)
+        self.assertEqual([call.kwargs['page'] for call in mock_get_transactions.call_args_list], [1, 2])
+
+    @patch('apps.ai_services.tasks.categorize_new_transactions')
+    @patch('apps.banking.tasks.PluggyService.get_transactions')
+    def test_sync_fetches_delta_since_cursor(self, mock_get_transactions, mock_task):
+        """
+        Ensure a sync without dates starts at the high-water mark minus the overlap.
+        """
+        mock_get_transactions.return_value = {'total': 1, 'totalPages': 1, 'page': 1, 'results': [
+            {'id': 'late', 'amount': -10, 'description': 'PADARIA', 'date': '2024-03-10T12:00:00+00:00'},
+        ]}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sync_account_transactions(self.account.id)
+        first_from = mock_get_transactions.call_args.args[1]
+        self.assertEqual(first_from, (timezone.localdate() - timedelta(days=90)).isoformat())
+
+        state = SyncState.objects.get(account=self.account)
+        self.assertEqual(state.high_water_mark, datetime(2024, 3, 10, 12, tzinfo=dt_timezone.utc))
+        self.assertIsNotNone(state.last_synced_at)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            sync_account_transactions(self.account.id)
+        self.assertEqual(mock_get_transactions.call_args.args[1:3], ('2024-03-07', timezone.localdate().isoformat()))
+        self.assertEqual(Transaction.objects.filter(account=self.account).count(), 1)
+
+    @override_settings(PLUGGY_SYNC_MAX_WORKERS=3)
+    @patch('apps.ai_services.tasks.categorize_new_transactions')
+    @patch('apps.banking.tasks.PluggyService.get_transactions')
+    def test_sync_item_fetches_accounts_concurrently(self, mock_get_transactions, mock_task):
+        """
+        Ensure an item's accounts download in parallel and a failed one keeps its cursor.
+        """
+        self.account.pluggy_item_id = 'item_1'
+        self.account.save()
+        for pluggy_id in ('savings_id', 'card_id', 'broken_id'):
+            BankAccount.objects.create(
+                user=self.user, pluggy_account_id=pluggy_id, pluggy_item_id='item_1',
+                bank_name='Test Bank', account_type='CHECKING', balance=0
+            )
+
+        def get_transactions(account_id, from_date, to_date, page=1, page_size=None):
+            time.sleep(0.2)
+            if account_id == 'broken_id':
+                raise requests.ConnectionError('boom')
+            return {'total': 2, 'totalPages': 1, 'page': 1, 'results': [
+                {'id': f'{account_id}_{i}', 'amount': -10, 'description': f'LOJA {i}', 'date': '2024-01-02T00:00:00+00:00'}
+                for i in range(2)
+            ]}
+        mock_get_transactions.side_effect = get_transactions
+
+        started = time.monotonic()
+        with self.captureOnCommitCallbacks(execute=True):
+            result = sync_item_transactions(self.user.id, 'item_1')
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(result, 'Fetched 6 new transactions for 4 accounts of item item_1 (1 failed)')
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(Transaction.objects.filter(account__pluggy_item_id='item_1').count(), 6)
+        self.assertIsNotNone(SyncState.objects.get(account=self.account).high_water_mark)
+        self.assertIsNone(SyncState.objects.get(account__pluggy_account_id='broken_id').last_synced_at)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    @patch('apps.banking.tasks.PluggyService.get_transactions')
+    def test_syncs_of_one_account_never_overlap(self, mock_get_transactions):
+        """
+        Ensure scheduled, item and on-demand syncs leave an account alone while another sync holds it.
+        """
+        cache.clear()
+        self.account.pluggy_item_id = 'item_1'
+        self.account.save()
+        token = acquire_sync_lock(self.account.id)
+
+        self.assertEqual(sync_scheduled_account(self.account.id), f'Sync of account {self.account.id} already running')
+        self.assertEqual(
+            sync_item_transactions(self.user.id, 'item_1'),
+            'Fetched 0 new transactions for 0 accounts of item item_1 (1 already syncing)'
+        )
+        with self.assertRaises(Retry):
+            sync_account_transactions(self.account.id)
+        mock_get_transactions.assert_not_called()
+        self.assertFalse(SyncRun.objects.exists())
+
+        release_sync_lock(self.account.id, token)
+        mock_get_transactions.return_value = {'total': 0, 'totalPages': 1, 'page': 1, 'results': []}
+        sync_account_transactions(self.account.id)
+        self.assertIsNotNone(acquire_sync_lock(self.account.id))
+
+    def test_cursor_never_moves_backwards(self):
+        """
+        Ensure a sync that loaded its state before a newer sync finished cannot rewind the high-water mark.
+        """
+        stale = SyncState.objects.create(account=self.account)
+        newest = datetime(2024, 3, 10, tzinfo=dt_timezone.utc)
+        advance_cursor(SyncState.objects.get(pk=stale.pk), newest)
+
+        advance_cursor(stale, datetime(2024, 2, 1, tzinfo=dt_timezone.utc))
+
+        self.assertEqual(SyncState.objects.get(pk=stale.pk).high_water_mark, newest)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    @patch('apps.banking.views.sync_account_transactions')
+    def test_fetch_transactions_starts_background_sync(self, mock_task):
+        """
+        Ensure the endpoint returns 202 with a task id the caller can poll.
+        """
+        mock_task.delay.return_value.id = 'sync-123'
+        url = reverse('banking:fetch_transactions', args=[self.account.id])
+
+        response = self.client.post(url, {}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['task_id'], 'sync-123')
+        mock_task.delay.assert_called_once_with(self.account.id, None, None, False)
+
+        with patch('apps.banking.views.AsyncResult') as mock_result:
+            mock_result.return_value.state = 'SUCCESS'
+            mock_result.return_value.result = 'Fetched 0 new transactions'
+            response = self.client.get(reverse('banking:sync_status', args=['sync-123']))
+        self.assertEqual(response.data['state'], 'SUCCESS')
+
+        response = self.client.get(reverse('banking:sync_status', args=['someone-else']))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    @patch('apps.banking.views.sync_account_transactions')
+    def test_fetch_transactions_parses_update_existing(self, mock_task):
+        """
+        Ensure string and form values of update_existing are parsed, not just tested for truthiness.
+        """
+        mock_task.delay.return_value.id = 'sync-123'
+        url = reverse('banking:fetch_transactions', args=[self.account.id])
+
+        for value, expected in [('false', False), ('0', False), ('true', True), (True, True)]:
+            self.client.post(url, {'update_existing': value, 'start_date': '2024-01-01'}, format='json')
+            mock_task.delay.assert_called_with(self.account.id, '2024-01-01', None, expected)
+
+        self.client.post(url, {'update_existing': 'false'})
+        mock_task.delay.assert_called_with(self.account.id, None, None, False)
+
+        response = self.client.post(url, {'update_existing': 'maybe'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PluggyServiceTests(TestCase):
+
+    def _serve(self, responses):
+        """
+        Serve ``responses`` (status, headers, body) in order from a local
+        HTTP server and point PluggyService at it.
+        """
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append(self.headers)
+                status_code, headers, body = responses.pop(0)
+                self.send_response(status_code)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        base_url = patch.object(PluggyService, 'BASE_URL', f'http://127.0.0.1:{server.server_port}')
+        base_url.start()
+        self.addCleanup(base_url.stop)
+        return requests_seen
+
+    def test_requests_share_the_global_budget(self):
+        """
+        Ensure every Pluggy call takes a slot from the fleet-wide limiter.
+        """
+        with patch.object(pluggy_rate_limiter, 'acquire') as mock_acquire, \
+                patch.object(PluggyService, 'get_session') as mock_session:
+            mock_session.return_value.get.return_value.json.return_value = {'results': []}
+            PluggyService.get_accounts('item_id')
+            PluggyService.get_transactions('account_id', '2024-01-01', '2024-01-31')
+
+        self.assertEqual(mock_acquire.call_count, 2)
+
+    def test_session_is_reused_within_a_process(self):
+        """
+        Ensure every call in a process shares one pooled session.
+        """
+        self.assertIs(PluggyService.get_session(), PluggyService.get_session())
+
+    @override_settings(PLUGGY_RETRY_BACKOFF=0)
+    def test_retries_rate_limited_responses(self):
+        """
+        Ensure a 429 with Retry-After is retried on the same session.
+        """
+        session = PluggyService.create_session()
+        requests_seen = self._serve([
+            (429, {'Retry-After': '0'}, b''),
+            (503, {}, b''),
+            (200, {'Content-Type': 'application/json'}, b'{"results": []}'),
+        ])
+
+        with patch.object(PluggyService, 'get_session', return_value=session):
+            data = PluggyService.get_accounts('item_id')
+
+        self.assertEqual(data, {'results': []})
+        self.assertEqual(len(requests_seen), 3)
+        self.assertIn('gzip', requests_seen[0]['Accept-Encoding'])
+
+    @override_settings(PLUGGY_RETRY_BACKOFF=0)
+    def test_every_attempt_takes_a_slot(self):
+        """
+        Ensure retries are counted against the limiter like first attempts.
+        """
+        session = PluggyService.create_session()
+        self._serve([
+            (429, {'Retry-After': '0'}, b''),
+            (503, {}, b''),
+            (200, {'Content-Type': 'application/json'}, b'{"results": []}'),
+        ])
+
+        with patch.object(pluggy_rate_limiter, 'acquire') as mock_acquire, \
+                patch.object(PluggyService, 'get_session', return_value=session):
+            PluggyService.get_accounts('item_id')
+
+        self.assertEqual(mock_acquire.call_count, 3)
+
+    def test_rate_limited_request_fails_fast_with_max_wait(self):
+        """
+        Ensure a 429 asking for a longer wait than max_wait raises RateLimitExceeded without retrying.
+        """
+        session = PluggyService.create_session()
+        requests_seen = self._serve([(429, {'Retry-After': '20'}, b'')])
+
+        with patch.object(PluggyService, 'get_session', return_value=session):
+            with self.assertRaises(RateLimitExceeded) as raised:
+                PluggyService.get_accounts('item_id', max_wait=2)
+
+        self.assertEqual(raised.exception.retry_after, 20)
+        self.assertEqual(len(requests_seen), 1)
+
+    @override_settings(PLUGGY_MAX_RETRIES=1, PLUGGY_RETRY_BACKOFF=0)
+    def test_gives_up_after_max_retries(self):
+        """
+        Ensure the last error response is raised once retries run out.
+        """
+        session = PluggyService.create_session()
+        self._serve([(500, {}, b''), (502, {}, b'')])
+
+        with patch.object(PluggyService, 'get_session', return_value=session):
+            with self.assertRaises(requests.HTTPError) as raised:
+                PluggyService.get_transactions('account_id', '2024-01-01', '2024-01-31')
+        self.assertEqual(raised.exception.response.status_code, 502)
+
+    @override_settings(PLUGGY_CONNECT_TIMEOUT=2, PLUGGY_READ_TIMEOUT=7)
+    def test_requests_use_configured_timeouts(self):
+        """
+        Ensure every request carries the connect and read timeouts.
+        """
+        with patch.object(PluggyService, 'get_session') as mock_session:
+            mock_session.return_value.get.return_value.json.return_value = {'results': []}
+            PluggyService.get_accounts('item_id')
+
+        self.assertEqual(mock_session.return_value.get.call_args.kwargs['timeout'], (2, 7))
+
+    def test_iter_transactions_is_lazy(self):
+        """
+        Ensure each page is only requested once the previous one is consumed.
+        """
+        with patch.object(PluggyService, 'get_transactions') as mock_get_transactions:
+            mock_get_transactions.side_effect = [
+                {'totalPages': 3, 'page': 1, 'results': [{'id': '1'}]},
+                {'totalPages': 3, 'page': 2, 'results': [{'id': '2'}]},
+                {'totalPages': 3, 'page': 3, 'results': [{'id': '3'}]},
+            ]
+            pages = PluggyService.iter_transactions('account_id', '2024-01-01', '2024-12-31', page_size=1)
+
+            self.assertEqual(next(pages), [{'id': '1'}])
+            self.assertEqual(mock_get_transactions.call_count, 1)
+            self.assertEqual(list(pages), [[{'id': '2'}], [{'id': '3'}]])
+        mock_get_transactions.assert_called_with('account_id', '2024-01-01', '2024-12-31', page=3, page_size=1)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    PLUGGY_WEBHOOK_SECRET='webhook-secret',
+)
+class PluggyWebhookTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('banking:pluggy_webhook')
+
+    def send_webhook(self, event, item_id='item_1', secret='webhook-secret'):
+        """
+        Deliver an event the way Pluggy does: unauthenticated JSON POST with
+        the configured custom header.
+        """
+        return self.client.post(
+            self.url,
+            {'event': event, 'eventId': f'{event}-{item_id}', 'itemId': item_id},
+            format='json',
+            HTTP_X_WEBHOOK_SECRET=secret,
+        )
+
+    @patch('apps.banking.tasks.sync_webhook_item')
+    def test_burst_of_events_schedules_one_sync(self, mock_task):
+        """
+        Ensure ten events for an item inside the window produce one sync.
+        """
+        for _ in range(10):
+            response = self.send_webhook('transactions/created')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.send_webhook('item/updated', item_id='item_2')
+
+        self.assertEqual(mock_task.apply_async.call_count, 2)
+        mock_task.apply_async.assert_any_call(('item_1',), countdown=30)
+
+    @patch('apps.banking.tasks.sync_webhook_item')
+    def test_rejects_wrong_secret_and_ignores_other_events(self, mock_task):
+        """
+        Ensure a bad secret is refused and unrelated events schedule nothing.
+        """
+        self.assertEqual(self.send_webhook('item/updated', secret='wrong').status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.send_webhook('item/error').status_code, status.HTTP_200_OK)
+        mock_task.apply_async.assert_not_called()
+
+    @patch('apps.banking.tasks.sync_item_transactions')
+    @patch('apps.banking.tasks.sync_webhook_item.apply_async')
+    def test_sync_reopens_the_window(self, mock_apply_async, mock_sync_item):
+        """
+        Ensure events arriving once the sync has started schedule another one.
+        """
+        user = User.objects.create_user(email='webhook@example.com', password='password123')
+        BankAccount.objects.create(
+            user=user, pluggy_account_id='webhook_account', pluggy_item_id='item_1',
+            bank_name='Test Bank', account_type='CHECKING', balance=0
+        )
+        self.send_webhook('transactions/created')
+
+        sync_webhook_item('item_1')
+        mock_sync_item.assert_called_once_with(user.id, 'item_1')
+
+        self.send_webhook('transactions/created')
+        self.assertEqual(mock_apply_async.call_count, 2)
+
+
+@override_settings(PLUGGY_SCHEDULE_BATCH_SIZE=5, PLUGGY_SCHEDULE_PER_USER=2)
+class ScheduledSyncTests(TestCase):
+    def setUp(self):
+        self.heavy_user = User.objects.create_user(email='heavy@example.com', password='password123')
+        self.light_user = User.objects.create_user(email='light@example.com', password='password123')
+        self.heavy_accounts = [self._create_account(self.heavy_user, f'heavy_{i}') for i in range(6)]
+        self.light_account = self._create_account(self.light_user, 'light_0')
+
+    def _create_account(self, user, pluggy_id):
+        return BankAccount.objects.create(
+            user=user, pluggy_account_id=pluggy_id,
+            bank_name='Test Bank', account_type='CHECKING', balance=0
+        )
+
+    @patch('apps.banking.tasks.sync_scheduled_account')
+    def test_scheduler_gives_each_user_a_fair_share(self, mock_task):
+        """
+        Ensure a user with many due accounts cannot take every slot of a tick.
+        """
+        result = schedule_account_syncs()
+
+        scheduled = [call.args[0][0] for call in mock_task.apply_async.call_args_list]
+        self.assertEqual(result, 'Scheduled 3 account syncs')
+        self.assertIn(self.light_account.id, scheduled)
+        self.assertEqual(len([account_id for account_id in scheduled if account_id != self.light_account.id]), 2)
+        for call in mock_task.apply_async.call_args_list:
+            self.assertLessEqual(call.kwargs['countdown'], 300)
+
+        # Leased accounts are not scheduled twice; the heavy user's backlog drains over later ticks
+        mock_task.reset_mock()
+        schedule_account_syncs()
+        second = [call.args[0][0] for call in mock_task.apply_async.call_args_list]
+        self.assertEqual(len(second), 2)
+        self.assertFalse(set(second) & set(scheduled))
+
+    @override_settings(PLUGGY_SCHEDULE_PER_USER=10, PLUGGY_SCHEDULE_BATCH_SIZE=4)
+    @patch('apps.banking.tasks.sync_scheduled_account')
+    def test_scheduler_respects_batch_size(self, mock_task):
+        """
+        Ensure no more than PLUGGY_SCHEDULE_BATCH_SIZE syncs start per tick.
+        """
+        schedule_account_syncs()
+        self.assertEqual(mock_task.apply_async.call_count, 4)
+
+    @patch('apps.ai_services.tasks.categorize_new_transactions')
+    @patch('apps.banking.tasks.PluggyService.get_transactions')
+    def test_scheduled_sync_records_runs_and_backs_off(self, mock_get_transactions, mock_task):
+        """
+        Ensure each run is recorded and repeated failures push the next sync further away.
+        """
+        account = self.light_account
+        mock_get_transactions.side_effect = requests.ConnectionError('down')
+
+        sync_scheduled_account(account.id)
+        first_delay = SyncState.objects.get(account=account).next_sync_at - timezone.now()
+        sync_scheduled_account(account.id)
+        state = SyncState.objects.get(account=account)
+        second_delay = state.next_sync_at - timezone.now()
+
+        self.assertEqual(state.consecutive_failures, 2)
+        self.assertEqual(state.last_error, 'down')
+        self.assertGreater(second_delay, first_delay * 1.5)
+
+        mock_get_transactions.side_effect = None
+        mock_get_transactions.return_value = {'total': 1, 'totalPages': 1, 'page': 1, 'results': [
+            {'id': 'scheduled_1', 'amount': -10, 'description': 'PADARIA', 'date': '2024-01-02T00:00:00+00:00'},
+        ]}
+        with self.captureOnCommitCallbacks(execute=True):
+            result = sync_scheduled_account(account.id)
+
+        self.assertEqual(result, f'Fetched 1 new transactions for account {account.id}')
+        state.refresh_from_db()
+        self.assertEqual(state.consecutive_failures, 0)
+        runs = list(SyncRun.objects.filter(account=account).order_by('id'))
+        self.assertEqual([run.succeeded for run in runs], [False, False, True])
+        self.assertEqual(runs[-1].transactions_synced, 1)
+        self.assertIsNotNone(runs[-1].duration)
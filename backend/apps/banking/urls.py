@@ -8,4 +8,7 @@ urlpatterns = [
     path('accounts/connect/', views.connect_bank_account, name='connect_bank_account'),
     path('accounts/<int:account_id>/disconnect/', views.disconnect_bank_account, name='disconnect_bank_account'),
     path('accounts/<int:account_id>/transactions/fetch/', views.fetch_transactions, name='fetch_transactions'),
+    path('items/<str:item_id>/sync/', views.sync_item, name='sync_item'),
+    path('accounts/sync/<str:task_id>/', views.sync_status, name='sync_status'),
+    path('webhooks/pluggy/', views.pluggy_webhook, name='pluggy_webhook'),
 ]
@@ -1,16 +1,26 @@
 from rest_framework import status
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
+from celery.result import AsyncResult
+from django.conf import settings
+from django.core.cache import cache
+import hmac
+import math
 from .models import BankAccount
-from .serializers import BankAccountSerializer, ConnectBankAccountSerializer
+from .serializers import BankAccountSerializer, ConnectBankAccountSerializer, FetchTransactionsSerializer
 from .services import PluggyService
-from apps.transactions.models import Transaction
+from .tasks import schedule_item_sync, sync_account_transactions, sync_item_transactions
+from apps.ai_services.ratelimit import RateLimitExceeded
+from apps.transactions.versioning import bump_data_version, conditional_on_data_version
 from apps.categories.models import Category
-from datetime import datetime
+
+# Pluggy events after which an item has new or changed transactions
+SYNC_EVENTS = {'item/created', 'item/updated', 'transactions/created', 'transactions/updated'}
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@conditional_on_data_version
 def list_bank_accounts(request):
     accounts = BankAccount.objects.filter(user=request.user, is_active=True)
     serializer = BankAccountSerializer(accounts, many=True)
@@ -23,24 +33,18 @@ def connect_bank_account(request):
     if serializer.is_valid():
         item_id = serializer.validated_data['itemId']
         try:
-            accounts_data = PluggyService.get_accounts(item_id)
-            created_accounts = []
-            for account_data in accounts_data['results']:
-                bank_account, created = BankAccount.objects.update_or_create(
-                    user=request.user,
-                    pluggy_account_id=account_data['id'],
-                    defaults={
-                        'bank_name': account_data.get('name', 'Unknown'),
-                        'account_type': account_data.get('type', 'OTHER'),
-                        'balance': account_data.get('balance', 0),
-                        'is_active': True,
-                    }
-                )
-                created_accounts.append(bank_account)
+            accounts_data = PluggyService.get_accounts(item_id, max_wait=settings.PLUGGY_REQUEST_MAX_WAIT)
+            created_accounts = BankAccount.objects.upsert_from_pluggy(request.user, item_id, accounts_data['results'])
 
             response_serializer = BankAccountSerializer(created_accounts, many=True)
             return Response(response_serializer.data, status=status.HTTP_201_CREATED)
 
+        except RateLimitExceeded as e:
+            return Response(
+                {'error': 'Bank provider is busy, try again shortly'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': str(math.ceil(e.retry_after))},
+            )
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -53,6 +57,7 @@ def disconnect_bank_account(request, account_id):
         account = BankAccount.objects.get(id=account_id, user=request.user)
         account.is_active = False
         account.save()
+        bump_data_version(request.user.id)
         return Response({'message': 'Bank account disconnected successfully'})
     except BankAccount.DoesNotExist:
         return Response({'error': 'Bank account not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -65,33 +70,71 @@ def fetch_transactions(request, account_id):
     except BankAccount.DoesNotExist:
         return Response({'error': 'Bank account not found'}, status=status.HTTP_404_NOT_FOUND)
 
-    start_date = request.data.get('start_date')
-    end_date = request.data.get('end_date')
+    serializer = FetchTransactionsSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    options = serializer.validated_data
+
+    task = sync_account_transactions.delay(
+        account.id, options['start_date'], options['end_date'], options['update_existing']
+    )
+    # Remember who started the task so only they can poll it
+    cache.set(f'sync_owner_{task.id}', request.user.id, timeout=settings.PLUGGY_SYNC_STATUS_TTL)
+
+    return Response({
+        'message': 'Transaction sync started in background',
+        'task_id': task.id
+    }, status=status.HTTP_202_ACCEPTED)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def sync_item(request, item_id):
+    if not BankAccount.objects.filter(user=request.user, pluggy_item_id=item_id, is_active=True).exists():
+        return Response({'error': 'Item not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Every account of the item is fetched concurrently from its own cursor
+    task = sync_item_transactions.delay(request.user.id, item_id)
+    cache.set(f'sync_owner_{task.id}', request.user.id, timeout=settings.PLUGGY_SYNC_STATUS_TTL)
+
+    return Response({
+        'message': 'Item sync started in background',
+        'task_id': task.id
+    }, status=status.HTTP_202_ACCEPTED)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def sync_status(request, task_id):
+    if cache.get(f'sync_owner_{task_id}') != request.user.id:
+        return Response({'error': 'Task not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    result = AsyncResult(task_id, app=sync_account_transactions.app)
+    response = {'task_id': task_id, 'state': result.state}
+    if result.state == 'SUCCESS':
+        response['result'] = result.result
+    elif result.state == 'FAILURE':
+        response['error'] = str(result.result)
+    return Response(response)
+
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def pluggy_webhook(request):
+    """
+    Receive Pluggy webhook events. Only checks the shared secret and
+    schedules a debounced item sync, so Pluggy gets its answer right away.
+    """
+    secret = request.headers.get('X-Webhook-Secret', '')
+    if not settings.PLUGGY_WEBHOOK_SECRET or not hmac.compare_digest(secret, settings.PLUGGY_WEBHOOK_SECRET):
+        return Response({'error': 'Invalid webhook secret'}, status=status.HTTP_403_FORBIDDEN)
 
-    if not start_date or not end_date:
-        return Response({'error': 'start_date and end_date are required'}, status=status.HTTP_400_BAD_REQUEST)
+    event = request.data.get('event')
+    item_id = request.data.get('itemId')
+    if event not in SYNC_EVENTS or not item_id:
+        return Response({'message': 'Event ignored'})
 
     try:
-        pluggy_transactions = PluggyService.get_transactions(account.pluggy_account_id, start_date, end_date)
-
-        saved_transactions = []
-        for tx_data in pluggy_transactions.get('transactions', []):
-            # Check if transaction already exists
-            if not Transaction.objects.filter(pluggy_transaction_id=tx_data['id']).exists():
-                transaction = Transaction.objects.create(
-                    account=account,
-                    pluggy_transaction_id=tx_data['id'],
-                    amount=tx_data['amount'],
-                    description=tx_data['description'],
-                    date=datetime.fromisoformat(tx_data['date']),
-                    # Category will be set by AI later
-                )
-                saved_transactions.append(transaction)
-
-        return Response({
-            'message': f'Successfully fetched {len(saved_transactions)} new transactions',
-            'transactions': len(saved_transactions)
-        }, status=status.HTTP_200_OK)
-
-    except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        schedule_item_sync(item_id)
+    except Exception:
+        # Broker might not be available; Pluggy retries failed deliveries
+        return Response({'error': 'Could not schedule sync'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response({'message': 'Event received'})
@@ -0,0 +1,73 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction as db_transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from apps.ai_services.benchmarking import Rollback, create_transactions, percentile
+from apps.transactions.models import Transaction
+from apps.transactions.readers import transaction_mapper, transaction_values
+from apps.transactions.serializers import TransactionSerializer
+from config.renderers import ORJSONRenderer
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the CPU time list_transactions spends per page with the serializer and '
+        'JSONRenderer against the values() read path and ORJSONRenderer, on synthetic '
+        'transactions. Everything it writes is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transactions', type=int, default=5000)
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--rounds', type=int, default=3, help='Times every page is rendered by each path')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            with db_transaction.atomic():
+                account = create_transactions(options['transactions'], options['seed'], categories=5)
+                self.run(account, options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def serializer_page(self, transactions, offset, limit):
+        page = transactions.select_related('category')[offset:offset + limit]
+        return JSONRenderer().render({'results': TransactionSerializer(page, many=True).data})
+
+    def values_page(self, transactions, offset, limit):
+        page = transaction_values(transactions)[offset:offset + limit]
+        to_dict = transaction_mapper()
+        return ORJSONRenderer().render({'results': [to_dict(row) for row in page]})
+
+    def run(self, account, options):
+        transactions = Transaction.objects.filter(account=account).order_by('-date', '-id')
+        limit = options['page_size']
+        offsets = range(0, options['transactions'], limit)
+        paths = [('serializer + JSONRenderer', self.serializer_page), ('values() + ORJSONRenderer', self.values_page)]
+
+        bodies = {}
+        results = {}
+        for name, render_page in paths:
+            cpu_times = []
+            with CaptureQueriesContext(connection) as queries:
+                for _ in range(options['rounds']):
+                    for offset in offsets:
+                        started = time.process_time()
+                        bodies[name, offset] = render_page(transactions, offset, limit)
+                        cpu_times.append(time.process_time() - started)
+            results[name] = (cpu_times, len(queries))
+
+        pages = len(offsets) * options['rounds']
+        identical = all(bodies[paths[0][0], offset] == bodies[paths[1][0], offset] for offset in offsets)
+        self.stdout.write(f'{options["transactions"]} transactions, {len(offsets)} pages of {limit}, '
+                          f'{options["rounds"]} rounds')
+        for name, (cpu_times, query_count) in results.items():
+            self.stdout.write(name)
+            self.stdout.write(f'  cpu per page:       {sum(cpu_times) / len(cpu_times) * 1000:.2f} ms mean, '
+                              f'{percentile(cpu_times, 0.5) * 1000:.2f} / {percentile(cpu_times, 0.99) * 1000:.2f} ms p50/p99')
+            self.stdout.write(f'  queries per page:   {query_count / pages:.2f}')
+        before, after = (sum(results[name][0]) for name, _ in paths)
+        self.stdout.write(f'speedup:              {before / after if after else 0:.1f}x')
+        self.stdout.write(f'identical output:     {"yes" if identical else "NO"}')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from apps.banking.models import BankAccount
+from apps.transactions.models import TransactionCounter
+
+class Command(BaseCommand):
+    help = 'Recount transactions per account, category and month and fix drifted counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, help='Only reconcile this user\'s accounts')
+
+    def handle(self, *args, **options):
+        accounts = BankAccount.objects.order_by('id')
+        if options['user_id']:
+            accounts = accounts.filter(user_id=options['user_id'])
+
+        checked = fixed = 0
+        for account in accounts.iterator():
+            fixed += TransactionCounter.objects.reconcile(account)
+            checked += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Checked {checked} accounts, fixed {fixed} counters'))
@@ -1,6 +1,147 @@
-from django.db import models
+from collections import defaultdict
+from datetime import datetime
+from django.db import IntegrityError, models, transaction as db_transaction
+from django.db.models import F, Q, Sum
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from apps.banking.models import BankAccount
 from apps.categories.models import Category
+from apps.ai_services.normalizer import normalize_merchant
+from .versioning import bump_data_version, bump_global_data_version
+
+def month_of(date):
+    """
+    First day of ``date``'s month in TIME_ZONE, the TransactionCounter bucket.
+    """
+    if timezone.is_naive(date):
+        # Stored as-is, i.e. read back as TIME_ZONE
+        date = timezone.make_aware(date)
+    return timezone.localtime(date).date().replace(day=1)
+
+def month_start(month):
+    """
+    Aware datetime at which ``month`` (a first-of-month date) begins.
+    """
+    return timezone.make_aware(datetime(month.year, month.month, 1))
+
+def next_month(month):
+    return month.replace(year=month.year + 1, month=1) if month.month == 12 else month.replace(month=month.month + 1)
+
+class MerchantManager(models.Manager):
+    def for_descriptions(self, descriptions):
+        """
+        Return a dict mapping each merchant key found in ``descriptions`` to
+        its Merchant, creating the missing ones in bulk.
+        """
+        names = {}
+        for description in descriptions:
+            names.setdefault(normalize_merchant(description), description)
+
+        merchants = {merchant.key: merchant for merchant in self.filter(key__in=names)}
+        missing = [
+            self.model(key=key, name=names[key][:200])
+            for key in names if key not in merchants
+        ]
+        if missing:
+            self.bulk_create(missing, ignore_conflicts=True)
+            merchants.update({
+                merchant.key: merchant
+                for merchant in self.filter(key__in=[merchant.key for merchant in missing])
+            })
+        return merchants
+
+class TransactionManager(models.Manager):
+    INGEST_BATCH_SIZE = 1000
+
+    def ingest(self, account, records, update_existing=False):
+        """
+        Store a page of Pluggy transaction ``records`` for ``account`` with a
+        constant number of queries: one lookup of the incoming ids, merchant
+        resolution and batched bulk inserts in one atomic block, which holds
+        the account's row lock so concurrent ingests of it queue up.
+
+        With ``update_existing`` the account's rows that already exist are
+        upserted too, picking up changed amounts, descriptions and dates.
+        Returns the ids of the newly inserted rows.
+        """
+        records = {record['id']: record for record in records}
+        if not records:
+            return []
+
+        with db_transaction.atomic():
+            # Ingests of one account run one at a time, so rows a concurrent
+            # sync inserts are never taken for this call's own
+            BankAccount.objects.select_for_update().get(pk=account.pk)
+            existing = {
+                pluggy_id: (account_id, date, category_id)
+                for pluggy_id, account_id, date, category_id in self.filter(
+                    pluggy_transaction_id__in=records
+                ).values_list('pluggy_transaction_id', 'account_id', 'date', 'category_id')
+            }
+            new_ids = [pluggy_id for pluggy_id in records if pluggy_id not in existing]
+            if update_existing:
+                # Never touch a row that belongs to another account
+                written_ids = [pluggy_id for pluggy_id in records if existing.get(pluggy_id, (account.id,))[0] == account.id]
+            else:
+                written_ids = new_ids
+            if not written_ids:
+                return []
+
+            merchants = Merchant.objects.for_descriptions(records[pluggy_id]['description'] for pluggy_id in written_ids)
+            rows = [
+                self.model(
+                    account=account,
+                    pluggy_transaction_id=pluggy_id,
+                    amount=records[pluggy_id]['amount'],
+                    description=records[pluggy_id]['description'],
+                    date=datetime.fromisoformat(records[pluggy_id]['date']),
+                    merchant=merchants[normalize_merchant(records[pluggy_id]['description'])],
+                    # Category will be set by AI later
+                )
+                for pluggy_id in written_ids
+            ]
+            counts = defaultdict(int)
+            if update_existing:
+                self.bulk_create(
+                    rows,
+                    batch_size=self.INGEST_BATCH_SIZE,
+                    update_conflicts=True,
+                    unique_fields=['pluggy_transaction_id'],
+                    update_fields=['amount', 'description', 'date', 'merchant', 'updated_at'],
+                )
+                # Rows whose date moved to another month move between counters
+                for row in rows:
+                    if row.pluggy_transaction_id in existing:
+                        account_id, old_date, category_id = existing[row.pluggy_transaction_id]
+                        if month_of(old_date) != month_of(row.date):
+                            counts[(account.id, category_id, month_of(old_date))] -= 1
+                            counts[(account.id, category_id, month_of(row.date))] += 1
+            else:
+                # Another account may hold some of these ids; those are skipped
+                self.bulk_create(rows, batch_size=self.INGEST_BATCH_SIZE, ignore_conflicts=True)
+
+            inserted = list(
+                self.filter(account=account, pluggy_transaction_id__in=new_ids).order_by('id').values_list('id', 'date')
+            ) if new_ids else []
+            for transaction_id, date in inserted:
+                counts[(account.id, None, month_of(date))] += 1
+            TransactionCounter.objects.add(counts)
+            bump_data_version(account.user_id)
+
+        return [transaction_id for transaction_id, date in inserted]
+
+class Merchant(models.Model):
+    key = models.CharField(max_length=200, unique=True, help_text="Canonical merchant key from normalize_merchant")
+    name = models.CharField(max_length=200, help_text="First description seen for this merchant")
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = MerchantManager()
+
+    def __str__(self):
+        return self.key
 
 class Transaction(models.Model):
     account = models.ForeignKey(BankAccount, on_delete=models.CASCADE)
@@ -9,16 +150,236 @@ class Transaction(models.Model):
     description = models.CharField(max_length=200)
     date = models.DateTimeField()
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True)
+    merchant = models.ForeignKey(Merchant, on_delete=models.SET_NULL, null=True, blank=True)
     is_processed = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = TransactionManager()
+
     class Meta:
-        ordering = ['-date']
+        ordering = ['-date', '-id']
         indexes = [
-            models.Index(fields=['account', 'date']),
+            # Serves list_transactions' (date, id) keyset pagination per account
+            models.Index(fields=['account', 'date', 'id'], name='transaction_keyset_idx'),
             models.Index(fields=['category']),
+            # Partial index: only unprocessed rows, so it stays tiny and the
+            # straggler sweeper never scans categorized history
+            models.Index(fields=['created_at'], condition=models.Q(is_processed=False), name='transaction_unprocessed_idx'),
         ]
 
     def __str__(self):
         return f"{self.account.user.username} - {self.description} - {self.amount}"
+
+    # Fields that place a row in a TransactionCounter
+    COUNTER_FIELDS = ('account_id', 'category_id', 'date')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remembered so save() can move the row between counters. Only the
+        # loaded values are read: touching a deferred field would load it
+        instance._counter_values = instance.loaded_counter_values()
+        return instance
+
+    def loaded_counter_values(self):
+        return {name: self.__dict__[name] for name in self.COUNTER_FIELDS if name in self.__dict__}
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        # The refreshed fields hold the stored values again
+        stored = getattr(self, '_counter_values', {})
+        for name, value in self.loaded_counter_values().items():
+            if fields is None or name in fields or name.removesuffix('_id') in fields:
+                stored[name] = value
+        self._counter_values = stored
+
+    @staticmethod
+    def counter_key_of(account_id, category_id, date):
+        if date is None:
+            return None
+        return (account_id, category_id, month_of(date))
+
+    def counter_key(self):
+        return self.counter_key_of(
+            self.account_id, self.category_id, self._meta.get_field('date').to_python(self.date)
+        )
+
+    def stored_counter_key(self):
+        """
+        Counter key of the row as stored, from the values loaded with it or,
+        when some of them were deferred, from the database.
+        """
+        if self._state.adding or self.pk is None:
+            return None
+        stored = getattr(self, '_counter_values', {})
+        if len(stored) < len(self.COUNTER_FIELDS):
+            row = Transaction.objects.filter(pk=self.pk).values(*self.COUNTER_FIELDS).first()
+            if row is None:
+                return None
+            stored = row
+        return self.counter_key_of(stored['account_id'], stored['category_id'], stored['date'])
+
+    def save(self, *args, **kwargs):
+        """
+        Keep TransactionCounter in step with single-row writes. Bulk paths
+        (ingest, categorization) update the counters themselves.
+        """
+        with db_transaction.atomic():
+            old_key = self.stored_counter_key()
+            super().save(*args, **kwargs)
+            new_key = self.counter_key()
+            if new_key != old_key:
+                counts = defaultdict(int)
+                if old_key:
+                    counts[old_key] -= 1
+                counts[new_key] += 1
+                TransactionCounter.objects.add(counts)
+            bump_data_version(self.account.user_id)
+        self._counter_values = self.loaded_counter_values()
+
+    def delete(self, *args, **kwargs):
+        with db_transaction.atomic():
+            key = self.stored_counter_key()
+            user_id = self.account.user_id
+            result = super().delete(*args, **kwargs)
+            if key:
+                TransactionCounter.objects.add({key: -1})
+            bump_data_version(user_id)
+        return result
+
+class TransactionCounterManager(models.Manager):
+    def add(self, counts):
+        """
+        Apply ``counts``, a mapping of (account id, category id, month) to a
+        change in the number of transactions. Call it inside the atomic block
+        that writes the transactions, so counters and rows commit together.
+        """
+        for (account_id, category_id, month), delta in counts.items():
+            if not delta:
+                continue
+            counter = self.filter(account_id=account_id, category_id=category_id, month=month)
+            if counter.update(count=F('count') + delta):
+                continue
+            try:
+                with db_transaction.atomic():
+                    self.create(account_id=account_id, category_id=category_id, month=month, count=delta)
+            except IntegrityError:
+                # Created concurrently since the update above
+                counter.update(count=F('count') + delta)
+
+    def count_for(self, user, start=None, end=None, category_id=None):
+        """
+        Number of ``user``'s transactions on active accounts with
+        start <= date <= end and, if given, in ``category_id``.
+
+        Months fully inside the range are read from the counters; only the
+        partial months at either edge are counted row by row, so the cost
+        does not grow with the length of the user's history.
+        """
+        counters = self.filter(account__user=user, account__is_active=True)
+        transactions = Transaction.objects.filter(account__user=user, account__is_active=True)
+        if category_id is not None:
+            counters = counters.filter(category_id=category_id)
+            transactions = transactions.filter(category_id=category_id)
+
+        # Whole months covered by the range: [first_month, end_month)
+        first_month = None
+        if start is not None:
+            first_month = month_of(start)
+            if start > month_start(first_month):
+                first_month = next_month(first_month)
+            counters = counters.filter(month__gte=first_month)
+        end_month = month_of(end) if end is not None else None
+        if end_month is not None:
+            counters = counters.filter(month__lt=end_month)
+
+        if first_month is not None and end_month is not None and first_month >= end_month:
+            # The range lies within a single month
+            return transactions.filter(date__gte=start, date__lte=end).count()
+
+        total = counters.aggregate(total=Sum('count'))['total'] or 0
+        if start is not None and start < month_start(first_month):
+            total += transactions.filter(date__gte=start, date__lt=month_start(first_month)).count()
+        if end is not None:
+            total += transactions.filter(date__gte=month_start(end_month), date__lte=end).count()
+        return total
+
+    def reconcile(self, account):
+        """
+        Recount ``account``'s transactions and rewrite its counters where
+        they drifted. Returns the number of counters fixed.
+        """
+        with db_transaction.atomic():
+            # Locks out concurrent increments until the recount is written
+            stored = {
+                (counter.category_id, counter.month): counter
+                for counter in self.select_for_update().filter(account=account)
+            }
+            actual = {}
+            for category_id, date in Transaction.objects.filter(account=account).values_list('category_id', 'date').iterator():
+                key = (category_id, month_of(date))
+                actual[key] = actual.get(key, 0) + 1
+
+            fixed = 0
+            for key in stored.keys() | actual.keys():
+                counter = stored.get(key)
+                count = actual.get(key, 0)
+                if counter is None:
+                    self.create(account=account, category_id=key[0], month=key[1], count=count)
+                elif not count:
+                    counter.delete()
+                elif counter.count != count:
+                    counter.count = count
+                    counter.save(update_fields=['count'])
+                else:
+                    continue
+                fixed += 1
+        return fixed
+
+class TransactionCounter(models.Model):
+    """
+    Number of transactions per account, category and month, kept in step
+    with the Transaction table so listing never counts a user's history.
+    Fix drift with the reconcile_transaction_counters command.
+    """
+    account = models.ForeignKey(BankAccount, on_delete=models.CASCADE, related_name='transaction_counters')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, null=True, blank=True)
+    month = models.DateField(help_text="First day of the month, in TIME_ZONE")
+    count = models.IntegerField(default=0)
+
+    objects = TransactionCounterManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['account', 'category', 'month'], name='transaction_counter_unique'),
+            # NULLs are distinct in unique constraints, so uncategorized rows need their own
+            models.UniqueConstraint(
+                fields=['account', 'month'], condition=Q(category__isnull=True), name='transaction_counter_null_uniq'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.account} - {self.category} - {self.month:%Y-%m}: {self.count}"
+
+@receiver(pre_delete, sender=Category)
+def move_counters_to_uncategorized(sender, instance, **kwargs):
+    """
+    Deleting a category leaves its transactions uncategorized (SET_NULL)
+    and cascades to its counters, so carry their counts over first.
+    """
+    counts = defaultdict(int)
+    for account_id, month, count in TransactionCounter.objects.filter(
+        category=instance
+    ).values_list('account_id', 'month', 'count'):
+        counts[(account_id, None, month)] += count
+    TransactionCounter.objects.add(counts)
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def bump_versions_for_category(sender, **kwargs):
+    """
+    Categories are embedded in every user's transactions, so any change
+    to one invalidates everyone's ETags.
+    """
+    bump_global_data_version()
@@ -0,0 +1,81 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from django.db.models import Q
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(row, direction):
+    """
+    Opaque cursor pointing just past the transaction ``row`` (a values()
+    dict) in ``direction`` ('next' or 'prev').
+    """
+    payload = json.dumps([direction, row['date'].isoformat(), row['id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, date, transaction_id = json.loads(payload)
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return direction, datetime.fromisoformat(date), int(transaction_id)
+    except (binascii.Error, ValueError, TypeError, UnicodeDecodeError) as e:
+        raise InvalidCursor('Invalid cursor') from e
+
+def paginate_keyset(transactions, cursor, limit):
+    """
+    Return one page of ``transactions`` (a values() queryset with at least
+    date and id) in (-date, -id) order, plus the next and previous cursors
+    (None at either end).
+
+    Pages are selected with a (date, id) range condition instead of an
+    offset, so any page costs the same as the first one.
+    """
+    direction = 'next'
+    if cursor:
+        direction, date, transaction_id = decode_cursor(cursor)
+        if direction == 'next':
+            transactions = transactions.filter(Q(date__lt=date) | Q(date=date, id__lt=transaction_id))
+        else:
+            transactions = transactions.filter(Q(date__gt=date) | Q(date=date, id__gt=transaction_id))
+
+    if direction == 'next':
+        rows = list(transactions.order_by('-date', '-id')[:limit + 1])
+    else:
+        rows = list(transactions.order_by('date', 'id')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+
+    if not rows:
+        return rows, None, None
+    # Coming from the other side means there is at least one row beyond that edge
+    has_next = has_more if direction == 'next' else bool(cursor)
+    has_prev = has_more if direction == 'prev' else bool(cursor)
+    next_cursor = encode_cursor(rows[-1], 'next') if has_next else None
+    prev_cursor = encode_cursor(rows[0], 'prev') if has_prev else None
+    return rows, next_cursor, prev_cursor
+
+def iter_keyset(transactions, chunk_size):
+    """
+    Yield all of ``transactions`` (a values() queryset with at least date
+    and id) in (-date, -id) order, as lists of up to ``chunk_size`` rows.
+
+    Each chunk is a separate short query continuing after the last row of
+    the previous one, so no cursor or transaction stays open between them
+    and memory does not grow with the number of rows.
+    """
+    transactions = transactions.order_by('-date', '-id')
+    chunk = list(transactions[:chunk_size])
+    while chunk:
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        chunk = list(transactions.filter(
+            Q(date__lt=last['date']) | Q(date=last['date'], id__lt=last['id'])
+        )[:chunk_size])
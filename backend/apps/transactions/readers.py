@@ -0,0 +1,65 @@
+"""
+Read path for the transaction endpoints that skips model instances and
+DRF serializer fields. Rows come from one joined values() query and are
+mapped to exactly what TransactionSerializer would output.
+"""
+import decimal
+from django.utils import timezone
+
+TRANSACTION_VALUES = (
+    'id', 'pluggy_transaction_id', 'amount', 'description', 'date', 'is_processed', 'created_at', 'updated_at',
+    'category_id', 'category__name', 'category__icon', 'category__color',
+)
+
+# Transaction.amount is DecimalField(max_digits=10, decimal_places=2)
+AMOUNT_QUANTUM = decimal.Decimal('0.01')
+AMOUNT_CONTEXT = decimal.Context(prec=10)
+
+def transaction_values(transactions):
+    """
+    The values() query behind transaction_mapper(); categories are joined in.
+    """
+    return transactions.values(*TRANSACTION_VALUES)
+
+def transaction_mapper():
+    """
+    Return a function turning a transaction_values() row into the dict
+    TransactionSerializer produces: amounts as fixed two-decimal strings,
+    datetimes in the current time zone as ISO 8601 with 'Z' for UTC.
+    """
+    tz = timezone.get_current_timezone()
+
+    def format_datetime(value):
+        if not value:
+            return None
+        value = value.astimezone(tz) if timezone.is_aware(value) else timezone.make_aware(value, tz)
+        value = value.isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+
+    def format_amount(value):
+        if value is None:
+            return ''
+        return f'{value.quantize(AMOUNT_QUANTUM, context=AMOUNT_CONTEXT):f}'
+
+    def to_dict(row):
+        category_id = row['category_id']
+        return {
+            'id': row['id'],
+            'pluggy_transaction_id': row['pluggy_transaction_id'],
+            'amount': format_amount(row['amount']),
+            'description': row['description'],
+            'date': format_datetime(row['date']),
+            'category': {
+                'id': category_id,
+                'name': row['category__name'],
+                'icon': row['category__icon'],
+                'color': row['category__color'],
+            } if category_id is not None else None,
+            'is_processed': row['is_processed'],
+            'created_at': format_datetime(row['created_at']),
+            'updated_at': format_datetime(row['updated_at']),
+        }
+
+    return to_dict
@@ -5,6 +5,8 @@ app_name = 'transactions'
 
 urlpatterns = [
     path('', views.list_transactions, name='list_transactions'),
+    path('export/<str:export_format>/', views.export_transactions, name='export_transactions'),
     path('<int:transaction_id>/', views.get_transaction, name='get_transaction'),
     path('categorize/', views.categorize_transactions, name='categorize_transactions'),
+    path('categorize/<str:task_id>/', views.categorization_status, name='categorization_status'),
 ]
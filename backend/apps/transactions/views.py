@@ -1,26 +1,59 @@
+import re
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from django.db.models import Q
-from .models import Transaction
-from .serializers import TransactionSerializer
+from celery.result import AsyncResult
+from datetime import datetime, time
+from django.conf import settings
+from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import Transaction, TransactionCounter
+from .export import EXPORT_FORMATS, stream_transactions
+from .pagination import InvalidCursor, paginate_keyset
+from .readers import transaction_mapper, transaction_values
+from .versioning import conditional_on_data_version
 from apps.banking.models import BankAccount
 from apps.ai_services.tasks import categorize_user_transactions
 
-@api_view(['GET'])
-@permission_classes([IsAuthenticated])
-def list_transactions(request):
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+def parse_date_param(value):
+    """
+    Parse a date or datetime query parameter into an aware datetime; a bare
+    date means midnight in TIME_ZONE. Raises ValueError on bad input.
+    """
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(value)
+        parsed = datetime.combine(date, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+def filter_transactions(user, query_params):
+    """
+    Return the user's transactions matching the start_date, end_date and
+    category_id query parameters, plus the parsed filters. Raises
+    ValueError on bad dates.
+    """
     # Get user's bank accounts
-    user_accounts = BankAccount.objects.filter(user=request.user, is_active=True)
+    user_accounts = BankAccount.objects.filter(user=user, is_active=True)
 
     # Get transactions for user's accounts
     transactions = Transaction.objects.filter(account__in=user_accounts)
 
     # Apply filters
-    start_date = request.query_params.get('start_date')
-    end_date = request.query_params.get('end_date')
-    category_id = request.query_params.get('category_id')
+    start_date = parse_date_param(query_params.get('start_date'))
+    end_date = parse_date_param(query_params.get('end_date'))
+    category_id = query_params.get('category_id')
 
     if start_date:
         transactions = transactions.filter(date__gte=start_date)
@@ -28,29 +61,80 @@ def list_transactions(request):
         transactions = transactions.filter(date__lte=end_date)
     if category_id:
         transactions = transactions.filter(category_id=category_id)
+    return transactions, start_date, end_date, category_id
 
-    # Paginate (simplified)
-    page = int(request.query_params.get('page', 1))
-    limit = int(request.query_params.get('limit', 20))
-    offset = (page - 1) * limit
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@conditional_on_data_version
+def list_transactions(request):
+    try:
+        transactions, start_date, end_date, category_id = filter_transactions(request.user, request.query_params)
+    except ValueError:
+        return Response({'error': 'start_date and end_date must be ISO 8601 dates'}, status=status.HTTP_400_BAD_REQUEST)
 
-    transactions = transactions[offset:offset + limit]
+    try:
+        page = int(request.query_params.get('page', 1))
+        limit = int(request.query_params.get('limit', settings.REST_FRAMEWORK['PAGE_SIZE']))
+    except ValueError:
+        return Response({'error': 'page and limit must be integers'}, status=status.HTTP_400_BAD_REQUEST)
+    # Never serve more than TRANSACTIONS_MAX_PAGE_SIZE rows, whatever the client asks for
+    limit = max(1, min(limit, settings.TRANSACTIONS_MAX_PAGE_SIZE))
 
-    serializer = TransactionSerializer(transactions, many=True)
-    return Response({
-        'count': Transaction.objects.filter(account__in=user_accounts).count(),
-        'results': serializer.data
-    })
+    transactions = transaction_values(transactions)
+    # Matches the filters above, read mostly from the monthly counters
+    response = {'count': TransactionCounter.objects.count_for(request.user, start_date, end_date, category_id or None)}
+
+    if 'page' in request.query_params and 'cursor' not in request.query_params:
+        # Deprecated offset pagination, kept for older app versions
+        offset = max(page - 1, 0) * limit
+        page_transactions = transactions.order_by('-date', '-id')[offset:offset + limit]
+    else:
+        try:
+            page_transactions, next_cursor, prev_cursor = paginate_keyset(
+                transactions, request.query_params.get('cursor'), limit
+            )
+        except InvalidCursor:
+            return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+        response['next'] = next_cursor
+        response['previous'] = prev_cursor
+
+    to_dict = transaction_mapper()
+    response['results'] = [to_dict(row) for row in page_transactions]
+    return Response(response)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+def export_transactions(request, export_format):
+    if export_format not in EXPORT_FORMATS:
+        return Response(
+            {'error': f'export_format must be one of: {", ".join(EXPORT_FORMATS)}'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    try:
+        transactions, start_date, end_date, category_id = filter_transactions(request.user, request.query_params)
+    except ValueError:
+        return Response({'error': 'start_date and end_date must be ISO 8601 dates'}, status=status.HTTP_400_BAD_REQUEST)
+
+    compress = bool(ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING', '')))
+    content_type, chunks = stream_transactions(
+        transaction_values(transactions), export_format, settings.TRANSACTIONS_EXPORT_CHUNK_SIZE, compress
+    )
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="transactions.{export_format}"'
+    if compress:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@conditional_on_data_version
 def get_transaction(request, transaction_id):
     try:
         # Get user's bank accounts
         user_accounts = BankAccount.objects.filter(user=request.user, is_active=True)
-        transaction = Transaction.objects.get(id=transaction_id, account__in=user_accounts)
-        serializer = TransactionSerializer(transaction)
-        return Response(serializer.data)
+        transaction = transaction_values(Transaction.objects.filter(account__in=user_accounts)).get(id=transaction_id)
+        return Response(transaction_mapper()(transaction))
     except Transaction.DoesNotExist:
         return Response({'error': 'Transaction not found'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -59,8 +143,26 @@ def get_transaction(request, transaction_id):
 def categorize_transactions(request):
     # Trigger background task for categorization
     task = categorize_user_transactions.delay(request.user.id)
+    # Remember who started the task so only they can poll its progress
+    cache.set(f'categorize_owner_{task.id}', request.user.id, timeout=settings.AI_CATEGORIZATION_PROGRESS_TTL)
 
     return Response({
         'message': 'Transaction categorization started in background',
         'task_id': task.id
     }, status=status.HTTP_202_ACCEPTED)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def categorization_status(request, task_id):
+    if cache.get(f'categorize_owner_{task_id}') != request.user.id:
+        return Response({'error': 'Task not found'}, status=status.HTTP_404_NOT_FOUND)
+
+    result = AsyncResult(task_id, app=categorize_user_transactions.app)
+    response = {'task_id': task_id, 'state': result.state}
+    if result.state == 'PROGRESS':
+        response.update(result.info or {})
+    elif result.state == 'SUCCESS':
+        response['result'] = result.result
+    elif result.state == 'FAILURE':
+        response['error'] = str(result.result)
+    return Response(response)
@@ -0,0 +1,23 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer on top of orjson. The output is byte-for-byte what
+    JSONRenderer produces for compact responses; datetimes, decimals and
+    other types orjson does not handle the DRF way go through DRF's encoder.
+    Indented (browsable or ?indent) responses fall back to JSONRenderer.
+    """
+    # Dates and datetimes are left to DRF's encoder, which writes UTC as 'Z'
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.ensure_ascii or not self.compact or \
+                self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        # Same strict javascript subset as JSONRenderer
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
@@ -1,4 +1,5 @@
 import os
+from datetime import timedelta
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -125,6 +126,79 @@ CACHES = {
     }
 }
 
+# AI categorization cache (AICache table)
+AI_CACHE_TTL = timedelta(days=int(os.environ.get('AI_CACHE_TTL_DAYS', '30')))
+AI_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CACHE_MAX_ENTRIES', '100000'))
+AI_CACHE_HIT_RESOLUTION = timedelta(hours=1)  # Minimum interval between last_hit_at writes
+AI_CACHE_SWEEP_BATCH_SIZE = 1000
+
+# Local category classifier tried before the LLM (see train_category_classifier)
+AI_CLASSIFIER_PATH = os.environ.get('AI_CLASSIFIER_PATH', str(BASE_DIR / 'var' / 'category_classifier.bin'))
+AI_CLASSIFIER_FEATURES = 2 ** 16
+AI_CLASSIFIER_THRESHOLD = float(os.environ.get('AI_CLASSIFIER_THRESHOLD', '0.9'))
+
+# OpenAI concurrency and account limits, shared by all workers through the cache
+AI_MAX_CONCURRENT_REQUESTS = int(os.environ.get('AI_MAX_CONCURRENT_REQUESTS', '4'))
+OPENAI_REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', '500'))
+OPENAI_TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', '200000'))
+OPENAI_MAX_RETRIES = 5
+OPENAI_RETRY_BACKOFF = 1.0  # Seconds, doubled on every retry
+OPENAI_MAX_RETRY_WAIT = 60  # Longest sleep before a retry, whatever Retry-After says
+OPENAI_REQUEST_TIMEOUT = 30  # Seconds per completion request
+
+# Single-flight guard: one worker per merchant asks the LLM, the others wait
+# The lease covers a worst-case call: every attempt waits out the rate
+# limiter's 70s lookback, times out and sleeps the longest retry wait
+AI_SINGLE_FLIGHT_LEASE = (OPENAI_MAX_RETRIES + 1) * (70 + OPENAI_REQUEST_TIMEOUT + OPENAI_MAX_RETRY_WAIT)
+AI_SINGLE_FLIGHT_WAIT = 10  # Seconds a waiter polls before using the keyword matcher
+AI_SINGLE_FLIGHT_POLL_INTERVAL = 0.1
+
+# Transactions read and written back per chunk by the categorization task
+AI_CATEGORIZATION_CHUNK_SIZE = 500
+# Backlogs larger than this are split into id ranges of this size and fanned out across workers
+AI_CATEGORIZATION_FANOUT_SIZE = 5000
+AI_CATEGORIZATION_PROGRESS_TTL = 24 * 60 * 60  # Seconds
+# Unprocessed transactions older than this are picked up by categorize_stragglers
+AI_CATEGORIZATION_STRAGGLER_DELAY = timedelta(minutes=30)
+AI_CATEGORIZATION_STRAGGLER_LIMIT = 10000
+
+# Pluggy HTTP client: one pooled keep-alive session per process
+PLUGGY_CONNECT_TIMEOUT = float(os.environ.get('PLUGGY_CONNECT_TIMEOUT', '5'))  # Seconds
+PLUGGY_READ_TIMEOUT = float(os.environ.get('PLUGGY_READ_TIMEOUT', '30'))  # Seconds
+PLUGGY_POOL_SIZE = int(os.environ.get('PLUGGY_POOL_SIZE', '10'))  # Keep-alive connections, and concurrent requests, to the API host
+PLUGGY_MAX_RETRIES = 3  # On connection errors, 429 and 5xx; Retry-After is honoured
+PLUGGY_RETRY_BACKOFF = 0.5  # Seconds, doubled on every retry
+PLUGGY_MAX_RETRY_WAIT = 30  # Longest sleep before a retry, whatever Retry-After says
+PLUGGY_REQUEST_MAX_WAIT = 2  # Seconds a web request may wait for the budget or a retry before answering 503
+PLUGGY_PAGE_SIZE = 500  # Transactions per page, Pluggy's maximum
+PLUGGY_REQUESTS_PER_MINUTE = int(os.environ.get('PLUGGY_REQUESTS_PER_MINUTE', '300'))  # Across all workers
+
+# Incremental account sync (apps.banking.tasks.sync_account_transactions)
+PLUGGY_SYNC_INITIAL_DAYS = 90  # History fetched on an account's first sync
+PLUGGY_SYNC_OVERLAP = timedelta(days=3)  # Re-read before the cursor for late-posted items
+PLUGGY_SYNC_STATUS_TTL = 24 * 60 * 60  # Seconds a sync task can be polled
+PLUGGY_SYNC_MAX_WORKERS = int(os.environ.get('PLUGGY_SYNC_MAX_WORKERS', '4'))  # Accounts of an item fetched at once
+PLUGGY_SYNC_QUEUE_SIZE = 8  # Downloaded pages waiting to be stored before fetch threads pause
+PLUGGY_SYNC_LOCK_LEASE = 30 * 60  # Seconds an account's sync lock outlives a worker that died mid-sync
+PLUGGY_SYNC_LOCK_RETRY_DELAY = 60  # Seconds before an on-demand sync retries an account already syncing
+
+# Scheduled refresh of every active account (apps.banking.tasks.schedule_account_syncs)
+PLUGGY_SYNC_INTERVAL = timedelta(hours=int(os.environ.get('PLUGGY_SYNC_INTERVAL_HOURS', '6')))
+PLUGGY_SYNC_MAX_BACKOFF = timedelta(days=1)  # Cap on the doubling delay after repeated failures
+PLUGGY_SCHEDULE_TICK = timedelta(minutes=5)  # How often the scheduler runs; starts are jittered across it
+PLUGGY_SCHEDULE_BATCH_SIZE = int(os.environ.get('PLUGGY_SCHEDULE_BATCH_SIZE', '200'))  # Syncs started per tick
+PLUGGY_SCHEDULE_PER_USER = 5  # Syncs started per user per tick, so no user starves the others
+
+# Pluggy webhooks: sent with this secret in the X-Webhook-Secret header
+# (configured as a custom header on the Pluggy webhook); empty rejects all
+PLUGGY_WEBHOOK_SECRET = os.environ.get('PLUGGY_WEBHOOK_SECRET', '')
+PLUGGY_WEBHOOK_DEBOUNCE = 30  # Seconds of events per item coalesced into one sync
+
+# Largest page list_transactions serves, whatever limit the client asks for
+TRANSACTIONS_MAX_PAGE_SIZE = 100
+# Rows read per query and written per flush by the streaming export
+TRANSACTIONS_EXPORT_CHUNK_SIZE = 2000
+
 # Celery Configuration
 CELERY_BROKER_URL = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
 CELERY_RESULT_BACKEND = os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0')
@@ -132,6 +206,20 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'America/Sao_Paulo'
+CELERY_BEAT_SCHEDULE = {
+    'sweep-ai-cache': {
+        'task': 'apps.ai_services.tasks.sweep_ai_cache',
+        'schedule': timedelta(minutes=15),
+    },
+    'categorize-stragglers': {
+        'task': 'apps.ai_services.tasks.categorize_stragglers',
+        'schedule': timedelta(minutes=30),
+    },
+    'schedule-account-syncs': {
+        'task': 'apps.banking.tasks.schedule_account_syncs',
+        'schedule': PLUGGY_SCHEDULE_TICK,
+    },
+}
 
 # Custom user model
 AUTH_USER_MODEL = 'authentication.CustomUser'
@@ -151,7 +239,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'config.renderers.ORJSONRenderer',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
@@ -159,7 +247,6 @@ REST_FRAMEWORK = {
 }
 
 # JWT Settings
-from datetime import timedelta
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=15),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),